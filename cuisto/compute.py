@@ -4,10 +4,124 @@ Contains actual computation functions.
 
 """
 
+from itertools import combinations
+
 import numpy as np
 import pandas as pd
+from scipy import ndimage
+
+from cuisto.utils import InfoStore, get_hemisphere_channel_mask, get_info_store
+
+
+def sum_grouping_sets(
+    df: pd.DataFrame,
+    by: list[str],
+    values: list[str],
+    pooled: dict | None = None,
+) -> pd.DataFrame:
+    """
+    Sum `values` per groups defined by `by`, and per groups pooling some keys.
+
+    This is similar to SQL's GROUPING SETS : groups are defined by all the `by` keys,
+    and also by the `by` keys except each combination of the `pooled` keys, whose
+    value is replaced by a label (eg. "both" for hemispheres). Groups are
+    integer-coded once. Counts and integer columns are summed in a single pass with
+    `np.bincount`, pooled sets are then summed from those. Other columns are summed
+    for each grouping set with pandas' compensated sum on the integer codes, so that
+    they are exactly the same as with `df.groupby()`.
+
+    Similarly to `df.groupby(by).sum()`, missing values in `values` are ignored,
+    missing keys are discarded (except for pooled keys, where they are included in the
+    pooled groups) and only groups with data are returned.
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+    by : list of str
+        Keys in `df` defining the groups.
+    values : list of str
+        Keys in `df` to sum.
+    pooled : dict or None, optional
+        Maps keys in `by` to pool to the label of the pooled groups, eg.
+        `{"hemisphere": "both"}`. Default is None (no pooled groups).
+
+    Returns
+    -------
+    df_sums : pandas.DataFrame
+        `by` and `values` columns, with one entry per group. Groups are sorted by
+        `by`, with groups of each grouping set following each others, in order :
+        no pooled keys, one pooled key, two pooled keys...
+
+    """
+    if pooled is None:
+        pooled = {}
+
+    # integer-coded groups, missing keys have their own (last) code
+    codes, uniques = [], []
+    for key in by:
+        key_codes, key_uniques = pd.factorize(df[key], sort=True)
+        key_codes[key_codes < 0] = len(key_uniques)
+        codes.append(key_codes)
+        uniques.append(key_uniques)
+    shape = tuple(len(key_uniques) + 1 for key_uniques in uniques)
+    flat_codes = np.ravel_multi_index(codes, shape)
+    size = int(np.prod(shape))
+
+    # one pass for the counts and integer sums
+    counts = np.bincount(flat_codes, minlength=size).reshape(shape)
+    sums = {
+        col: np.bincount(
+            flat_codes, weights=df[col].to_numpy(float), minlength=size
+        ).reshape(shape)
+        for col in values
+        if pd.api.types.is_integer_dtype(df[col])
+    }
+
+    df_sums = []
+    for npooled in range(len(pooled) + 1):
+        for pooled_keys in combinations(pooled, npooled):
+            set_counts, set_sums = counts, dict(sums)
+            set_uniques = list(uniques)
+            for key in pooled_keys:
+                axis = by.index(key)
+                set_counts = set_counts.sum(axis=axis, keepdims=True)
+                set_sums = {
+                    col: s.sum(axis=axis, keepdims=True) for col, s in set_sums.items()
+                }
+                set_uniques[axis] = np.array([pooled[key]], dtype=object)
+            # compensated sums of the other columns, pooled keys have a single code
+            set_codes = np.ravel_multi_index(
+                [
+                    np.zeros_like(key_codes) if key in pooled_keys else key_codes
+                    for key, key_codes in zip(by, codes)
+                ],
+                set_counts.shape,
+            )
+            for col in values:
+                if col not in set_sums:
+                    col_sums = df[col].groupby(set_codes).sum()
+                    set_sums[col] = np.zeros(set_counts.size)
+                    set_sums[col][col_sums.index] = col_sums.to_numpy()
+                    set_sums[col] = set_sums[col].reshape(set_counts.shape)
+            # discard missing keys, except for pooled keys
+            subset = tuple(
+                slice(None) if key in pooled_keys else slice(0, -1) for key in by
+            )
+            set_counts = set_counts[subset]
 
-from cuisto.utils import get_starter_cells, select_hemisphere_channel
+            # keep groups with data
+            indices = np.nonzero(set_counts)
+            data = {
+                key: np.asarray(key_uniques).take(key_indices)
+                for key, key_uniques, key_indices in zip(by, set_uniques, indices)
+            }
+            for col in values:
+                data[col] = set_sums[col][subset][indices].astype(
+                    df[col].dtype, copy=False
+                )
+            df_sums.append(pd.DataFrame(data))
+
+    return pd.concat(df_sums, ignore_index=True)
 
 
 def get_regions_metrics(
@@ -32,6 +146,9 @@ def get_regions_metrics(
     Supports objects that are counted (polygons or points) and objects whose length is
     measured (fibers-like).
 
+    Metrics are computed on (regions, channels) arrays and the result is built directly
+    in long format, with one entry per region, hemisphere and channel.
+
     Parameters
     ----------
     df_annotations : pandas.DataFrame
@@ -49,7 +166,7 @@ def get_regions_metrics(
     Returns
     -------
     df_regions : pandas.DataFrame
-        DataFrame with brain regions name, area and metrics.
+        DataFrame with brain regions name, area and metrics, one entry per channel.
 
     """
     # get columns names
@@ -58,133 +175,587 @@ def get_regions_metrics(
     cols_colors = cols[
         cols.str.startswith(object_type) & cols.str.endswith(meas_base_name)
     ]
-    # select relevant data
-    cols_to_select = pd.Index(["Name", "hemisphere", "Area µm^2"]).append(cols_colors)
-    # sum lengths and areas of each brain regions
+    # sum lengths and areas of each brain regions, in each hemisphere and for both
+    # hemispheres
     df_regions = (
-        df_annotations[cols_to_select]
-        .groupby(["Name", "hemisphere"])
-        .sum()
-        .reset_index()
-    )
-
-    # get measurement for both hemispheres (sum)
-    df_both = df_annotations[cols_to_select].groupby(["Name"]).sum().reset_index()
-    df_both["hemisphere"] = "both"
-    df_regions = (
-        pd.concat([df_regions, df_both], ignore_index=True)
+        sum_grouping_sets(
+            df_annotations,
+            ["Name", "hemisphere"],
+            pd.Index(["Area µm^2"]).append(cols_colors),
+            pooled={"hemisphere": "both"},
+        )
         .sort_values(by="Name")
         .reset_index()
         .drop(columns="index")
     )
 
-    # rename measurement columns to lower case
-    df_regions = df_regions.rename(
-        columns={
-            k: k.replace(meas_base_name, meas_base_name.lower()) for k in cols_colors
-        }
-    )
-
     # update names
-    meas_base_name = meas_base_name.lower()
-    cols = df_regions.columns
-    cols_colors = cols[
-        cols.str.startswith(object_type) & cols.str.endswith(meas_base_name)
-    ]
-
-    # convert area in mm^2
-    df_regions["Area mm^2"] = df_regions["Area µm^2"] / 1e6
-
-    # prepare metrics
-    if meas_base_name.endswith("µm"):
+    channels = (
+        cols_colors.str.replace(object_type + ": ", "")
+        .str.replace(" " + meas_base_name, "")
+        .values.tolist()
+    )
+    meas_name = meas_base_name.lower()
+
+    # metrics are computed on (regions, channels) arrays, then flattened so that each
+    # channel has an entry
+    area_um = df_regions["Area µm^2"].to_numpy()[:, None]
+    area_mm = area_um / 1e6
+    measurement = df_regions[cols_colors].to_numpy()
+    metrics = {meas_name: measurement}
+    if meas_name.endswith("µm"):
         # fibers : convert to mm
-        cols_to_convert = pd.Index([col for col in cols_colors if "µm" in col])
-        df_regions[cols_to_convert.str.replace("µm", "mm")] = (
-            df_regions[cols_to_convert] / 1000
-        )
-        metrics = [meas_base_name, meas_base_name.replace("µm", "mm")]
-    else:
-        # objects : count
-        metrics = [meas_base_name]
-
-    # density = measurement / area
-    metric = metrics_names["density µm^-2"]
-    df_regions[cols_colors.str.replace(meas_base_name, metric)] = df_regions[
-        cols_colors
-    ].divide(df_regions["Area µm^2"], axis=0)
-    metrics.append(metric)
-    metric = metrics_names["density mm^-2"]
-    df_regions[cols_colors.str.replace(meas_base_name, metric)] = df_regions[
-        cols_colors
-    ].divide(df_regions["Area mm^2"], axis=0)
-    metrics.append(metric)
-
+        metrics[meas_name.replace("µm", "mm")] = measurement / 1000
+    metrics[metrics_names["density µm^-2"]] = measurement / area_um
+    density = measurement / area_mm
+    metrics[metrics_names["density mm^-2"]] = density
     # coverage index = measurement² / area
-    metric = metrics_names["coverage index"]
-    df_regions[cols_colors.str.replace(meas_base_name, metric)] = (
-        df_regions[cols_colors].pow(2).divide(df_regions["Area µm^2"], axis=0)
-    )
-    metrics.append(metric)
-
-    # prepare relative metrics columns
-    metric = metrics_names["relative measurement"]
-    cols_rel_meas = cols_colors.str.replace(meas_base_name, metric)
-    df_regions[cols_rel_meas] = np.nan
-    metrics.append(metric)
-    metric = metrics_names["relative density"]
-    cols_dens = cols_colors.str.replace(meas_base_name, metrics_names["density mm^-2"])
-    cols_rel_dens = cols_colors.str.replace(meas_base_name, metric)
-    df_regions[cols_rel_dens] = np.nan
-    metrics.append(metric)
+    metrics[metrics_names["coverage index"]] = measurement**2 / area_um
+
     # relative metrics should be defined within each hemispheres (left, right, both)
+    # relative measurement = measurement / total measurement
+    # relative density = density / total density
+    relative_measurement = np.full(measurement.shape, np.nan)
+    relative_density = np.full(measurement.shape, np.nan)
+    df_density = pd.DataFrame(density)
+    df_measurement = pd.DataFrame(measurement)
+    hemispheres = df_regions["hemisphere"].to_numpy()
     for hemisphere in df_regions["hemisphere"].unique():
-        row_indexer = df_regions["hemisphere"] == hemisphere
-
-        # relative measurement = measurement / total measurement
-        df_regions.loc[row_indexer, cols_rel_meas] = (
-            df_regions.loc[row_indexer, cols_colors]
-            .divide(df_regions.loc[row_indexer, cols_colors].sum())
-            .to_numpy()
+        row_indexer = hemispheres == hemisphere
+        relative_measurement[row_indexer] = measurement[row_indexer] / (
+            df_measurement[row_indexer].sum().to_numpy()
+        )
+        relative_density[row_indexer] = density[row_indexer] / (
+            df_density[row_indexer].sum().to_numpy()
         )
+    metrics[metrics_names["relative measurement"]] = relative_measurement
+    metrics[metrics_names["relative density"]] = relative_density
+
+    # one entry per region, hemisphere and channel
+    nchannels = len(channels)
+    df_regions = pd.DataFrame(
+        {
+            "Name": df_regions["Name"].to_numpy().repeat(nchannels),
+            "hemisphere": hemispheres.repeat(nchannels),
+            "Area µm^2": area_um.ravel().repeat(nchannels),
+            "Area mm^2": area_mm.ravel().repeat(nchannels),
+            **{metric: values.ravel() for metric, values in metrics.items()},
+            # add a color tag, given their names in the configuration file
+            "channel": np.tile(
+                np.array([channel_names[k] for k in channels], dtype=object),
+                len(df_regions),
+            ),
+        },
+        index=df_regions.index.repeat(nchannels),
+    )
+
+    return df_regions
+
+
+def get_bin_indices(values: np.ndarray, bin_edges: np.ndarray) -> np.ndarray:
+    """
+    Get the index of the bin of each value, for uniform bins.
+
+    Indices are computed arithmetically then corrected with the actual edges, so that
+    the result is the same as with `np.histogram(values, bin_edges)` : bins are
+    half-open, except the last one that includes its right edge.
+
+    Parameters
+    ----------
+    values : np.ndarray
+    bin_edges : np.ndarray
+        Uniformly spaced bin edges, as created with `np.linspace`.
+
+    Returns
+    -------
+    indices : np.ndarray
+        Bin index of each value. Values outside the bins and NaN get `nbins`, eg. the
+        index of a virtual overflow bin.
+
+    """
+    values = np.asarray(values)
+    nbins = len(bin_edges) - 1
+    first_edge, last_edge = bin_edges[0], bin_edges[-1]
+
+    indices = (values - first_edge) * (nbins / (last_edge - first_edge))
+    # clip to existing bins, NaN become 0
+    np.fmax(indices, 0, out=indices)
+    np.fmin(indices, nbins - 1, out=indices)
+    indices = indices.astype(np.intp)
+    # fix rounding errors with the actual edges
+    indices -= values < bin_edges.take(indices)
+    indices += (values >= bin_edges.take(indices + 1)) & (indices != nbins - 1)
+    # values outside the bins
+    outside = ~((values >= first_edge) & (values <= last_edge))
+    np.copyto(indices, nbins, where=outside)
+
+    return indices
+
+
+def get_distributions_counts(
+    df: pd.DataFrame,
+    cols: list[str],
+    hue: str,
+    hue_filter: dict,
+    binlims: list,
+    nbins: list[int],
+) -> dict:
+    """
+    Count objects in bins along several axes, globally and for each hue value.
+
+    This is the mergeable part of `get_distributions()` : counts of different parts of
+    the data (eg. images) can be summed with `merge_distributions_counts()`, then
+    turned into distributions with `get_distributions_from_counts()`.
+
+    For each axis, bin indices are computed once, then the counts of the global
+    distribution and of all hue values are computed at once with a single
+    `np.bincount` over combined (hue, bin) codes.
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+    cols : list of str
+        Keys in `df`, used to compute the distributions.
+    hue, hue_filter
+        See `get_distribution()`.
+    binlims : list
+        First bin left edge and last bin right edge, for each axis in `cols`.
+    nbins : list of int
+        Number of bins, for each axis in `cols`.
+
+    Returns
+    -------
+    counts : dict
+        "length_total" : number of objects in the subset selected by `hue_filter`,
+        "length_parts" : {hue value: number of objects in the subset},
+        "global" : {col: counts of all objects},
+        "per_hue" : {col: {hue value: counts of objects in the subset}}.
+        Missing hue values are represented by `np.nan`.
+
+    """
+    # - Preparation, for all axes
+    # subset used for additional distribution
+    subset = get_hemisphere_channel_mask(df, hue, hue_filter, False)
+    # get grouping values, in order of appearance
+    hue_values = [np.nan if pd.isna(v) else v for v in df[hue].unique()]
+    categories = [value for value in hue_values if not pd.isna(value)]
+    hue_codes = pd.Categorical(df[hue], categories=categories).codes.astype(np.intp)
+    nhues = len(categories)
+    # entries not in the subset get their own code so they count only globally
+    hue_codes[~subset | (hue_codes < 0)] = nhues
+    length_parts = np.bincount(hue_codes, minlength=nhues + 1)
+    # map hue values to their code, missing hue values have no data
+    value_codes = {
+        value: nhues if pd.isna(value) else categories.index(value)
+        for value in hue_values
+    }
+
+    counts = {
+        "length_total": int(subset.sum()),
+        "length_parts": {
+            value: int(length_parts[code]) if code < nhues else 0
+            for value, code in value_codes.items()
+        },
+        "global": {},
+        "per_hue": {},
+    }
+    for col, binlim, nbin in zip(cols, binlims, nbins):
+        bin_edges = np.linspace(*binlim, nbin + 1)  # create bins
+
+        # raw count per bins (histogram), for each hue and globally
+        # outside values are counted in an extra bin, that is then discarded
+        indices = get_bin_indices(df[col].to_numpy(), bin_edges)
+        indices += hue_codes * (nbin + 1)
+        col_counts = np.bincount(indices, minlength=(nhues + 1) * (nbin + 1))
+        col_counts = col_counts.reshape(nhues + 1, nbin + 1)[:, :nbin]
+
+        counts["global"][col] = col_counts.sum(axis=0)
+        # missing hue values (nhues code) have no data for the per-hue distributions
+        counts["per_hue"][col] = {
+            value: col_counts[code] if code < nhues else np.zeros(nbin, dtype=np.intp)
+            for value, code in value_codes.items()
+        }
+
+    return counts
+
+
+def merge_distributions_counts(counts_list: list[dict]) -> dict:
+    """
+    Sum counts from `get_distributions_counts()`.
+
+    Hue values are kept in order of first appearance.
+
+    Parameters
+    ----------
+    counts_list : list of dict
+        Counts computed with the same axes, hue and bins.
+
+    Returns
+    -------
+    counts : dict
+        Merged counts.
+
+    """
+    merged = None
+    for counts in counts_list:
+        if merged is None:
+            merged = {
+                "length_total": counts["length_total"],
+                "length_parts": dict(counts["length_parts"]),
+                "global": {col: c.copy() for col, c in counts["global"].items()},
+                "per_hue": {
+                    col: {value: c.copy() for value, c in col_counts.items()}
+                    for col, col_counts in counts["per_hue"].items()
+                },
+            }
+            continue
+
+        merged["length_total"] += counts["length_total"]
+        for value, length in counts["length_parts"].items():
+            merged["length_parts"][value] = (
+                merged["length_parts"].get(value, 0) + length
+            )
+        for col, c in counts["global"].items():
+            merged["global"][col] += c
+            for value, c_hue in counts["per_hue"][col].items():
+                if value in merged["per_hue"][col]:
+                    merged["per_hue"][col][value] += c_hue
+                else:
+                    merged["per_hue"][col][value] = c_hue.copy()
+
+    return merged
 
-        # relative density = density / total density
-        df_regions.loc[row_indexer, cols_rel_dens] = (
-            df_regions.loc[
-                row_indexer,
-                cols_dens,
+
+def get_distributions_from_counts(
+    counts: dict,
+    hue: str,
+    hue_filter: dict,
+    per_commonnorm: bool,
+    binlims: list,
+) -> list[pd.DataFrame]:
+    """
+    Build distributions from counts, see `get_distributions_counts()`.
+
+    Parameters
+    ----------
+    counts : dict
+        Output of `get_distributions_counts()` or `merge_distributions_counts()`.
+    hue, hue_filter, per_commonnorm
+        See `get_distribution()`.
+    binlims : list
+        First bin left edge and last bin right edge, for each axis in `counts`.
+
+    Returns
+    -------
+    dfs_distribution : list of pandas.DataFrame
+        Distribution along each axis in `counts`, see `get_distribution()`.
+
+    """
+    length_total = counts["length_total"]
+
+    dfs_distribution = []
+    for (col, count), binlim in zip(counts["global"].items(), binlims):
+        nbin = len(count)
+        bin_edges = np.linspace(*binlim, nbin + 1)  # create bins
+        bin_widths = np.diff(bin_edges)
+        # get bin centers rather than edges to plot them
+        bin_centers = bin_edges[:-1] + bin_widths / 2
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            # - Both hemispheres, all channels
+            # get normalized count (pdf)
+            distribution = count / bin_widths / count.sum()
+            df_distribution = [
+                pd.DataFrame(
+                    {
+                        "bins": bin_centers,
+                        "distribution": distribution,
+                        "count": count,
+                        "hemisphere": "both",
+                        "channel": "all",
+                        "axis": col,  # keep track of what col. was used
+                    }
+                )
             ]
-            .divide(df_regions.loc[row_indexer, cols_dens].sum())
-            .to_numpy()
-        )
 
-    # collect channel names
-    channels = (
-        cols_colors.str.replace(object_type + ": ", "")
-        .str.replace(" " + meas_base_name, "")
-        .values.tolist()
+            # - Per additional criterion
+            for value, count in counts["per_hue"][col].items():
+                # get normalized count (pdf)
+                distribution = count / bin_widths / count.sum()
+
+                if per_commonnorm:
+                    # re-normalize so that the sum of areas of all sub-parts is 1
+                    length_part = counts["length_parts"][value]
+                    distribution *= np.divide(length_part, length_total)
+
+                # make a DataFrame out of that
+                df_distribution.append(
+                    pd.DataFrame(
+                        {
+                            "bins": bin_centers,
+                            "distribution": distribution,
+                            "count": count,
+                            hue: value,
+                            "channel" if hue == "hemisphere" else "hemisphere": (
+                                hue_filter
+                            ),
+                            "axis": col,  # keep track of what col. was used
+                        }
+                    )
+                )
+
+        dfs_distribution.append(pd.concat(df_distribution))
+
+    return dfs_distribution
+
+
+def get_distributions(
+    df: pd.DataFrame,
+    cols: list[str],
+    hue: str,
+    hue_filter: dict,
+    per_commonnorm: bool,
+    binlims: list,
+    nbins: list[int],
+) -> list[pd.DataFrame]:
+    """
+    Computes distribution of objects along several axes.
+
+    This is the same as calling `get_distribution()` for each axis in `cols`, but the
+    data subset and hue are evaluated once, see `get_distributions_counts()`.
+    Probability densities are derived from the counts.
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+    cols : list of str
+        Keys in `df`, used to compute the distributions.
+    hue, hue_filter, per_commonnorm
+        See `get_distribution()`.
+    binlims : list
+        First bin left edge and last bin right edge, for each axis in `cols`.
+    nbins : list of int
+        Number of bins, for each axis in `cols`.
+
+    Returns
+    -------
+    dfs_distribution : list of pandas.DataFrame
+        Distribution along each axis in `cols`, see `get_distribution()`.
+
+    """
+    counts = get_distributions_counts(df, cols, hue, hue_filter, binlims, nbins)
+    return get_distributions_from_counts(
+        counts, hue, hue_filter, per_commonnorm, binlims
     )
-    # collect measurements columns names
-    cols_metrics = df_regions.columns.difference(
-        pd.Index(["Name", "hemisphere", "Area µm^2", "Area mm^2"])
+
+
+def get_histogram_2d(
+    x: np.ndarray, y: np.ndarray, xlim: list, ylim: list, nbins: int | list[int]
+) -> np.ndarray:
+    """
+    Count objects in a 2D grid.
+
+    Grids computed on different parts of the data with the same limits and number of
+    bins can be summed.
+
+    Parameters
+    ----------
+    x, y : np.ndarray
+        Coordinates.
+    xlim, ylim : list
+        First bin left edge and last bin right edge, in each dimension.
+    nbins : int or list of int
+        Number of bins, in each dimension.
+
+    Returns
+    -------
+    grid : np.ndarray
+        Counts, with shape (nbins_x, nbins_y). Same as `np.histogram2d()`.
+
+    """
+    nbins_x, nbins_y = (nbins, nbins) if np.isscalar(nbins) else nbins
+    ix = get_bin_indices(x, np.linspace(*xlim, nbins_x + 1))
+    iy = get_bin_indices(y, np.linspace(*ylim, nbins_y + 1))
+    # outside values are counted in extra bins, that are then discarded
+    grid = np.bincount(ix * (nbins_y + 1) + iy, minlength=(nbins_x + 1) * (nbins_y + 1))
+
+    return grid.reshape(nbins_x + 1, nbins_y + 1)[:nbins_x, :nbins_y]
+
+
+def get_density_volume(
+    x: np.ndarray,
+    y: np.ndarray,
+    z: np.ndarray,
+    shape: tuple[int, int, int],
+    resolution: tuple[float, float, float],
+    downsample: int = 1,
+    sigma: float | None = None,
+    weights: np.ndarray | None = None,
+) -> np.ndarray:
+    """
+    Count objects in a voxel grid aligned with the atlas annotation volume.
+
+    Voxels indices are computed from the coordinates, then objects are counted with a
+    single `np.bincount` on the raveled indices. Objects outside the grid are ignored.
+    Optionally, the volume is smoothed with a gaussian kernel, applied along each axis
+    in turn (separable filter).
+
+    With `downsample=1`, the volume has the same shape as the annotation volume, so
+    that the count in each region is `np.bincount(annotation.ravel(), volume.ravel())`.
+
+    Parameters
+    ----------
+    x, y, z : np.ndarray
+        Coordinates in microns. They should correspond to what is expected by
+        brainglobe-atlasapi : x is AP, y is DV and Z is ML.
+    shape : tuple of int
+        Shape of the atlas annotation volume, in voxels.
+    resolution : tuple of float
+        Atlas resolution, in microns, along each axis.
+    downsample : int, optional
+        Voxels of the output are `downsample` times larger than the atlas voxels, along
+        each axis. Default is 1 (atlas resolution).
+    sigma : float or None, optional
+        Standard deviation of the gaussian kernel, in microns. If None (default), the
+        volume is not smoothed.
+    weights : np.ndarray or None, optional
+        Weight of each object, eg. the length of fibers segments. If None (default),
+        each object counts for 1.
+
+    Returns
+    -------
+    volume : np.ndarray
+        Number (or sum of weights) of objects in each voxel, with shape
+        `ceil(shape / downsample)`. Integers if not weighted nor smoothed.
+
+    """
+    voxel_size = np.asarray(resolution, dtype=float) * downsample
+    grid_shape = tuple(-(-np.asarray(shape) // downsample))  # ceil
+
+    # voxels indices, objects outside the grid are discarded
+    indices = []
+    inside = np.ones(len(x), dtype=bool)
+    for values, size, n in zip((x, y, z), voxel_size, grid_shape):
+        values = np.asarray(values) / size
+        inside &= (values >= 0) & (values < n)  # NaN are outside too
+        indices.append(values)
+    indices = [np.floor(values[inside]).astype(np.intp) for values in indices]
+    if weights is not None:
+        weights = np.asarray(weights)[inside]
+
+    volume = np.bincount(
+        np.ravel_multi_index(indices, grid_shape),
+        weights=weights,
+        minlength=np.prod(grid_shape),
+    ).reshape(grid_shape)
+
+    if sigma:
+        # applied as 1D filters along each axis
+        volume = ndimage.gaussian_filter(
+            volume.astype(float), sigma / voxel_size, mode="constant"
+        )
+
+    return volume
+
+
+def split_segments(
+    x: np.ndarray,
+    y: np.ndarray,
+    z: np.ndarray,
+    offsets: np.ndarray,
+    resolution: tuple[float, float, float] | None = None,
+    shape: tuple[int, int, int] | None = None,
+) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Split paths in segments between consecutive points, and segments in voxels.
+
+    Points of path `i` are found between `offsets[i]` and `offsets[i + 1]`, each pair
+    of consecutive points of a path is a segment. If `resolution` is given, segments
+    are further split in pieces where they cross voxels boundaries, so that each piece
+    lies in a single voxel. This is done without loop : the crossings of each axis
+    planes are enumerated with `np.repeat`, then sorted along each segment.
+    Segments with non-finite coordinates are discarded.
+
+    Parameters
+    ----------
+    x, y, z : np.ndarray
+        Points coordinates, in microns.
+    offsets : np.ndarray
+        Paths limits in the points arrays, with length number of paths + 1.
+    resolution : tuple of float or None, optional
+        Voxels size, in microns, along each axis. If None (default), segments are not
+        split.
+    shape : tuple of int or None, optional
+        Shape of the voxel grid. Only crossings within the grid are enumerated, pieces
+        outside of it are merged. If None (default), all crossings are enumerated.
+
+    Returns
+    -------
+    segments : np.ndarray
+        Index of the first point of the segment each piece belongs to.
+    xm, ym, zm : np.ndarray
+        Coordinates of the middle of each piece, that is in the voxel of the piece.
+    lengths : np.ndarray
+        Length of each piece, in microns.
+
+    """
+    points = np.column_stack((x, y, z)).astype(float)
+    offsets = np.asarray(offsets)
+
+    # segments start at all points but the last of each path
+    is_start = np.ones(len(points), dtype=bool)
+    is_start[offsets[1:][np.diff(offsets) > 0] - 1] = False
+    starts = np.flatnonzero(is_start)
+    p0 = points[starts]
+    delta = points[starts + 1] - p0
+    valid = np.isfinite(p0).all(axis=1) & np.isfinite(delta).all(axis=1)
+    starts, p0, delta = starts[valid], p0[valid], delta[valid]
+    lengths = np.sqrt((delta**2).sum(axis=1))
+
+    if resolution is None:
+        return starts, *(p0 + delta / 2).T, lengths
+
+    # breakpoints along each segment, as a fraction of its length : 0, 1 and crossings
+    nsegments = len(starts)
+    segment_index = [np.arange(nsegments), np.arange(nsegments)]
+    fractions = [np.zeros(nsegments), np.ones(nsegments)]
+    for axis, res in enumerate(resolution):
+        v0 = p0[:, axis] / res
+        dv = delta[:, axis] / res
+        i0, i1 = np.floor(v0), np.floor(v0 + dv)
+        if shape is not None:
+            i0, i1 = np.clip(i0, -1, shape[axis]), np.clip(i1, -1, shape[axis])
+        ncrossings = np.abs(i1 - i0).astype(np.intp)
+        index = np.repeat(np.arange(nsegments), ncrossings)
+        # rank of each crossing along its segment
+        rank = np.arange(len(index)) - np.repeat(
+            np.cumsum(ncrossings) - ncrossings, ncrossings
+        )
+        # planes crossed : i0 + 1, ..., i1 going forward, i0, ..., i1 + 1 backward
+        forward = dv[index] > 0
+        planes = np.where(forward, i0[index] + 1 + rank, i0[index] - rank)
+        segment_index.append(index)
+        fractions.append((planes - v0[index]) / dv[index])
+    segment_index = np.concatenate(segment_index)
+    fractions = np.concatenate(fractions)
+    order = np.lexsort((fractions, segment_index))
+    segment_index, fractions = segment_index[order], fractions[order]
+
+    # pieces between consecutive breakpoints of the same segment
+    is_piece = segment_index[1:] == segment_index[:-1]
+    is_piece &= fractions[1:] > fractions[:-1]  # several planes crossed at once
+    segment_index = segment_index[:-1][is_piece]
+    fraction_start, fraction_end = fractions[:-1][is_piece], fractions[1:][is_piece]
+    middles = (
+        p0[segment_index]
+        + delta[segment_index] * ((fraction_start + fraction_end) / 2)[:, None]
     )
-    for metric in metrics:
-        cols_to_cat = [f"{object_type}: {cn} {metric}" for cn in channels]
-        # make sure it's part of available metrics
-        if not set(cols_to_cat) <= set(cols_metrics):
-            raise ValueError(f"{cols_to_cat} not in DataFrame.")
-        # group all colors in the same colors
-        df_regions[metric] = df_regions[cols_to_cat].values.tolist()
-        # remove original data
-        df_regions = df_regions.drop(columns=cols_to_cat)
-
-    # add a color tag, given their names in the configuration file
-    df_regions["channel"] = len(df_regions) * [[channel_names[k] for k in channels]]
-    metrics.append("channel")
-
-    # explode the dataframe so that each color has an entry
-    df_regions = df_regions.explode(metrics)
 
-    return df_regions
+    return (
+        starts[segment_index],
+        *middles.T,
+        lengths[segment_index] * (fraction_end - fraction_start),
+    )
 
 
 def get_distribution(
@@ -215,6 +786,8 @@ def get_distribution(
     `hue_filter="Ipsi.", per_commonnorm=False`. Computes a distribution for each channel
     only for points in the ipsilateral hemisphere. Each curve will have an area of 1.
 
+    Wraps `get_distributions()` for a single axis.
+
     Parameters
     ----------
     df : pandas.DataFrame
@@ -240,80 +813,24 @@ def get_distribution(
         per-channel variants.
 
     """
-
-    # - Preparation
-    bin_edges = np.linspace(*binlim, nbins + 1)  # create bins
-    df_distribution = []  # prepare list of distributions
-
-    # - Both hemispheres, all channels
-    # get raw count per bins (histogram)
-    count, bin_edges = np.histogram(df[col], bin_edges)
-    # get normalized count (pdf)
-    distribution, _ = np.histogram(df[col], bin_edges, density=True)
-    # get bin centers rather than edges to plot them
-    bin_centers = bin_edges[:-1] + np.diff(bin_edges) / 2
-
-    # make a DataFrame out of that
-    df_distribution.append(
-        pd.DataFrame(
-            {
-                "bins": bin_centers,
-                "distribution": distribution,
-                "count": count,
-                "hemisphere": "both",
-                "channel": "all",
-                "axis": col,  # keep track of what col. was used
-            }
-        )
-    )
-
-    # - Per additional criterion
-    # select data
-    df_sub = select_hemisphere_channel(df, hue, hue_filter, False)
-    hue_values = df[hue].unique()  # get grouping values
-    # total number of datapoints in the subset used for additional distribution
-    length_total = len(df_sub)
-
-    for value in hue_values:
-        # select part and coordinates
-        df_part = df_sub.loc[df_sub[hue] == value, col]
-
-        # get raw count per bins (histogram)
-        count, bin_edges = np.histogram(df_part, bin_edges)
-        # get normalized count (pdf)
-        distribution, _ = np.histogram(df_part, bin_edges, density=True)
-
-        if per_commonnorm:
-            # re-normalize so that the sum of areas of all sub-parts is 1
-            length_part = len(df_part)  # number of datapoints in that hemisphere
-            distribution *= length_part / length_total
-
-        # get bin centers rather than edges to plot them
-        bin_centers = bin_edges[:-1] + np.diff(bin_edges) / 2
-
-        # make a DataFrame out of that
-        df_distribution.append(
-            pd.DataFrame(
-                {
-                    "bins": bin_centers,
-                    "distribution": distribution,
-                    "count": count,
-                    hue: value,
-                    "channel" if hue == "hemisphere" else "hemisphere": hue_filter,
-                    "axis": col,  # keep track of what col. was used
-                }
-            )
-        )
-
-    return pd.concat(df_distribution)
+    return get_distributions(
+        df, [col], hue, hue_filter, per_commonnorm, [binlim], [nbins]
+    )[0]
 
 
 def normalize_starter_cells(
-    df: pd.DataFrame, cols: list[str], animal: str, info_file: str, channel_names: dict
+    df: pd.DataFrame,
+    cols: list[str],
+    animal: str,
+    info_file: str | InfoStore,
+    channel_names: dict,
 ) -> pd.DataFrame:
     """
     Normalize data by the number of starter cells.
 
+    The number of starter cells is looked up once per channel, then all columns are
+    divided at once.
+
     Parameters
     ----------
     df : pd.DataFrame
@@ -322,8 +839,8 @@ def normalize_starter_cells(
         Columns to divide by the number of starter cells.
     animal : str
         Animal ID to parse the number of starter cells.
-    info_file : str
-        Full path to the TOML file with informations.
+    info_file : str or InfoStore
+        Full path to the TOML file with informations, or its `InfoStore`.
     channel_names : dict
         Map between original channel names to something else.
 
@@ -333,14 +850,12 @@ def normalize_starter_cells(
         Same `df` with normalized count.
 
     """
-    for channel in df["channel"].unique():
-        # inverse mapping channel colors : names
-        reverse_channels = {v: k for k, v in channel_names.items()}
-        nstarters = get_starter_cells(animal, reverse_channels[channel], info_file)
-
-        for col in cols:
-            df.loc[df["channel"] == channel, col] = (
-                df.loc[df["channel"] == channel, col] / nstarters
-            )
+    if not isinstance(info_file, InfoStore):
+        info_file = get_info_store(info_file)
+
+    # inverse mapping channel colors : names
+    reverse_channels = {v: k for k, v in channel_names.items()}
+    nstarters = info_file.get_starter_cells(animal, df["channel"].map(reverse_channels))
+    df[cols] = df[cols].to_numpy() / nstarters[:, np.newaxis]
 
     return df
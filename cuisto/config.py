@@ -4,11 +4,13 @@ Contains the Config class.
 
 """
 
+import hashlib
 import os
 import tomllib
 import warnings
 
 from brainglobe_atlasapi import BrainGlobeAtlas
+
 from cuisto import utils
 
 
@@ -18,6 +20,12 @@ class Config:
 
     Reads input configuration file and provides its constant.
 
+    The Brainglobe atlas is loaded only when `bg_atlas` is first accessed. The
+    regions lists derived from the atlas (blacklist and leaves) are cached in
+    $HOME/.cuisto so that they are computed only once per atlas and blacklist file.
+    The `[dtypes]` section is optional, missing keys are taken from
+    `io.DTYPES_POLICY` when the policy is applied, see `io.apply_dtypes_policy()`.
+
     Parameters
     ----------
     config_file : str
@@ -38,10 +46,10 @@ class Config:
                 setattr(self, key, cfg[key])
 
         self.config_file = config_file
-        if self.atlas["name"]:
-            self.bg_atlas = BrainGlobeAtlas(self.atlas["name"], check_latest=False)
-        else:
-            self.bg_atlas = None
+        self._bg_atlas = None  # loaded on first access
+
+        # optional dtype policy, missing keys take the default value when applied
+        self.dtypes = getattr(self, "dtypes", {})
 
         # name axes to handle ABBA/Brainglobe atlases differences
         if self.atlas["type"] in ("abba", "brain"):
@@ -60,18 +68,48 @@ class Config:
         self.get_blacklist()
         self.get_leaves_list()
 
+    @property
+    def bg_atlas(self) -> BrainGlobeAtlas | None:
+        """Brainglobe atlas, loaded on first access. None if no atlas is specified."""
+        if (self._bg_atlas is None) and self.atlas["name"]:
+            self._bg_atlas = BrainGlobeAtlas(self.atlas["name"], check_latest=False)
+        return self._bg_atlas
+
+    @bg_atlas.setter
+    def bg_atlas(self, atlas: BrainGlobeAtlas | None):
+        self._bg_atlas = atlas
+
+    @property
+    def info_store(self) -> utils.InfoStore:
+        """Parsed info file, read again only when `files["infos"]` is modified."""
+        return utils.get_info_store(self.files["infos"])
+
+    def __getstate__(self) -> dict:
+        """Do not pickle the atlas, it is loaded again when needed."""
+        state = self.__dict__.copy()
+        state["_bg_atlas"] = None
+        return state
+
     def get_blacklist(self):
-        """Wraps cuisto.utils.get_blacklist."""
+        """Wraps cuisto.utils.get_blacklist, see `utils.get_cached_regions()`."""
 
         if os.path.isfile(self.files["blacklist"]):
-            self.atlas["blacklist"] = utils.get_blacklist(
-                self.files["blacklist"], self.bg_atlas
+            with open(self.files["blacklist"], "rb") as fid:
+                key = "blacklist_" + hashlib.md5(fid.read()).hexdigest()
+            self.atlas["blacklist"] = utils.get_cached_regions(
+                self.atlas["name"],
+                key,
+                lambda: utils.get_blacklist(self.files["blacklist"], self.bg_atlas),
             )
 
     def get_leaves_list(self):
-        """Wraps utils.get_leaves_list."""
+        """Wraps utils.get_leaves_list, see `utils.get_cached_regions()`."""
 
-        self.atlas["leaveslist"] = utils.get_leaves_list(self.bg_atlas)
+        self.atlas["leaveslist"] = utils.get_cached_regions(
+            self.atlas["name"],
+            "leaves_list",
+            lambda: utils.get_leaves_list(self.bg_atlas),
+        )
 
     def get_injection_sites(self, animals: list[str]) -> dict:
         """
@@ -93,20 +131,12 @@ class Config:
             for axis in ["x", "y", "z"]
         }
 
-        for animal in animals:
-            for channel in self.channels["names"].keys():
-                injx, injy, injz = utils.get_injection_site(
-                    animal,
-                    self.files["infos"],
-                    channel,
-                    stereo=self.distributions["stereo"],
-                )
-                if injx is not None:
-                    injection_sites["x"][channel].append(injx)
-                if injy is not None:
-                    injection_sites["y"][channel].append(injy)
-                if injz is not None:
-                    injection_sites["z"][channel].append(injz)
+        for channel in self.channels["names"].keys():
+            df_sites = self.info_store.get_injection_sites(
+                animals, channel, stereo=self.distributions["stereo"]
+            )
+            for axis in ["x", "y", "z"]:
+                injection_sites[axis][channel] = df_sites[axis].dropna().tolist()
 
         return injection_sites
 
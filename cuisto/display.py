@@ -12,7 +12,7 @@ import pandas as pd
 import seaborn as sns
 from matplotlib import patches
 
-from cuisto import atlas, utils
+from cuisto import atlas, io, utils
 
 
 def add_injection_patch(X: list, ax: plt.Axes, **kwargs) -> plt.Axes:
@@ -241,11 +241,22 @@ def nice_bar_plot(
         # get nx first most prominent regions
         if not names_list:
             names_list_plt = (
-                df.groupby(["Name"])[yi].mean().sort_values(ascending=False).index[0:nx]
+                df.groupby(["Name"], observed=True)[yi]
+                .mean()
+                .sort_values(ascending=False)
+                .index[0:nx]
             )
         else:
             names_list_plt = names_list
         dfplt = df[df["Name"].isin(names_list_plt)]  # limit to those regions
+        # plain labels so that seaborn shows only the selected ones, in order
+        dfplt = dfplt.astype(
+            {
+                col: "object"
+                for col, dtype in dfplt.dtypes.items()
+                if isinstance(dtype, pd.CategoricalDtype)
+            }
+        )
         # limit hierarchy list if provided
         if isinstance(ordering, list):
             order = [el for el in ordering if el in names_list_plt]
@@ -634,10 +645,12 @@ def nice_heatmap(
     return axs
 
 
-def plot_regions(df: pd.DataFrame, cfg, **kwargs):
+def plot_regions(df: pd.DataFrame | io.ResultsQuery, cfg, **kwargs):
     """
     Wraps nice_bar_plot().
     """
+    df = io.get_dataframe(df)
+
     # get regions order
     if cfg.regions["display"]["order"] == "ontology":
         regions_order = [d["acronym"] for d in cfg.bg_atlas.structures_list]
@@ -690,13 +703,18 @@ def plot_regions(df: pd.DataFrame, cfg, **kwargs):
 
 
 def plot_1D_distributions(
-    dfs_distributions: list[pd.DataFrame],
+    dfs_distributions: list[pd.DataFrame | io.ResultsQuery],
     cfg,
-    df_coordinates: pd.DataFrame = None,
+    df_coordinates: pd.DataFrame | io.ResultsQuery = None,
 ):
     """
     Wraps nice_distribution_plot().
     """
+    dfs_distributions = [io.get_dataframe(df) for df in dfs_distributions]
+    if df_coordinates is not None:
+        # only what is needed for the data coverage
+        df_coordinates = io.get_dataframe(df_coordinates, ["Atlas_AP", "animal"])
+
     # prepare figures
     fig, axs_dist = plt.subplots(1, 3, sharey=True, figsize=(13, 6))
     xlabels = [
@@ -784,10 +802,12 @@ def plot_1D_distributions(
     return fig
 
 
-def plot_2D_distributions(df: pd.DataFrame, cfg):
+def plot_2D_distributions(df: pd.DataFrame | io.ResultsQuery, cfg):
     """
     Wraps nice_joint_plot().
     """
+    df = io.get_dataframe(df, [cfg.Xname, cfg.Yname, cfg.Zname, "animal"])
+
     # -- 2D heatmap, all animals pooled
     # prepare figure
     fig_heatmap = plt.figure(figsize=(12, 9))
@@ -4,195 +4,1861 @@ Contains loading and saving functions.
 
 """
 
+import hashlib
+import inspect
 import os
+import pickle
+import re
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+from functools import partial
+from itertools import chain
 
-from brainglobe_atlasapi import BrainGlobeAtlas
-from cuisto import utils
+import numpy as np
 import orjson
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from brainglobe_atlasapi import BrainGlobeAtlas
+
+from cuisto import utils
+
+JSON_KW = ["fibers", "axons", "fiber", "axon"]
+CSV_KW = ["synapto", "synaptophysin", "syngfp", "boutons", "points"] + [
+    "cells",
+    "polygon",
+    "polygons",
+    "polygon",
+    "cell",
+]
+# QuPath columns identifying objects
+ID_COLUMNS = ["Image", "Object ID", "Object type", "Name", "Classification", "Parent"]
+# QuPath columns with atlas coordinates
+COORDINATES_COLUMNS = ["Atlas_X", "Atlas_Y", "Atlas_Z"]
+# columns with stereotaxic coordinates, added by the pipeline
+STEREO_COLUMNS = ["Atlas_AP", "Atlas_DV", "Atlas_ML"]
+# columns added by the pipeline
+PIPELINE_COLUMNS = STEREO_COLUMNS + ["hemisphere", "channel", "animal"]
+# columns with labels, in QuPath measurements and in the pipeline outputs
+LABEL_COLUMNS = [
+    "Image",
+    "Object type",
+    "Name",
+    "Classification",
+    "Parent",
+    "ROI",
+    "hemisphere",
+    "channel",
+    "animal",
+]
+# default dtype policy, can be overridden in the [dtypes] section of the configuration
+DTYPES_POLICY = {
+    "coordinates": "float32",  # type of the coordinates columns, empty to keep as is
+    "labels": "category",  # type of the labels columns, empty to keep as is
+    "drop_unused": False,  # drop QuPath measurements columns unused by the pipeline
+}
+# types of the points data in a FibersStore
+FIBERS_STORE_DTYPES = {
+    "x": "float32",
+    "y": "float32",
+    "z": "float32",
+    "hemisphere": "int8",
+}
+# explicit types of QuPath measurements columns
+QUPATH_DTYPES = {
+    "Atlas_X": "float32",
+    "Atlas_Y": "float32",
+    "Atlas_Z": "float32",
+    "Classification": "category",
+    "Parent": "category",
+    "Name": "category",
+}
+
+
+def get_measurements_directory(wdir, animal: str, kind: str, segtype: str) -> str:
+    """
+    Get the directory with detections or annotations measurements for given animal ID.
+
+    Parameters
+    ----------
+    wdir : str
+        Base working directory.
+    animal : str
+        Animal ID.
+    kind : str
+        "annotation" or "detection".
+    segtype : str
+        Type of segmentation, eg. "synaptophysin".
+
+    Returns
+    -------
+    directory : str
+        Path to detections or annotations directory.
+
+    """
+    bdir = os.path.join(wdir, animal, animal.lower() + "_segmentation", segtype)
+
+    if (kind == "detection") or (kind == "detections"):
+        return os.path.join(bdir, "detections")
+    elif (kind == "annotation") or (kind == "annotations"):
+        return os.path.join(bdir, "annotations")
+    else:
+        raise ValueError(
+            f"kind = '{kind}' not supported. Choose 'detection' or 'annotation'."
+        )
+
+
+def count_lines(filename: str) -> int:
+    """
+    Count the lines of a text file.
+
+    Parameters
+    ----------
+    filename : str
+        Full path to the file.
+
+    Returns
+    -------
+    nlines : int
+
+    """
+    with open(filename, "rb") as fid:
+        return sum(1 for _ in fid)
+
+
+def check_empty_file(filename: str, threshold: int = 1) -> bool:
+    """
+    Checks if a file is empty.
+
+    Empty is defined as a file whose number of lines is lower than or equal to
+    `threshold` (to allow for headers).
+
+    Parameters
+    ----------
+    filename : str
+        Full path to the file to check.
+    threshold : int, optional
+        If number of lines is lower than or equal to this value, it is considered as
+        empty. Default is 1.
+
+    Returns
+    -------
+    empty : bool
+        True if the file is empty as defined above.
+
+    """
+    if count_lines(filename) <= threshold:
+        return True
+    else:
+        return False
+
+
+def get_usecols(cfg, kind: str) -> Callable:
+    """
+    Get the columns of QuPath measurements files actually used in the pipeline.
+
+    Can be used as the `usecols` argument of pandas.read_csv() (and thus
+    `cat_csv_dir()`) so that other columns are not parsed at all.
+    For annotations, those are the identification columns, the area and the
+    `object_type: channel base_measurement` columns. For detections, those are the
+    identification columns, the atlas coordinates and the hemisphere if it was
+    exported from QuPath.
+
+    Parameters
+    ----------
+    cfg : cuisto.Config
+        The configuration, used to get the object type and base measurement.
+    kind : {"annotation", "detection"}
+        Kind of QuPath objects in the files.
+
+    Returns
+    -------
+    usecols : callable
+        Returns True if a column should be read.
+
+    """
+    if kind in ("detection", "detections"):
+        return partial(
+            _is_detection_column,
+            columns=frozenset(ID_COLUMNS + COORDINATES_COLUMNS + ["hemisphere"]),
+        )
+    elif kind in ("annotation", "annotations"):
+        return partial(
+            _is_annotation_column,
+            columns=set(ID_COLUMNS + ["Area µm^2"]),
+            object_type=cfg.object_type,
+            base_measurement=cfg.regions["base_measurement"],
+        )
+    else:
+        raise ValueError(
+            f"kind = '{kind}' not supported. Choose 'detection' or 'annotation'."
+        )
+
+
+def apply_dtypes_policy(
+    df: pd.DataFrame, policy: dict | None = None, usecols: Callable | None = None
+) -> pd.DataFrame:
+    """
+    Cast the columns of a DataFrame following a dtype policy.
+
+    Coordinates columns (atlas and stereotaxic) are cast to `policy["coordinates"]`
+    and labels columns (see `LABEL_COLUMNS`) to `policy["labels"]`. If
+    `policy["drop_unused"]` is True and `usecols` is provided, columns for which
+    `usecols` returns False are dropped first, except the ones added by the pipeline
+    (see `PIPELINE_COLUMNS`). Columns that already have the requested
+    type are left untouched, so that the DataFrame is not copied for nothing.
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+    policy : dict or None, optional
+        With keys "coordinates", "labels" and "drop_unused", as the `dtypes` attribute
+        of the configuration. Missing keys are taken from `DTYPES_POLICY`. Default is
+        None (default policy).
+    usecols : callable or None, optional
+        Returns True if a column is used, see `get_usecols()`. Default is None (no
+        column is dropped).
+
+    Returns
+    -------
+    df : pandas.DataFrame
+
+    """
+    policy = DTYPES_POLICY | (policy or {})
+
+    if policy["drop_unused"] and (usecols is not None):
+        dropped = [
+            col for col in df.columns if not (usecols(col) or (col in PIPELINE_COLUMNS))
+        ]
+        if dropped:
+            df = df.drop(columns=dropped)
+
+    dtypes = {}
+    for key, columns in (
+        ("coordinates", COORDINATES_COLUMNS + STEREO_COLUMNS),
+        ("labels", LABEL_COLUMNS),
+    ):
+        if policy[key]:
+            # compare names so that categories are not checked
+            dtype = pd.api.types.pandas_dtype(policy[key])
+            dtypes |= {
+                col: dtype
+                for col in columns
+                if (col in df.columns) and (df[col].dtype.name != dtype.name)
+            }
+
+    return df.astype(dtypes) if dtypes else df
+
+
+def _is_detection_column(col: str, columns: frozenset) -> bool:
+    """Column selector for detections, see get_usecols()."""
+    return col in columns
+
+
+def _is_annotation_column(
+    col: str, columns: set, object_type: str, base_measurement: str
+) -> bool:
+    """Column selector for annotations, see get_usecols()."""
+    return (col in columns) or (
+        col.startswith(object_type) and col.endswith(base_measurement)
+    )
+
+
+def read_csv_file(filename: str, **kwargs) -> pd.DataFrame | None:
+    """
+    Read a CSV file, returning None if it is empty.
+
+    Parameters
+    ----------
+    filename : str
+        Full path to the file.
+    **kwargs : passed to pandas.read_csv()
+
+    Returns
+    -------
+    df : pandas.DataFrame or None
+        File content, None if the file has no data rows.
+
+    """
+    if check_empty_file(filename, threshold=1):
+        return None
+    return pd.read_csv(filename, **kwargs)
+
+
+def concat_dfs(dfs: list[pd.DataFrame], **kwargs) -> pd.DataFrame:
+    """
+    Concatenate DataFrames, preserving categorical columns.
+
+    pandas.concat() falls back to object dtype if categorical columns do not have the
+    same categories in all DataFrames. Here, the categories are first unified (sorted
+    union) so that the result stays categorical.
+
+    Parameters
+    ----------
+    dfs : list of pandas.DataFrame
+    **kwargs : passed to pandas.concat()
+
+    Returns
+    -------
+    df : pandas.DataFrame
+        Concatenated DataFrame.
+
+    """
+    dfs = list(dfs)
+    catcols = {
+        col
+        for df in dfs
+        for col, dtype in df.dtypes.items()
+        if isinstance(dtype, pd.CategoricalDtype)
+    }
+    for col in catcols:
+        dtypes = {df[col].dtype for df in dfs if col in df.columns}
+        if len(dtypes) == 1 and all(col in df.columns for df in dfs):
+            # same categories everywhere, nothing to unify
+            continue
+        categories = sorted(
+            set().union(
+                *(
+                    df[col].cat.categories
+                    if isinstance(df[col].dtype, pd.CategoricalDtype)
+                    else df[col].dropna().unique()
+                    for df in dfs
+                    if col in df.columns
+                )
+            )
+        )
+        dtype = pd.CategoricalDtype(categories)
+        for idx, df in enumerate(dfs):
+            if col in df.columns:
+                dfs[idx] = df.assign(**{col: df[col].astype(dtype)})
+
+    return pd.concat(dfs, **kwargs)
+
+
+def list_files(directory: str, extension: str) -> list[str]:
+    """
+    List files in `directory` ending with `extension`.
+
+    Parameters
+    ----------
+    directory : str
+        Path to the directory to scan.
+    extension : str
+        File extension, including the leading dot.
+
+    Returns
+    -------
+    files_list : list of str
+        Full paths to the files.
+
+    """
+    return [
+        os.path.join(directory, filename)
+        for filename in os.listdir(directory)
+        if filename.endswith(extension)
+    ]
+
+
+def scan_directory(
+    directory: str,
+    extension: str = "",
+    count_rows: bool = False,
+    cache_dir: str | None = None,
+    cache: bool = False,
+) -> pd.DataFrame:
+    """
+    List files in `directory` with their size, modification time and number of rows.
+
+    The directory is scanned in a single pass with os.scandir(). If `cache` is True, a
+    manifest of the files is kept in `cache_dir` and updated at each scan, so that rows
+    are counted only once per file (on the first scan or when the file is modified).
+    Use it to decide what to read without opening the files, eg. to skip files without
+    rows.
+
+    Parameters
+    ----------
+    directory : str
+        Path to the directory to scan.
+    extension : str, optional
+        Keep only the files ending with `extension`. Default is "" (all files).
+    count_rows : bool, optional
+        Whether to count the rows of text tables, eg. the number of lines minus the
+        header. Otherwise, the number of rows is -1 unless it was already counted.
+        Default is False.
+    cache_dir : str or None, optional
+        Directory where the manifests are stored. If None (default), use
+        $HOME/.cuisto/cache.
+    cache : bool, optional
+        Whether to use and update the manifest. Default is False.
+
+    Returns
+    -------
+    manifest : pd.DataFrame
+        With columns "filename" (full path), "size", "mtime" (in ns) and "nrows", one
+        row per file, in the directory order.
+
+    """
+    # manifest has one entry per extension
+    manifests = {}
+    if cache:
+        manifest_file = get_cache_filename(directory, cache_dir, kind="manifest")
+        if os.path.isfile(manifest_file):
+            with open(manifest_file, "rb") as fid:
+                manifests = orjson.loads(fid.read())
+    previous = manifests.get(extension, {})
+
+    # current state of the files, from the directory entries
+    files = {}
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.name.endswith(extension) and entry.is_file():
+                st = entry.stat()
+                files[entry.name] = [st.st_size, st.st_mtime_ns, -1]
+
+    # re-use row counts of unchanged files
+    for name, state in files.items():
+        old = previous.get(name)
+        if (old is not None) and (old[:2] == state[:2]):
+            state[2] = old[2]
+        if count_rows and (state[2] < 0):
+            state[2] = max(count_lines(os.path.join(directory, name)) - 1, 0)
+
+    if cache and (files != previous):
+        manifests[extension] = files
+        tmp_file = f"{manifest_file}.{os.getpid()}.tmp"
+        with open(tmp_file, "wb") as fid:
+            fid.write(orjson.dumps(manifests))
+        os.replace(tmp_file, manifest_file)
+
+    return pd.DataFrame(
+        [[os.path.join(directory, name), *state] for name, state in files.items()],
+        columns=["filename", "size", "mtime", "nrows"],
+    )
+
+
+def read_files(
+    files_list: list[str], reader: Callable, n_jobs: int | None = None
+) -> list:
+    """
+    Read files concurrently in a pool of threads.
+
+    Parameters
+    ----------
+    files_list : list of str
+        Full paths to the files.
+    reader : callable
+        Function reading a file, taking its path as only argument.
+    n_jobs : int or None, optional
+        Number of threads. If None (default), use the Python default.
+
+    Returns
+    -------
+    data : list
+        Output of `reader` for each file, in the same order as `files_list`.
+
+    """
+    with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+        return list(executor.map(reader, files_list))
+
+
+def cat_csv_dir(
+    directory,
+    n_jobs: int | None = None,
+    cache: bool = False,
+    cache_dir: str | None = None,
+    **kwargs,
+) -> pd.DataFrame:
+    """
+    Scans a directory for csv files and concatenate them into a single DataFrame.
+
+    Files are read concurrently in a pool of threads. Use the `dtype` and `usecols`
+    keywords arguments to set an explicit schema and parse only the required columns,
+    for instance with `dtype=QUPATH_DTYPES` and `usecols=get_usecols(cfg, kind)`.
+    Categorical columns stay categorical after concatenation. Files without rows are
+    found from the directory manifest (see `scan_directory()`) and are not read.
+
+    Parameters
+    ----------
+    directory : str
+        Path to the directory to scan.
+    n_jobs : int or None, optional
+        Number of threads used to read files. If None (default), use the Python
+        default.
+    cache : bool, optional
+        Whether to read the files through the persistent cache, see `read_dir()`.
+        Default is False.
+    cache_dir : str or None, optional
+        Directory where the cache files are stored. If None (default), use
+        $HOME/.cuisto/cache.
+    **kwargs : passed to pandas.read_csv()
+
+    Returns
+    -------
+    df : pandas.DataFrame
+        All CSV files concatenated in a single DataFrame.
+
+    """
+    return read_dir(
+        directory,
+        ".csv",
+        partial(pd.read_csv, **kwargs),
+        n_jobs=n_jobs,
+        cache=cache,
+        cache_dir=cache_dir,
+        skip_empty=True,
+    )
+
+
+def read_fibers_json(filename: str) -> dict:
+    """
+    Read a json file with fibers coordinates into flat arrays.
+
+    Coordinates of all the points of all the paths are concatenated in flat float32
+    arrays, without building intermediate Python objects per point. Points of path
+    `i` are found between `offsets[i]` and `offsets[i + 1]`, `path_id` gives the index
+    of the path each point belongs to.
+
+    The json files must be generated with 'pipelineImportExport.groovy" or
+    'exportFibersAtlasCoordinates.groovy' from a QuPath project. The whole file is
+    loaded at once, see `iter_fibers_json()` to read very large files in chunks.
+
+    Parameters
+    ----------
+    filename : str
+        Full path to the json file.
+
+    Returns
+    -------
+    fibers : dict
+        "x", "y", "z" : float32 arrays with points coordinates,
+        "hemisphere" : pandas.Categorical with points hemisphere,
+        "offsets" : int64 array with paths start and end indices in points arrays,
+        "path_id" : int64 array with the path index of each point,
+        "object_id" : array of paths identifiers,
+        "properties" : dict {name: array} with other per-path properties (eg.
+        classification).
+
+    """
+    with open(filename, "rb") as fid:
+        paths = orjson.loads(fid.read())["paths"]
+
+    return paths_to_fibers(paths)
+
+
+def paths_to_fibers(paths: dict) -> dict:
+    """
+    Convert the parsed "paths" object of a fibers json file to flat arrays.
+
+    Parameters
+    ----------
+    paths : dict
+        {object_id: path}, with path a dict with "x", "y", "z" and "hemisphere" lists
+        and other per-path properties.
+
+    Returns
+    -------
+    fibers : dict
+        See `read_fibers_json()`.
+
+    """
+    values = paths.values()
+
+    # paths limits
+    lengths = np.fromiter((len(p["x"]) for p in values), dtype=np.int64)
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    npoints = offsets[-1]
+
+    # points data
+    fibers = {
+        axis: np.fromiter(
+            chain.from_iterable(p[axis] for p in values),
+            dtype=np.float32,
+            count=npoints,
+        )
+        for axis in ("x", "y", "z")
+    }
+    hemisphere = np.fromiter(
+        chain.from_iterable(p["hemisphere"] for p in values),
+        dtype="U5",
+        count=npoints,
+    )
+    fibers["hemisphere"] = pd.Categorical.from_codes(
+        np.select([hemisphere == "Left", hemisphere == "Right"], [0, 1], -1),
+        categories=["Left", "Right"],
+    )
+    fibers["offsets"] = offsets
+    fibers["path_id"] = np.repeat(np.arange(len(lengths)), lengths)
+    fibers["object_id"] = np.array(list(paths.keys()), dtype=object)
+
+    # paths data
+    keys = dict.fromkeys(k for p in values for k in p)  # ordered union of keys
+    fibers["properties"] = {
+        key: pd.Series([p.get(key) for p in values]).to_numpy()
+        for key in keys
+        if key not in ("x", "y", "z", "hemisphere")
+    }
+
+    return fibers
+
+
+def iter_fibers_json(
+    filename: str, chunk_size: int = 1_000_000, buffer_size: int = 2**24
+):
+    """
+    Read a json file with fibers coordinates by chunks of paths, with bounded memory.
+
+    The file is read `buffer_size` bytes at a time and the "paths" object is walked
+    incrementally : only the complete paths found in the buffer are parsed, then
+    grouped in chunks of at most `chunk_size` points (unless a single path is longer)
+    and converted to flat arrays as in `read_fibers_json()`. Peak memory thus depends
+    on `buffer_size` and `chunk_size` (about 100 bytes per point), not on the size of
+    the file.
+
+    Parameters
+    ----------
+    filename : str
+        Full path to the json file.
+    chunk_size : int, optional
+        Maximum number of points per chunk. Default is 1 million.
+    buffer_size : int, optional
+        Number of bytes read from the file at once. Default is 16MB.
+
+    Yields
+    ------
+    fibers : dict
+        Fibers data of consecutive paths, see `read_fibers_json()`. Offsets and path
+        indices are relative to the chunk.
+
+    """
+    paths = {}
+    npoints = 0
+    with open(filename, "rb") as fid:
+        for batch in _JsonReader(fid, buffer_size).iter_members("paths"):
+            for object_id, path in batch.items():
+                if paths and (npoints + len(path["x"]) > chunk_size):
+                    yield paths_to_fibers(paths)
+                    paths = {}
+                    npoints = 0
+                paths[object_id] = path
+                npoints += len(path["x"])
+    if paths:
+        yield paths_to_fibers(paths)
+
+
+class _JsonReader:
+    """
+    Minimal incremental reader of a json file, see `iter_fibers_json()`.
+
+    Only the structure needed to walk the members of a top-level object is parsed
+    here, values are parsed with orjson. The scan of the value being read is kept
+    between reads, so that each byte is scanned once even if the value spans several
+    blocks of the file.
+
+    """
+
+    # json insignificant whitespace
+    _not_whitespace = re.compile(rb"[^ \t\n\r]")
+    # end of a number or a literal
+    _scalar = re.compile(rb"[^,\]} \t\n\r]*")
+
+    def __init__(self, fid, buffer_size: int):
+        """Constructor."""
+        self.fid = fid
+        self.buffer_size = buffer_size
+        self.buffer = bytearray()
+        self.pos = 0
+        self._reset_scan()
+
+    def _reset_scan(self):
+        """Start a new scan at `pos`."""
+        self._scanned = 0  # number of bytes scanned after `pos`
+        self._depth = 0
+        self._in_string = False
+
+    def _scan_brackets(self) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Scan the bytes read since the last scan, see `_get_json_brackets()`.
+
+        Returns positions (relative to `pos`) and depth of the new brackets.
+
+        """
+        positions, depth, self._in_string = _get_json_brackets(
+            np.frombuffer(self.buffer, np.uint8),
+            self.pos + self._scanned,
+            self._in_string,
+        )
+        depth += self._depth
+        if len(depth) > 0:
+            self._depth = depth[-1]
+        self._scanned = len(self.buffer) - self.pos
+        return positions - self.pos, depth
+
+    def _fill(self):
+        """Read the next block of the file, dropping what was already consumed."""
+        data = self.fid.read(self.buffer_size)
+        if not data:
+            raise ValueError(f"Unexpected end of json file {self.fid.name}.")
+        # in place, so that a value spanning several blocks is not copied at each read
+        del self.buffer[: self.pos]
+        self.buffer += data
+        self.pos = 0
+
+    def peek(self) -> int:
+        """Skip whitespace and get the next character, without consuming it."""
+        while True:
+            match = self._not_whitespace.search(self.buffer, self.pos)
+            if match:
+                self.pos = match.start()
+                return self.buffer[self.pos]
+            self.pos = len(self.buffer)
+            self._fill()
+
+    def expect(self, char: bytes):
+        """Consume the next character, that must be `char`."""
+        if self.peek() != char[0]:
+            raise ValueError(
+                f"Invalid json file {self.fid.name}, expected '{char.decode()}'."
+            )
+        self.pos += 1
+
+    def read_value(self) -> bytes:
+        """Consume the next json value and get its raw bytes."""
+        first = self.peek()
+        self._reset_scan()
+        while (end := self._find_value_end(first)) is None:
+            self._fill()
+        value = self.buffer[self.pos : end]
+        self.pos = end
+        return value
+
+    def _find_value_end(self, first: int) -> int | None:
+        """Index after the value starting at `pos`, None if it is not complete."""
+        if first in b"{[":
+            positions, depth = self._scan_brackets()
+            ends = positions[depth == 0]
+            return self.pos + ends[0] + 1 if len(ends) > 0 else None
+        elif first == ord('"'):
+            end = self.pos + max(self._scanned - 1, 0)
+            while (end := self.buffer.find(b'"', end + 1)) != -1:
+                # quotes after an odd number of backslashes are escaped
+                start = end - 1
+                while self.buffer[start] == ord("\\"):
+                    start -= 1
+                if (end - 1 - start) % 2 == 0:
+                    return end + 1
+            self._scanned = len(self.buffer) - self.pos
+            return None
+        else:
+            end = self._scalar.match(self.buffer, self.pos).end()
+            return end if end < len(self.buffer) else None
+
+    def iter_members(self, key: str):
+        """
+        Iterate over the members of the object at `key` in the top-level object.
+
+        Members are parsed by batches : all the members that are complete in the
+        buffer are parsed at once. Their values must be objects or arrays.
+
+        Yields
+        ------
+        members : dict
+            {name: value} for consecutive members of the object.
+
+        """
+        self.expect(b"{")
+        while self.peek() != ord("}"):
+            name = orjson.loads(self.read_value())
+            self.expect(b":")
+            if name == key:
+                self.expect(b"{")
+                yield from self._iter_batches()
+                return
+            self.read_value()  # skip other top-level members
+            if self.peek() == ord(","):
+                self.pos += 1
+
+    def _iter_batches(self):
+        """Parse the members of the current object, see `iter_members()`."""
+        while True:
+            if self.peek() == ord(","):
+                self.pos += 1
+            self._reset_scan()
+            while True:
+                positions, depth = self._scan_brackets()
+                # end of the object, or end of the last complete member
+                closing = positions[depth == -1]
+                if len(closing) > 0:
+                    end = closing[0]
+                    break
+                elif (depth == 0).any():
+                    end = positions[depth == 0][-1] + 1
+                    break
+                self._fill()
+            members = orjson.loads(b"{" + self.buffer[self.pos : self.pos + end] + b"}")
+            if members:
+                yield members
+            if len(closing) > 0:
+                self.pos += end + 1
+                return
+            self.pos += end
+
+
+# depth change for each bracket of json text
+_JSON_DEPTH_STEPS = np.zeros(256, dtype=np.int8)
+_JSON_DEPTH_STEPS[[ord("{"), ord("[")]] = 1
+_JSON_DEPTH_STEPS[[ord("}"), ord("]")]] = -1
+
+
+def _get_json_brackets(
+    chars: np.ndarray, start: int = 0, in_string: bool = False
+) -> tuple[np.ndarray, np.ndarray, bool]:
+    """
+    Find the brackets of json text that are not in strings, and the nesting depth.
+
+    Only the positions of quotes and brackets are processed, so that the bulk of the
+    text (numbers, separators) is scanned only once. Text can be scanned in several
+    parts, passing the state at the end of the previous part.
+
+    Parameters
+    ----------
+    chars : np.ndarray
+        uint8 array with the bytes of the json text.
+    start : int, optional
+        Index where to start the scan. Default is 0.
+    in_string : bool, optional
+        Whether `start` is in a string. Default is False.
+
+    Returns
+    -------
+    positions : np.ndarray
+        Indices of the brackets in `chars`.
+    depth : np.ndarray
+        Nesting depth after each bracket, relative to `start`.
+    in_string : bool
+        Whether the end of `chars` is in a string.
+
+    """
+    part = chars[start:]
+    positions = (
+        np.flatnonzero(
+            (part == ord('"'))
+            | (part == ord("{"))
+            | (part == ord("}"))
+            | (part == ord("["))
+            | (part == ord("]"))
+        )
+        + start
+    )
+    structure = chars[positions]
+    quotes = structure == ord('"')
+    # quotes after an odd number of backslashes are escaped
+    for idx in np.flatnonzero(quotes & (chars[positions - 1] == ord("\\"))):
+        end = positions[idx]
+        start = end - 1
+        while start >= 0 and chars[start] == ord("\\"):
+            start -= 1
+        quotes[idx] = (end - 1 - start) % 2 == 0
+    strings = np.bitwise_xor.accumulate(quotes.view(np.uint8)).view(bool) ^ in_string
+    if len(strings) > 0:
+        in_string = bool(strings[-1])
+
+    brackets = ~(quotes | strings)
+    steps = _JSON_DEPTH_STEPS[structure[brackets]]
+
+    return positions[brackets], np.cumsum(steps, dtype=np.int16), in_string
+
+
+def fibers_to_dataframe(
+    fibers: dict,
+    image: str,
+    hemisphere_names: dict,
+    atlas: BrainGlobeAtlas,
+    xname: str = "Atlas_X",
+    yname: str = "Atlas_Y",
+    zname: str = "Atlas_Z",
+) -> pd.DataFrame:
+    """
+    Build a DataFrame with one entry per point from flat fibers arrays.
+
+    The DataFrame is built directly from the arrays : coordinates are float32, the
+    hemisphere and the classification are categorical, per-path properties are
+    broadcasted to their points.
+
+    Parameters
+    ----------
+    fibers : dict
+        Fibers data, as returned by `read_fibers_json()` or `FibersStore.get_fibers()`.
+    image : str
+        Image name.
+    hemisphere_names : dict
+        Maps between hemisphere names in the json files ("Right" and "Left") to
+        something else (eg. "Ipsi." and "Contra.").
+    atlas : BrainGlobeAtlas
+        Atlas to read regions from.
+    xname, yname, zname : str, optional
+        How to name x, y and z coordinates. Default is ABBA convention, eg. Atlas_X,
+        Atlas_Y and Atlas_Z, resp. corresponding to AP, DV, ML.
+
+    Returns
+    -------
+    df : pd.DataFrame
+        Points of all the paths.
+
+    """
+    path_id = fibers["path_id"]
+
+    # per-point data
+    data = {
+        xname: fibers["x"],
+        yname: fibers["y"],
+        zname: fibers["z"],
+        "hemisphere": fibers["hemisphere"].rename_categories(
+            [hemisphere_names.get(h, h) for h in fibers["hemisphere"].categories]
+        ),
+    }
+    # per-path data, broadcasted to points
+    for key, values in fibers["properties"].items():
+        if key == "classification":
+            key = "Classification"
+        if values.dtype == object:
+            values = pd.Categorical(values)
+        data[key] = values.take(path_id)
+
+    df = pd.DataFrame(
+        data,
+        index=pd.Index(fibers["object_id"].take(path_id), name="Object ID"),
+    )
+    df["Image"] = pd.Categorical.from_codes(
+        np.zeros(len(df), dtype=np.int8), categories=[image]
+    )
+    df["Object type"] = "Detection"
+
+    # add brain regions
+    df = utils.add_brain_region(
+        df, atlas, col="Parent", xname=xname, yname=yname, zname=zname
+    )
+
+    return df
+
+
+def read_json_file(
+    filename: str,
+    hemisphere_names: dict,
+    atlas: BrainGlobeAtlas,
+    xname: str = "Atlas_X",
+    yname: str = "Atlas_Y",
+    zname: str = "Atlas_Z",
+) -> pd.DataFrame:
+    """
+    Read a json file with fibers coordinates, with one entry per point.
+
+    Wraps `read_fibers_json()` and `fibers_to_dataframe()`. See `cat_json_dir()`.
+
+    Parameters
+    ----------
+    filename : str
+        Full path to the json file.
+    hemisphere_names : dict
+        Maps between hemisphere names in the json files ("Right" and "Left") to
+        something else (eg. "Ipsi." and "Contra.").
+    atlas : BrainGlobeAtlas
+        Atlas to read regions from.
+    xname, yname, zname : str, optional
+        How to name x, y and z coordinates. Default is ABBA convention, eg. Atlas_X,
+        Atlas_Y and Atlas_Z, resp. corresponding to AP, DV, ML.
+
+    Returns
+    -------
+    df : pd.DataFrame
+        Points of all the paths in the file.
+
+    """
+    return fibers_to_dataframe(
+        read_fibers_json(filename),
+        get_image_name(filename),
+        hemisphere_names,
+        atlas,
+        xname=xname,
+        yname=yname,
+        zname=zname,
+    )
+
+
+def get_image_name(filename: str) -> str:
+    """
+    Get the image name from a json detections file name.
+
+    Parameters
+    ----------
+    filename : str
+        Path to a file named "imagename_detections*.json".
+
+    Returns
+    -------
+    image : str
+        Image name.
+
+    """
+    return os.path.basename(filename).split("_detections")[0]
+
+
+class FibersStore:
+    """
+    Memory-mapped store of fibers points coordinates.
+
+    The store is a directory with flat binary files, one value per point : "x.bin",
+    "y.bin", "z.bin" (float32) and "hemisphere.bin" (int8 codes), along with
+    CSR-like indices : "path_offsets.npy" (points limits of each path) and
+    "image_offsets.npy" (paths limits of each image). Per-path properties, images
+    names and the list of source files are stored in the "metadata.json" sidecar.
+
+    Points arrays are memory-mapped, so data is read from disk only when it is
+    actually used, eg. one image or one chunk at a time.
+    Create a store with `write_fibers_store()`.
+
+    Parameters
+    ----------
+    store_dir : str
+        Path to the store directory.
+
+    """
+
+    def __init__(self, store_dir: str):
+        """Constructor."""
+        self.store_dir = store_dir
+        with open(os.path.join(store_dir, "metadata.json"), "rb") as fid:
+            self.metadata = orjson.loads(fid.read())
+
+        self.images = self.metadata["images"]
+        self.path_offsets = np.load(os.path.join(store_dir, "path_offsets.npy"))
+        self.image_offsets = np.load(os.path.join(store_dir, "image_offsets.npy"))
+        self.n_points = int(self.path_offsets[-1])
+        self.n_paths = len(self.path_offsets) - 1
+
+        # points data
+        self.points = {
+            name: np.memmap(
+                os.path.join(store_dir, f"{name}.bin"),
+                dtype=dtype,
+                mode="r",
+                shape=(self.n_points,),
+            )
+            if self.n_points > 0
+            else np.empty(0, dtype=dtype)
+            for name, dtype in FIBERS_STORE_DTYPES.items()
+        }
+
+        # paths data
+        self.object_id = np.array(self.metadata["object_id"], dtype=object)
+        self.properties = {
+            key: pd.Series(values).to_numpy()
+            for key, values in self.metadata["properties"].items()
+        }
+
+    def get_fibers(self, image: int | str) -> dict:
+        """
+        Get the fibers of one image, in the format of `read_fibers_json()`.
+
+        Points arrays are views on the memory-mapped files.
+
+        Parameters
+        ----------
+        image : int or str
+            Image index or name.
+
+        Returns
+        -------
+        fibers : dict
+            See `read_fibers_json()`.
+
+        """
+        if isinstance(image, str):
+            image = self.images.index(image)
+
+        paths = slice(self.image_offsets[image], self.image_offsets[image + 1])
+        offsets = self.path_offsets[paths.start : paths.stop + 1]
+        points = slice(offsets[0], offsets[-1])
+
+        fibers = {axis: self.points[axis][points] for axis in ("x", "y", "z")}
+        fibers["hemisphere"] = pd.Categorical.from_codes(
+            self.points["hemisphere"][points],
+            categories=self.metadata["hemispheres"],
+        )
+        fibers["offsets"] = offsets - offsets[0]
+        fibers["path_id"] = np.repeat(
+            np.arange(len(offsets) - 1), np.diff(fibers["offsets"])
+        )
+        fibers["object_id"] = self.object_id[paths]
+        fibers["properties"] = {
+            key: values[paths] for key, values in self.properties.items()
+        }
+
+        return fibers
+
+    def iter_chunks(self, chunk_size: int = 10_000_000):
+        """
+        Iterate over points by chunks of at most `chunk_size` points.
+
+        Chunks do not cross images nor paths boundaries, unless a single path is longer
+        than `chunk_size`.
+
+        Parameters
+        ----------
+        chunk_size : int, optional
+            Maximum number of points per chunk. Default is 10 millions.
+
+        Yields
+        ------
+        image : str
+            Image name.
+        points : dict
+            "x", "y", "z", "hemisphere" arrays and "path_id" (index of the path in the
+            store) for the points of the chunk.
+
+        """
+        for idx, image in enumerate(self.images):
+            first_path, last_path = self.image_offsets[idx : idx + 2]
+            while first_path < last_path:
+                start = self.path_offsets[first_path]
+                # last path whose end fits in the chunk
+                stop_path = (
+                    np.searchsorted(
+                        self.path_offsets[first_path + 1 : last_path + 1],
+                        start + chunk_size,
+                        side="right",
+                    )
+                    + first_path
+                )
+                stop_path = max(stop_path, first_path + 1)
+                stop = self.path_offsets[stop_path]
+                points = {
+                    name: values[start:stop] for name, values in self.points.items()
+                }
+                points["path_id"] = np.repeat(
+                    np.arange(first_path, stop_path),
+                    np.diff(self.path_offsets[first_path : stop_path + 1]),
+                )
+                yield image, points
+                first_path = stop_path
+
+    def to_dataframe(
+        self,
+        hemisphere_names: dict,
+        atlas: BrainGlobeAtlas,
+        xname: str = "Atlas_X",
+        yname: str = "Atlas_Y",
+        zname: str = "Atlas_Z",
+        images: list[str] | None = None,
+    ) -> pd.DataFrame:
+        """
+        Get the points of the store as a DataFrame, as `cat_json_dir()` would.
+
+        Parameters
+        ----------
+        hemisphere_names : dict
+            Maps between hemisphere names ("Right" and "Left") to something else.
+        atlas : BrainGlobeAtlas
+            Atlas to read regions from.
+        xname, yname, zname : str, optional
+            How to name x, y and z coordinates. Default is Atlas_X, Atlas_Y, Atlas_Z.
+        images : list of str or None, optional
+            Images to load. If None (default), all images are loaded.
+
+        Returns
+        -------
+        df : pd.DataFrame
+            Points of all the paths in the selected images.
+
+        """
+        if images is None:
+            images = self.images
+
+        return concat_dfs(
+            [
+                fibers_to_dataframe(
+                    self.get_fibers(image),
+                    image,
+                    hemisphere_names,
+                    atlas,
+                    xname=xname,
+                    yname=yname,
+                    zname=zname,
+                )
+                for image in images
+            ]
+        )
+
+
+def get_files_state(files_list: list[str] | pd.DataFrame) -> list[list]:
+    """
+    Get name, size and modification time of files.
+
+    Parameters
+    ----------
+    files_list : list of str or pd.DataFrame
+        Full paths to the files, or a manifest as returned by `scan_directory()`, in
+        which case the files are not stat'ed again.
+
+    Returns
+    -------
+    state : list
+        [file name, size, modification time in ns] for each file.
+
+    """
+    if isinstance(files_list, pd.DataFrame):
+        return [
+            [os.path.basename(row.filename), int(row.size), int(row.mtime)]
+            for row in files_list.itertuples()
+        ]
+
+    state = []
+    for filename in files_list:
+        st = os.stat(filename)
+        state.append([os.path.basename(filename), st.st_size, st.st_mtime_ns])
+    return state
+
+
+def write_fibers_store(
+    directory: str,
+    store_dir: str | None = None,
+    chunk_size: int = 1_000_000,
+    manifest: pd.DataFrame | None = None,
+    cache_dir: str | None = None,
+) -> str:
+    """
+    Convert the json files of a directory to a `FibersStore`.
+
+    Files are parsed incrementally and converted by chunks of paths (see
+    `iter_fibers_json()`), so that memory usage does not depend on the size of the
+    files. If the store exists and its source files did not change, nothing is done.
+
+    Parameters
+    ----------
+    directory : str
+        Path to the directory with the json files.
+    store_dir : str or None, optional
+        Path to the store directory. If None (default), it is in `cache_dir`, see
+        `get_cache_filename()`.
+    chunk_size : int, optional
+        Maximum number of points converted at once. Default is 1 million.
+    manifest : pd.DataFrame or None, optional
+        Json files of `directory`, as returned by `scan_directory()`. If None
+        (default), the directory is scanned.
+    cache_dir : str or None, optional
+        Directory where the store is created when `store_dir` is None. If None
+        (default), use $HOME/.cuisto/cache.
+
+    Returns
+    -------
+    store_dir : str
+        Path to the store directory.
+
+    """
+    if not store_dir:
+        store_dir = get_cache_filename(directory, cache_dir, kind="fibers")
+    if manifest is None:
+        manifest = scan_directory(directory, ".json")
+    manifest = manifest.sort_values("filename")
+    files_list = manifest["filename"].tolist()
+    sources = get_files_state(manifest)
+
+    # check if the store is up-to-date
+    metadata_file = os.path.join(store_dir, "metadata.json")
+    if os.path.isfile(metadata_file):
+        with open(metadata_file, "rb") as fid:
+            if orjson.loads(fid.read())["sources"] == sources:
+                return store_dir
+        os.remove(metadata_file)  # invalidate the store while rewriting it
+    os.makedirs(store_dir, exist_ok=True)
+
+    path_offsets = [np.zeros(1, dtype=np.int64)]
+    image_offsets = [0]
+    object_id = []
+    properties = {}
+    images = []
+    with ExitStack() as stack:
+        fids = {
+            name: stack.enter_context(
+                open(os.path.join(store_dir, f"{name}.bin"), "wb")
+            )
+            for name in FIBERS_STORE_DTYPES
+        }
+        for filename in files_list:
+            for fibers in iter_fibers_json(filename, chunk_size=chunk_size):
+                npaths = len(fibers["offsets"]) - 1
+
+                # append points
+                for axis in ("x", "y", "z"):
+                    fids[axis].write(fibers[axis].tobytes())
+                fids["hemisphere"].write(
+                    fibers["hemisphere"].codes.astype(np.int8).tobytes()
+                )
+
+                # append paths
+                path_offsets.append(fibers["offsets"][1:] + path_offsets[-1][-1])
+                object_id.extend(fibers["object_id"].tolist())
+                for key in properties.keys() | fibers["properties"].keys():
+                    values = properties.setdefault(
+                        key, [None] * (len(object_id) - npaths)
+                    )
+                    if key in fibers["properties"]:
+                        values.extend(fibers["properties"][key].tolist())
+                    else:
+                        values.extend([None] * npaths)
+            image_offsets.append(len(object_id))
+            images.append(get_image_name(filename))
+
+    np.save(os.path.join(store_dir, "path_offsets.npy"), np.concatenate(path_offsets))
+    np.save(
+        os.path.join(store_dir, "image_offsets.npy"),
+        np.array(image_offsets, dtype=np.int64),
+    )
+    metadata = dict(
+        version=1,
+        images=images,
+        hemispheres=["Left", "Right"],
+        object_id=object_id,
+        properties=properties,
+        sources=sources,
+    )
+    with open(metadata_file, "wb") as fid:
+        fid.write(orjson.dumps(metadata, option=orjson.OPT_SERIALIZE_NUMPY))
+
+    return store_dir
+
+
+def cat_json_dir(
+    directory: str,
+    hemisphere_names: dict,
+    atlas: BrainGlobeAtlas,
+    xname: str = "Atlas_X",
+    yname: str = "Atlas_Y",
+    zname: str = "Atlas_Z",
+    cache: bool = False,
+    cache_dir: str | None = None,
+    store: bool | str = False,
+) -> pd.DataFrame | FibersStore:
+    """
+    Scans a directory for json files and concatenate them in a single DataFrame.
+
+    The json files must be generated with 'pipelineImportExport.groovy" or
+    'exportFibersAtlasCoordinates.groovy' from a QuPath project.
+
+    With `store`, the json files are converted to a memory-mapped `FibersStore`, that
+    is re-used as long as the json files do not change, and the store is returned
+    instead : points are only read when they are used, see `FibersStore.get_fibers()`,
+    `FibersStore.iter_chunks()` and `FibersStore.to_dataframe()`.
+
+    Parameters
+    ----------
+    directory : str
+        Path to the directory to scan.
+    hemisphere_names : dict
+        Maps between hemisphere names in the json files ("Right" and "Left") to
+        something else (eg. "Ipsi." and "Contra.").
+    atlas : BrainGlobeAtlas
+        Atlas to read regions from.
+    xname, yname, zname : str, optional
+        How to name x, y and z coordinates. Default is ABBA convention, eg. Atlas_X,
+        Atlas_Y and Atlas_Z, resp. corresponding to AP, DV, ML.
+    cache : bool, optional
+        Whether to read the files through the persistent cache, see `read_dir()`.
+        Default is False.
+    cache_dir : str or None, optional
+        Directory where the cache files are stored. If None (default), use
+        $HOME/.cuisto/cache.
+    store : bool or str, optional
+        Whether to return a `FibersStore`. If a str, it is the path to the store
+        directory, otherwise it is in `cache_dir`. Default is False.
+
+    Returns
+    -------
+    df : pd.DataFrame or FibersStore
+        All JSON files concatenated in a single DataFrame, or the store.
+
+    """
+    if store:
+        return FibersStore(
+            write_fibers_store(
+                directory,
+                store_dir=store if isinstance(store, str) else None,
+                manifest=scan_directory(
+                    directory, ".json", cache_dir=cache_dir, cache=cache
+                ),
+                cache_dir=cache_dir,
+            )
+        )
+
+    return read_dir(
+        directory,
+        ".json",
+        partial(
+            read_json_file,
+            hemisphere_names=hemisphere_names,
+            atlas=atlas,
+            xname=xname,
+            yname=yname,
+            zname=zname,
+        ),
+        n_jobs=1,
+        cache=cache,
+        cache_dir=cache_dir,
+    )
+
+
+def get_cache_filename(
+    directory: str, cache_dir: str | None = None, kind: str = "measurements"
+) -> str:
+    """
+    Get the cache file corresponding to a measurements directory.
+
+    Parameters
+    ----------
+    directory : str
+        Path to the measurements directory.
+    cache_dir : str or None, optional
+        Directory where cache files are stored. If None (default), use
+        $HOME/.cuisto/cache.
+    kind : {"measurements", "manifest", "fibers"}, optional
+        "measurements" for the HDF5 cache of the files content (default), "manifest"
+        for the json manifest of the files, see `scan_directory()`, "fibers" for the
+        `FibersStore` directory, see `write_fibers_store()`.
+
+    Returns
+    -------
+    cache_file : str
+        Full path to the cache file.
+
+    """
+    if not cache_dir:
+        cache_dir = os.path.join(os.path.expanduser("~"), ".cuisto", "cache")
+    os.makedirs(cache_dir, exist_ok=True)
+    dirhash = hashlib.md5(os.path.abspath(directory).encode()).hexdigest()
+
+    if kind == "measurements":
+        return os.path.join(cache_dir, f"measurements_{dirhash}.h5")
+    elif kind == "manifest":
+        return os.path.join(cache_dir, f"manifest_{dirhash}.json")
+    elif kind == "fibers":
+        return os.path.join(cache_dir, f"fibers_{dirhash}")
+    else:
+        raise ValueError(
+            f"kind = '{kind}' not supported. "
+            "Choose 'measurements', 'manifest' or 'fibers'."
+        )
+
+
+def get_signature(**kwargs) -> str:
+    """
+    Get a hash identifying reading parameters.
+
+    Used to invalidate cached data when the way files are read changes. Callables are
+    identified by their qualified name, along with their arguments for
+    functools.partial and the object they are bound to for methods. Atlases are
+    identified by their name.
+
+    Parameters
+    ----------
+    **kwargs : reading parameters.
+
+    Returns
+    -------
+    signature : str
+        Hexadecimal hash. Raises a TypeError if a callable can't be identified by its
+        name, such as lambdas and local functions, as their state would not be part of
+        the signature.
+
+    """
+
+    def default(obj):
+        if isinstance(obj, partial):
+            return [default(obj.func), obj.args, obj.keywords]
+        elif isinstance(obj, (set, frozenset)):
+            return sorted(obj)
+        elif isinstance(obj, BrainGlobeAtlas):
+            return obj.atlas_name
+        elif callable(obj):
+            name = f"{getattr(obj, '__module__', '')}.{obj.__qualname__}"
+            if "<" in obj.__qualname__:
+                raise TypeError(f"{name} can't be identified in a signature.")
+            bound_to = getattr(obj, "__self__", None)
+            if bound_to is None or inspect.ismodule(bound_to):
+                return name
+            return [name, bound_to]
+        else:
+            return repr(obj)
+
+    return hashlib.md5(
+        orjson.dumps(kwargs, default=default, option=orjson.OPT_SORT_KEYS)
+    ).hexdigest()
+
+
+def read_files_cached(
+    files_list: list[str],
+    reader: Callable,
+    cache_file: str,
+    signature: str,
+    n_jobs: int | None = None,
+    manifest: pd.DataFrame | None = None,
+) -> list:
+    """
+    Read files through a HDF5 cache.
+
+    Each file is stored as a table in `cache_file`, along with a manifest of file
+    names, sizes and modification times. Files that did not change since they were
+    cached are loaded from the cache, the others are read with `reader` and the cache
+    is updated. If `signature` differs from the one of the cache, the cache is reset.
+
+    Parameters
+    ----------
+    files_list : list of str
+        Full paths to the files.
+    reader : callable
+        Function reading a file, taking its path as only argument and returning a
+        DataFrame or None.
+    cache_file : str
+        Full path to the HDF5 cache file.
+    signature : str
+        Identifies `reader` and its parameters, see `get_signature()`.
+    n_jobs : int or None, optional
+        Number of threads used to read files that are not cached. Default is None.
+    manifest : pd.DataFrame or None, optional
+        Sizes and modification times of the files, in the same order as `files_list`,
+        as returned by `scan_directory()`. If None (default), files are stat'ed.
+
+    Returns
+    -------
+    data : list
+        Output of `reader` for each file, in the same order as `files_list`.
+
+    """
+    # current state of the files
+    if manifest is None:
+        stats = [os.stat(filename) for filename in files_list]
+        sizes = [st.st_size for st in stats]
+        mtimes = [st.st_mtime_ns for st in stats]
+    else:
+        sizes = manifest["size"].tolist()
+        mtimes = manifest["mtime"].tolist()
+    manifest = pd.DataFrame(
+        {
+            "filename": files_list,
+            "size": sizes,
+            "mtime": mtimes,
+            "key": ["f_" + hashlib.md5(f.encode()).hexdigest() for f in files_list],
+        }
+    )
+
+    with pd.HDFStore(cache_file, mode="a") as store:
+        # get what's in the cache
+        existing = set(store.keys())
+        if ("/manifest" in existing) and (
+            store.get_storer("manifest").attrs.signature == signature
+        ):
+            cached = store["manifest"]
+        else:
+            # nothing or different parameters : reset the cache
+            for key in existing:
+                store.remove(key)
+            existing = set()
+            cached = pd.DataFrame(columns=[*manifest.columns, "empty"])
+
+        # up-to-date files
+        merged = manifest.merge(cached, how="left", on="filename", suffixes=("", "_c"))
+        uptodate = (
+            (merged["size"] == merged["size_c"])
+            & (merged["mtime"] == merged["mtime_c"])
+        ).to_numpy()
+        manifest["empty"] = merged["empty"].where(uptodate, False).astype(bool)
+
+        # read new or modified files
+        to_read = manifest.loc[~uptodate, "filename"].tolist()
+        fresh = dict(zip(to_read, read_files(to_read, reader, n_jobs)))
+
+        # remove stale entries
+        current_keys = set(manifest["key"])
+        for key in cached["key"]:
+            if key not in current_keys and f"/{key}" in existing:
+                store.remove(key)
+
+        # collect data and update the cache
+        data = []
+        for row in manifest.itertuples():
+            if row.filename in fresh:
+                df = fresh[row.filename]
+                if f"/{row.key}" in existing:
+                    store.remove(row.key)
+                if df is None:
+                    manifest.loc[row.Index, "empty"] = True
+                else:
+                    store.put(row.key, df, format="table")
+            elif row.empty:
+                df = None
+            else:
+                df = store[row.key]
+            data.append(df)
 
-JSON_KW = ["fibers", "axons", "fiber", "axon"]
-CSV_KW = ["synapto", "synaptophysin", "syngfp", "boutons", "points"] + [
-    "cells",
-    "polygon",
-    "polygons",
-    "polygon",
-    "cell",
-]
+        store.put("manifest", manifest, format="table")
+        store.get_storer("manifest").attrs.signature = signature
 
+    return data
 
-def get_measurements_directory(wdir, animal: str, kind: str, segtype: str) -> str:
+
+def get_data_hash(*data) -> str:
     """
-    Get the directory with detections or annotations measurements for given animal ID.
+    Get a hash identifying the content of DataFrames.
+
+    Column names, data types, index and values are taken into account.
 
     Parameters
     ----------
-    wdir : str
-        Base working directory.
-    animal : str
-        Animal ID.
-    kind : str
-        "annotation" or "detection".
-    segtype : str
-        Type of segmentation, eg. "synaptophysin".
+    *data : pandas.DataFrame or pandas.Series
 
     Returns
     -------
-    directory : str
-        Path to detections or annotations directory.
+    data_hash : str
+        Hexadecimal hash.
 
     """
-    bdir = os.path.join(wdir, animal, animal.lower() + "_segmentation", segtype)
-
-    if (kind == "detection") or (kind == "detections"):
-        return os.path.join(bdir, "detections")
-    elif (kind == "annotation") or (kind == "annotations"):
-        return os.path.join(bdir, "annotations")
-    else:
-        raise ValueError(
-            f"kind = '{kind}' not supported. Choose 'detection' or 'annotation'."
-        )
+    hasher = hashlib.md5()
+    for df in data:
+        if isinstance(df, pd.Series):
+            df = df.to_frame()
+        hasher.update(orjson.dumps([str(col) for col in df.columns]))
+        hasher.update(orjson.dumps([str(dtype) for dtype in df.dtypes]))
+        hasher.update(pd.util.hash_pandas_object(df, index=True).to_numpy().tobytes())
+    return hasher.hexdigest()
 
 
-def check_empty_file(filename: str, threshold: int = 1) -> bool:
+class StageResult:
     """
-    Checks if a file is empty.
+    Lazy output of a stage of a `StageCache`.
 
-    Empty is defined as a file whose number of lines is lower than or equal to
-    `threshold` (to allow for headers).
+    The output is computed (or loaded from the cache) only when `get()` is first
+    called, so that the inputs of a stage whose output is cached are never loaded.
 
     Parameters
     ----------
-    filename : str
-        Full path to the file to check.
-    threshold : int, optional
-        If number of lines is lower than or equal to this value, it is considered as
-        empty. Default is 1.
-
-    Returns
-    -------
-    empty : bool
-        True if the file is empty as defined above.
+    key : str
+        Identifies the output.
+    getter : callable
+        Gets the output, without arguments.
 
     """
-    with open(filename, "rb") as fid:
-        nlines = sum(1 for _ in fid)
 
-    if nlines <= threshold:
-        return True
-    else:
-        return False
+    def __init__(self, key: str, getter: Callable):
+        """Constructor."""
+        self.key = key
+        self._getter = getter
+        self._output = None
+        self._done = False
 
+    def get(self):
+        """Get the output."""
+        if not self._done:
+            self._output = self._getter()
+            self._getter = None
+            self._done = True
+        return self._output
 
-def cat_csv_dir(directory, **kwargs) -> pd.DataFrame:
+
+class StageCache:
     """
-    Scans a directory for csv files and concatenate them into a single DataFrame.
+    On-disk memoization of processing stages, with a least recently used policy.
+
+    The output of a stage is stored in a file named after a key combining the stage
+    name, the keys of its inputs and the parameters it depends on. Data entering the
+    pipeline is identified by its content hash, see `get_data_hash()`. A stage is
+    computed only if its key was never seen, so that changing a parameter only
+    re-computes the stages that depend on it and their downstream stages. When the
+    total size of the cache exceeds `max_size`, the least recently used outputs are
+    removed.
 
     Parameters
     ----------
-    directory : str
-        Path to the directory to scan.
-    **kwargs : passed to pandas.read_csv()
-
-    Returns
-    -------
-    df : pandas.DataFrame
-        All CSV files concatenated in a single DataFrame.
+    cache_dir : str or None, optional
+        Directory where outputs are stored. If None (default), use
+        $HOME/.cuisto/stages.
+    max_size : int, optional
+        Maximum size of the cache, in bytes. Default is 2GB.
 
     """
-    return pd.concat(
-        pd.read_csv(
-            os.path.join(directory, filename),
-            **kwargs,
+
+    def __init__(self, cache_dir: str | None = None, max_size: int = 2 * 1024**3):
+        """Constructor."""
+        if not cache_dir:
+            cache_dir = os.path.join(os.path.expanduser("~"), ".cuisto", "stages")
+        self.cache_dir = str(cache_dir)
+        self.max_size = max_size
+
+    def __repr__(self) -> str:
+        return f"StageCache({self.cache_dir!r}, max_size={self.max_size})"
+
+    def data(self, *data) -> StageResult:
+        """
+        Wrap input data, identified by its content.
+
+        Parameters
+        ----------
+        *data : pandas.DataFrame or pandas.Series
+
+        Returns
+        -------
+        result : StageResult
+            Returns `data` (or its only element).
+
+        """
+        output = data[0] if len(data) == 1 else data
+        return StageResult(get_data_hash(*data), lambda: output)
+
+    def stage(
+        self,
+        name: str,
+        params: dict,
+        func: Callable,
+        *inputs: StageResult,
+        **kwargs,
+    ) -> StageResult:
+        """
+        Declare a stage.
+
+        Parameters
+        ----------
+        name : str
+            Name of the stage.
+        params : dict
+            Everything the output depends on besides `inputs`, eg. the configuration
+            keys used by `func`. See `get_signature()`.
+        func : callable
+            Computes the stage, called as `func(*inputs_outputs, **kwargs)`.
+        *inputs : StageResult
+            Inputs of the stage.
+        **kwargs : passed to `func`. They are not part of the key, they should be
+            accounted for in `params`.
+
+        Returns
+        -------
+        result : StageResult
+            Output of the stage, computed or loaded when needed.
+
+        """
+        key = f"{name}_" + get_signature(
+            inputs=[result.key for result in inputs], params=params
         )
-        for filename in os.listdir(directory)
-        if (filename.endswith(".csv"))
-        and not check_empty_file(os.path.join(directory, filename), threshold=1)
-    )
+        filename = os.path.join(self.cache_dir, f"{key}.pkl")
+
+        def getter():
+            try:
+                output = pd.read_pickle(filename)
+            except (OSError, EOFError, pickle.UnpicklingError):
+                pass
+            else:
+                os.utime(filename)  # mark as recently used
+                return output
 
+            output = func(*(result.get() for result in inputs), **kwargs)
+            os.makedirs(self.cache_dir, exist_ok=True)
+            tmp_file = f"{filename}.{os.getpid()}.tmp"
+            pd.to_pickle(output, tmp_file)
+            os.replace(tmp_file, filename)
+            self.evict()
+            return output
 
-def cat_json_dir(
+        return StageResult(key, getter)
+
+    def evict(self):
+        """Remove the least recently used outputs until the cache fits in max_size."""
+        files = []
+        with os.scandir(self.cache_dir) as entries:
+            for entry in entries:
+                if entry.name.endswith(".pkl"):
+                    st = entry.stat()
+                    files.append((st.st_mtime_ns, st.st_size, entry.path))
+        total_size = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total_size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total_size -= size
+
+    def clear(self):
+        """Remove all stored outputs."""
+        if os.path.isdir(self.cache_dir):
+            for filename in list_files(self.cache_dir, ".pkl"):
+                os.remove(filename)
+
+
+def read_dir(
     directory: str,
-    hemisphere_names: dict,
-    atlas: BrainGlobeAtlas,
-    xname: str = "Atlas_X",
-    yname: str = "Atlas_Y",
-    zname: str = "Atlas_Z",
+    extension: str,
+    reader: Callable,
+    n_jobs: int | None = None,
+    cache: bool = False,
+    cache_dir: str | None = None,
+    skip_empty: bool = False,
 ) -> pd.DataFrame:
     """
-    Scans a directory for json files and concatenate them in a single DataFrame.
+    Read all files with `extension` in `directory` and concatenate them.
 
-    The json files must be generated with 'pipelineImportExport.groovy" or
-    'exportFibersAtlasCoordinates.groovy' from a QuPath project.
+    Files are listed with `scan_directory()`, that keeps a manifest of their sizes,
+    modification times and number of rows. If `cache` is True, the files are read
+    through a persistent HDF5 cache (see `read_files_cached()`) : only files that were
+    added or modified since the last call are actually parsed, the others are loaded
+    from the cache.
 
     Parameters
     ----------
     directory : str
         Path to the directory to scan.
-    hemisphere_names : dict
-        Maps between hemisphere names in the json files ("Right" and "Left") to
-        something else (eg. "Ipsi." and "Contra.").
-    atlas : BrainGlobeAtlas
-        Atlas to read regions from.
-    xname, yname, zname : str, optional
-        How to name x, y and z coordinates. Default is ABBA convention, eg. Atlas_X,
-        Atlas_Y and Atlas_Z, resp. corresponding to AP, DV, ML.
+    extension : str
+        File extension, including the leading dot.
+    reader : callable
+        Function reading a file, taking its path as only argument and returning a
+        DataFrame or None.
+    n_jobs : int or None, optional
+        Number of threads used to read files. Default is None.
+    cache : bool, optional
+        Whether to use the cache. Default is False.
+    cache_dir : str or None, optional
+        Directory where the cache files and the manifest are stored. If None (default),
+        use $HOME/.cuisto/cache.
+    skip_empty : bool, optional
+        If True, rows are counted in the manifest and files without rows (eg. with
+        only a header) are not opened again. Default is False.
 
     Returns
     -------
     df : pd.DataFrame
-        All JSON files concatenated in a single DataFrame.
+        All files concatenated in a single DataFrame.
 
     """
-    # list files
-    files_list = [
-        os.path.join(directory, filename)
-        for filename in os.listdir(directory)
-        if (filename.endswith(".json"))
-    ]
-
-    data = []  # prepare list of DataFrame
-    for filename in files_list:
-        with open(filename, "rb") as fid:
-            df = pd.DataFrame.from_dict(
-                orjson.loads(fid.read())["paths"], orient="index"
-            )
-            df["Image"] = os.path.basename(filename).split("_detections")[0]
-            data.append(df)
-
-    df = (
-        pd.concat(data)
-        .explode(
-            ["x", "y", "z", "hemisphere"]
-        )  # get an entry for each point of segments
-        .reset_index()
-        .rename(
-            columns=dict(
-                x=xname,
-                y=yname,
-                z=zname,
-                index="Object ID",
-                classification="Classification",
-            )
+    manifest = scan_directory(directory, extension, skip_empty, cache_dir, cache)
+    if skip_empty:
+        manifest = manifest[manifest["nrows"] != 0]
+    files_list = manifest["filename"].tolist()
+    if cache:
+        dfs = read_files_cached(
+            files_list,
+            reader,
+            get_cache_filename(directory, cache_dir),
+            get_signature(reader=reader),
+            n_jobs=n_jobs,
+            manifest=manifest,
         )
-        .set_index("Object ID")
-    )
-
-    # change hemisphere names
-    df["hemisphere"] = df["hemisphere"].map(hemisphere_names)
-
-    # add object type
-    df["Object type"] = "Detection"
-
-    # add brain regions
-    df = utils.add_brain_region(
-        df, atlas, col="Parent", xname=xname, yname=yname, zname=zname
-    )
+    else:
+        dfs = read_files(files_list, reader, n_jobs=n_jobs)
 
-    return df
+    return concat_dfs([df for df in dfs if df is not None])
 
 
-def cat_data_dir(directory: str, segtype: str, **kwargs) -> pd.DataFrame:
+def cat_data_dir(directory: str, segtype: str, **kwargs) -> pd.DataFrame | FibersStore:
     """
     Wraps either cat_csv_dir() or cat_json_dir() depending on `segtype`.
 
@@ -206,17 +1872,23 @@ def cat_data_dir(directory: str, segtype: str, **kwargs) -> pd.DataFrame:
 
     Returns
     -------
-    df : pd.DataFrame
-        All files concatenated in a single DataFrame.
+    df : pd.DataFrame or FibersStore
+        All files concatenated in a single DataFrame, or the `FibersStore` of json
+        files with `store`.
 
     """
     if segtype in CSV_KW:
         # remove kwargs for json
         kwargs.pop("hemisphere_names", None)
         kwargs.pop("atlas", None)
+        kwargs.pop("store", None)
         return cat_csv_dir(directory, **kwargs)
     elif segtype in JSON_KW:
-        kwargs = {k: kwargs[k] for k in ["hemisphere_names", "atlas"] if k in kwargs}
+        kwargs = {
+            k: kwargs[k]
+            for k in ["hemisphere_names", "atlas", "cache", "cache_dir", "store"]
+            if k in kwargs
+        }
         return cat_json_dir(directory, **kwargs)
     else:
         raise ValueError(
@@ -224,34 +1896,554 @@ def cat_data_dir(directory: str, segtype: str, **kwargs) -> pd.DataFrame:
         )
 
 
+def iter_data_dir(directory: str, segtype: str, **kwargs):
+    """
+    Iterate over the files of a directory, one DataFrame at a time.
+
+    This is the streaming counterpart of `cat_data_dir()` : only one file (or one image
+    of the `FibersStore`, with `store`) is loaded in memory at once. Empty files are
+    skipped. With `chunk_size`, json files are parsed incrementally and yielded by
+    chunks of at most `chunk_size` points, see `iter_fibers_json()`.
+
+    Parameters
+    ----------
+    directory : str
+        Path to the directory to scan.
+    segtype : str
+        "synaptophysin" or "fibers".
+    **kwargs : passed to pandas.read_csv() or read_json_file(), see `cat_data_dir()`.
+
+    Yields
+    ------
+    df : pd.DataFrame
+        Content of one file.
+
+    """
+    # persistent cache works on the full directory
+    cache = kwargs.pop("cache", False)
+    cache_dir = kwargs.pop("cache_dir", None)
+    kwargs.pop("n_jobs", None)
+    if segtype in CSV_KW:
+        kwargs.pop("hemisphere_names", None)
+        kwargs.pop("atlas", None)
+        kwargs.pop("store", None)
+        kwargs.pop("chunk_size", None)
+        manifest = scan_directory(directory, ".csv", True, cache_dir, cache)
+        for filename in manifest.loc[manifest["nrows"] != 0, "filename"]:
+            yield pd.read_csv(filename, **kwargs)
+    elif segtype in JSON_KW:
+        kwargs = {
+            k: kwargs[k]
+            for k in [
+                "hemisphere_names",
+                "atlas",
+                "xname",
+                "yname",
+                "zname",
+                "store",
+                "chunk_size",
+            ]
+            if k in kwargs
+        }
+        store = kwargs.pop("store", False)
+        chunk_size = kwargs.pop("chunk_size", None)
+        manifest = scan_directory(directory, ".json", cache_dir=cache_dir, cache=cache)
+        if store:
+            fibers_store = FibersStore(
+                write_fibers_store(
+                    directory,
+                    store_dir=store if isinstance(store, str) else None,
+                    manifest=manifest,
+                    cache_dir=cache_dir,
+                )
+            )
+            for image in fibers_store.images:
+                yield fibers_store.to_dataframe(**kwargs, images=[image])
+        elif chunk_size:
+            # parse files incrementally, chunks of whole paths
+            for filename in manifest["filename"]:
+                for fibers in iter_fibers_json(filename, chunk_size=chunk_size):
+                    yield fibers_to_dataframe(
+                        fibers, get_image_name(filename), **kwargs
+                    )
+        else:
+            for filename in manifest["filename"]:
+                yield read_json_file(filename, **kwargs)
+    else:
+        raise ValueError(
+            f"'{segtype}' not supported, unable to determine if CSV or JSON."
+        )
+
+
+def save_density_volumes(filename: str, volumes: dict, voxel_size: list[float]):
+    """
+    Save density volumes in a compressed, sparse, npz file.
+
+    Only non-zero voxels are stored, as linear indices and values.
+
+    Parameters
+    ----------
+    filename : str
+        Full path to the output file, with the .npz extension.
+    volumes : dict
+        {name: volume}, eg. from `process.get_density_volumes()`. All volumes must have
+        the same shape.
+    voxel_size : list of float
+        Size of the voxels, in microns, along each axis.
+
+    """
+    names = list(volumes.keys())
+    arrays = {
+        "names": np.array(names, dtype=str),
+        "shape": np.array(volumes[names[0]].shape if names else (0, 0, 0)),
+        "voxel_size": np.asarray(voxel_size, dtype=float),
+    }
+    for idx, name in enumerate(names):
+        flat = np.ravel(volumes[name])
+        nonzero = np.flatnonzero(flat)
+        arrays[f"indices_{idx}"] = nonzero
+        arrays[f"values_{idx}"] = flat[nonzero]
+
+    np.savez_compressed(filename, **arrays)
+
+
+def load_density_volumes(filename: str) -> tuple[dict, np.ndarray]:
+    """
+    Load density volumes saved with `save_density_volumes()`.
+
+    Parameters
+    ----------
+    filename : str
+        Full path to the npz file.
+
+    Returns
+    -------
+    volumes : dict
+        {name: volume}, dense volumes.
+    voxel_size : np.ndarray
+        Size of the voxels, in microns, along each axis.
+
+    """
+    with np.load(filename) as data:
+        shape = tuple(data["shape"])
+        volumes = {}
+        for idx, name in enumerate(data["names"].tolist()):
+            values = data[f"values_{idx}"]
+            volume = np.zeros(np.prod(shape), dtype=values.dtype)
+            volume[data[f"indices_{idx}"]] = values
+            volumes[name] = volume.reshape(shape)
+        voxel_size = data["voxel_size"]
+
+    return volumes, voxel_size
+
+
+class ResultsStore:
+    """
+    Store of the results of a cohort, as a Parquet dataset.
+
+    Each DataFrame (eg. "df_regions", "df_coordinates") is a table, stored in a
+    directory with one Parquet file per animal : "{store_dir}/{table}/{animal}.parquet".
+    Columns types, including categorical, are preserved. Results are added animal by
+    animal : storing an animal that is already in a table replaces its file, so the
+    store can be updated as animals are added to the cohort. Files are written to a
+    temporary file first, then renamed, so an interrupted write never leaves a
+    partial file.
+
+    Tables can be loaded partially : `select()` reads only the requested columns, and
+    filters are applied while reading, skipping the files (and row groups) that can't
+    match, so that a slice of a large table is loaded without reading all of it.
+
+    Parameters
+    ----------
+    store_dir : str
+        Path to the store directory, created when results are first stored.
+    compression : str, optional
+        Parquet compression codec. Default is "zstd".
+
+    """
+
+    def __init__(self, store_dir: str, compression: str = "zstd"):
+        """Constructor."""
+        self.store_dir = str(store_dir)
+        self.compression = compression
+
+    def __repr__(self) -> str:
+        return f"ResultsStore({self.store_dir!r})"
+
+    @property
+    def tables(self) -> list[str]:
+        """Names of the stored tables."""
+        if not os.path.isdir(self.store_dir):
+            return []
+        with os.scandir(self.store_dir) as entries:
+            return sorted(entry.name for entry in entries if entry.is_dir())
+
+    def get_files(self, table: str) -> list[str]:
+        """Parquet files of `table`, one per animal, sorted by animal."""
+        table_dir = os.path.join(self.store_dir, table)
+        if not os.path.isdir(table_dir):
+            return []
+        return sorted(list_files(table_dir, ".parquet"))
+
+    def get_animals(self, table: str = "df_regions") -> list[str]:
+        """Animals stored in `table`."""
+        return [
+            os.path.splitext(os.path.basename(filename))[0]
+            for filename in self.get_files(table)
+        ]
+
+    def append(self, dfs: dict):
+        """
+        Store DataFrames, replacing the animals already stored.
+
+        Parameters
+        ----------
+        dfs : dict
+            DataFrames to store, as {table: df}. They are split by the "animal"
+            column. If a DataFrame has no "animal" column, the whole table is replaced
+            by a single "all" file.
+
+        """
+        for table, df in dfs.items():
+            table_dir = os.path.join(self.store_dir, table)
+            os.makedirs(table_dir, exist_ok=True)
+
+            if "animal" in df.columns:
+                groups = df.groupby("animal", sort=False, observed=True)
+            else:
+                for filename in self.get_files(table):
+                    os.remove(filename)
+                groups = [("all", df)]
+
+            for animal, df_animal in groups:
+                filename = os.path.join(table_dir, f"{animal}.parquet")
+                tmp_file = f"{filename}.{os.getpid()}.tmp"
+                df_animal.to_parquet(tmp_file, compression=self.compression)
+                os.replace(tmp_file, filename)
+
+    def select(
+        self,
+        table: str,
+        columns: list[str] | None = None,
+        **filters,
+    ) -> pd.DataFrame:
+        """
+        Load a table, or part of it.
+
+        Parameters
+        ----------
+        table : str
+            Name of the table, eg. "df_coordinates".
+        columns : list of str or None, optional
+            Columns to load. If None (default), all columns are loaded.
+        **filters : list-like
+            Keep rows whose column value is in the given values, eg.
+            `animal=["mouse0", "mouse1"], Name=["VISp", "MOp"]`. Only the files of
+            the selected animals are read.
+
+        Returns
+        -------
+        df : pandas.DataFrame
+
+        """
+        query = self.query(table).where(**filters)
+        if columns is not None:
+            query = query.select(columns)
+        return query.collect()
+
+    def query(self, table: str) -> "ResultsQuery":
+        """Get a lazy query on `table`, see `ResultsQuery`."""
+        return ResultsQuery(self, table)
+
+
+class ResultsQuery:
+    """
+    Lazy query on a table of a `ResultsStore`.
+
+    Projections and filters are only recorded : `select()`, `where()`, `within()` and
+    `in_region()` return a new query, nothing is read until `collect()` (or
+    `iter_chunks()`) is called. The query is then executed by pyarrow, batch by batch,
+    reading only the files of the selected animals, the selected columns and the row
+    groups that can match, so that only the final subset is materialized.
+
+    Queries are accepted by the `cuisto.display.plot_*` functions in place of
+    DataFrames.
+
+    Parameters
+    ----------
+    store : ResultsStore
+        Store to query.
+    table : str
+        Name of the table, eg. "df_coordinates".
+
+    """
+
+    def __init__(self, store: ResultsStore, table: str):
+        """Constructor."""
+        self.store = store
+        self.table = table
+        self.columns = None  # all columns
+        self.filters = {}  # {column: allowed values}
+        self.ranges = {}  # {column: (min, max)}
+
+    def __repr__(self) -> str:
+        return (
+            f"ResultsQuery({self.store!r}, {self.table!r}, columns={self.columns}, "
+            f"filters={self.filters}, ranges={self.ranges})"
+        )
+
+    def _copy(self) -> "ResultsQuery":
+        """Copy the query, so that queries are never modified in place."""
+        query = ResultsQuery(self.store, self.table)
+        query.columns = self.columns
+        query.filters = dict(self.filters)
+        query.ranges = dict(self.ranges)
+        return query
+
+    def select(self, columns: list[str]) -> "ResultsQuery":
+        """
+        Load only `columns`. The index is always loaded.
+
+        Parameters
+        ----------
+        columns : list of str
+
+        Returns
+        -------
+        query : ResultsQuery
+
+        """
+        query = self._copy()
+        query.columns = list(columns)
+        return query
+
+    def where(self, **filters) -> "ResultsQuery":
+        """
+        Keep rows whose column value is in the given values.
+
+        Filtering the same column several times keeps the values common to all
+        filters.
+
+        Parameters
+        ----------
+        **filters : list-like
+            Allowed values, eg. `animal=["mouse0"], channel=["marker+"]`. Filtering on
+            "animal" skips the files of the other animals.
+
+        Returns
+        -------
+        query : ResultsQuery
+
+        """
+        query = self._copy()
+        for col, values in filters.items():
+            values = list(dict.fromkeys(values))
+            if col in query.filters:
+                values = [value for value in values if value in query.filters[col]]
+            query.filters[col] = values
+        return query
+
+    def within(self, **ranges) -> "ResultsQuery":
+        """
+        Keep rows whose column value is between the given limits, included.
+
+        Parameters
+        ----------
+        **ranges : tuple
+            (min, max) limits, eg. `Atlas_AP=(-2.5, -1), Atlas_DV=(None, 3)`. None
+            means no limit.
+
+        Returns
+        -------
+        query : ResultsQuery
+
+        """
+        query = self._copy()
+        for col, (vmin, vmax) in ranges.items():
+            prev_min, prev_max = query.ranges.get(col, (None, None))
+            if prev_min is not None:
+                vmin = prev_min if vmin is None else max(vmin, prev_min)
+            if prev_max is not None:
+                vmax = prev_max if vmax is None else min(vmax, prev_max)
+            query.ranges[col] = (vmin, vmax)
+        return query
+
+    def in_region(
+        self, region: str | list[str], atlas: BrainGlobeAtlas, col: str = "Parent"
+    ) -> "ResultsQuery":
+        """
+        Keep rows in `region` or any of its descendants in the atlas hierarchy.
+
+        Parameters
+        ----------
+        region : str or list of str
+            Acronym(s) of the parent region(s).
+        atlas : BrainGlobeAtlas
+        col : str, optional
+            Column with the regions acronyms. Default is "Parent" (detections), use
+            "Name" for the regions metrics.
+
+        Returns
+        -------
+        query : ResultsQuery
+
+        """
+        if isinstance(region, str):
+            region = [region]
+        subtree = chain.from_iterable(utils.get_child_regions(atlas, r) for r in region)
+        return self.where(**{col: subtree})
+
+    def _get_scanner(self) -> ds.Scanner | None:
+        """Build the pyarrow scanner, None if there are no files to read."""
+        files = self.store.get_files(self.table)
+        if "animal" in self.filters:
+            animals = set(self.filters["animal"])
+            files = [
+                filename
+                for filename, animal in zip(files, self.store.get_animals(self.table))
+                if animal in animals
+            ]
+        if len(files) == 0:
+            return None
+
+        # files may have different types, eg. null where another has strings
+        schema = pa.unify_schemas(
+            [pq.read_schema(filename) for filename in files],
+            promote_options="permissive",
+        )
+        dataset = ds.dataset(files, schema=schema, format="parquet")
+
+        columns = self.columns
+        if columns is not None:
+            # the index is stored in regular columns
+            index_columns = [
+                col
+                for col in (schema.pandas_metadata or {}).get("index_columns", [])
+                if isinstance(col, str) and col not in columns
+            ]
+            columns = columns + index_columns
+
+        expression = None
+        for col, values in self.filters.items():
+            dtype = schema.field(col).type
+            if pa.types.is_dictionary(dtype):
+                dtype = dtype.value_type
+            values = pa.array(values, type=dtype)
+            expression = _and(expression, pc.field(col).isin(values))
+        for col, (vmin, vmax) in self.ranges.items():
+            if vmin is not None:
+                expression = _and(expression, pc.field(col) >= vmin)
+            if vmax is not None:
+                expression = _and(expression, pc.field(col) <= vmax)
+
+        return dataset.scanner(columns=columns, filter=expression)
+
+    def iter_chunks(self):
+        """
+        Execute the query, yielding the matching rows batch by batch.
+
+        Yields
+        ------
+        df : pandas.DataFrame
+
+        """
+        scanner = self._get_scanner()
+        if scanner is None:
+            return
+        for batch in scanner.to_batches():
+            if batch.num_rows > 0:
+                yield pa.Table.from_batches(
+                    [batch], schema=scanner.projected_schema
+                ).to_pandas()
+
+    def collect(self) -> pd.DataFrame:
+        """
+        Execute the query.
+
+        Returns
+        -------
+        df : pandas.DataFrame
+            Matching rows.
+
+        """
+        scanner = self._get_scanner()
+        if scanner is None:
+            return pd.DataFrame(columns=self.columns)
+        return scanner.to_table().to_pandas()
+
+
+def _and(expression: pc.Expression | None, other: pc.Expression) -> pc.Expression:
+    """Combine two pyarrow expressions, the first one can be None."""
+    return other if expression is None else expression & other
+
+
+def get_dataframe(
+    data: pd.DataFrame | ResultsQuery, columns: list[str] | None = None
+) -> pd.DataFrame:
+    """
+    Get a DataFrame from a DataFrame or a `ResultsQuery`.
+
+    Parameters
+    ----------
+    data : pandas.DataFrame or ResultsQuery
+        If a query, it is executed, otherwise it is returned as is.
+    columns : list of str or None, optional
+        Columns needed, only those are loaded from a query. If None (default), the
+        columns selected in the query are loaded.
+
+    Returns
+    -------
+    df : pandas.DataFrame
+
+    """
+    if isinstance(data, ResultsQuery):
+        if columns is not None:
+            data = data.select(columns)
+        return data.collect()
+    return data
+
+
 def save_dfs(out_dir: str, filename, dfs: dict):
     """
     Save DataFrames to file.
 
-    File format is inferred from file name extension.
+    File format is inferred from file name extension. With the ".parquet" extension,
+    DataFrames are stored in a `ResultsStore` directory : saving animals to an existing
+    store adds them, or replaces them if they were already there. Categorical columns
+    are kept as such with parquet, HDF5 (in "table" format) and pickle, CSV, TSV and
+    xlsx files do not keep the columns types.
 
     Parameters
     ----------
     out_dir : str
         Output directory.
-    filename : _type_
+    filename : str
         File name.
     dfs : dict
-        DataFrames to save, as {identifier: df}. If HDF5 or xlsx, all df are saved in
-        the same file, otherwise identifier is appended to the file name.
+        DataFrames to save, as {identifier: df}. If HDF5, xlsx or parquet, all df are
+        saved in the same file (directory for parquet), otherwise identifier is
+        appended to the file name.
 
     """
     if not os.path.isdir(out_dir):
         os.makedirs(out_dir)
 
     basename, ext = os.path.splitext(filename)
-    if ext in [".h5", ".hdf", ".hdf5"]:
-        path = os.path.join(out_dir, filename)
-        for identifier, df in dfs.items():
-            df.to_hdf(path, key=identifier, mode="w")
+    path = os.path.join(out_dir, filename)
+    if ext == ".parquet":
+        ResultsStore(path).append(dfs)
+    elif ext in [".h5", ".hdf", ".hdf5"]:
+        with pd.HDFStore(path, mode="w") as store:
+            for identifier, df in dfs.items():
+                # the faster "fixed" format can't store categorical columns
+                has_categories = any(
+                    isinstance(dtype, pd.CategoricalDtype) for dtype in df.dtypes
+                )
+                store.put(identifier, df, format="table" if has_categories else "fixed")
     elif ext == ".xlsx":
-        for identifier, df in dfs.items():
-            df.to_excel(path, sheet_name=identifier)
+        with pd.ExcelWriter(path) as writer:
+            for identifier, df in dfs.items():
+                df.to_excel(writer, sheet_name=identifier)
     else:
         for identifier, df in dfs.items():
             path = os.path.join(out_dir, f"{basename}_{identifier}{ext}")
@@ -275,24 +2467,35 @@ def load_dfs(
         "df_distribution_dv",
         "df_distribution_ml",
     ],
+    columns: list[str] | None = None,
+    **filters,
 ):
     """
     Load DataFrames from file.
 
     If `fmt` is "h5" ("xslx"), identifiers are interpreted as h5 group identifier (sheet
     name, respectively).
+    If `fmt` is "parquet", identifiers are tables of the `ResultsStore`.
     If `fmt` is "pickle", "csv" or "tsv", identifiers are appended to `filename`.
     Path to the file can't have a dot (".") in it.
 
+    With "parquet", only the requested columns and rows are read, see
+    `ResultsStore.select()`. With other formats, DataFrames are read in full then
+    selected.
+
     Parameters
     ----------
     filepath : str
         Full path to the file(s), without extension.
-    fmt : {"h5", "csv", "pickle", "xlsx"}
+    fmt : {"parquet", "h5", "csv", "pickle", "xlsx"}
         File(s) format.
     identifiers : list of str, optional
         List of identifiers to load from files. Defaults to the ones saved in
         cuisto.process.process_animals().
+    columns : list of str or None, optional
+        Columns to load. If None (default), all columns are loaded.
+    **filters : list-like
+        Keep rows whose column value is in the given values, eg. `animal=["mouse0"]`.
 
     Returns
     -------
@@ -304,7 +2507,13 @@ def load_dfs(
     full_path = base_path + "." + fmt
 
     res = []
-    if (fmt == "h5") or (fmt == "hdf") or (fmt == "hdf5"):
+    if fmt == "parquet":
+        store = ResultsStore(full_path)
+        return [
+            store.select(identifier, columns=columns, **filters)
+            for identifier in identifiers
+        ]
+    elif (fmt == "h5") or (fmt == "hdf") or (fmt == "hdf5"):
         for identifier in identifiers:
             res.append(pd.read_hdf(full_path, identifier))
     elif fmt == "xlsx":
@@ -322,4 +2531,11 @@ def load_dfs(
             else:
                 raise ValueError(f"{fmt} is not supported.")
 
+    for idx, df in enumerate(res):
+        for col, values in filters.items():
+            df = df[df[col].isin(values)]
+        if columns is not None:
+            df = df[columns]
+        res[idx] = df
+
     return res
@@ -5,12 +5,1004 @@ Wraps other functions for a click&play behaviour. Relies on the configuration fi
 """
 
 import os
+import pickle
+import warnings
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
+import numpy as np
 import pandas as pd
 from tqdm import tqdm
 
 from cuisto import compute, io, utils
 
+# errors of an animal that can be skipped in process_animals(), eg. missing or
+# malformed measurements files
+SKIPPABLE_ERRORS = (OSError, ValueError, KeyError)
+
+
+def prepare_detections(
+    df_detections: pd.DataFrame, cfg, allow_empty: bool = False
+) -> pd.DataFrame:
+    """
+    Clean up detections and add the columns required for the analysis.
+
+    Objects that do not belong to the object type or that are in blacklisted regions
+    are removed, then the "hemisphere" and "channel" columns are added (unless they
+    exist already), atlas coordinates are converted to mm and stereotaxic coordinates
+    are added as "Atlas_AP", "Atlas_DV" and "Atlas_ML". This is equivalent to
+    `utils.filter_df_classifications()`, `utils.filter_df_regions()`,
+    `utils.add_hemisphere()`, `utils.add_channel()` and `utils.ccf_to_stereo()` in a
+    row, but rules are evaluated on unique labels and the DataFrame is copied only
+    once.
+
+    Parameters
+    ----------
+    df_detections : pd.DataFrame
+        DataFrame of QuPath Detections, with coordinates in microns.
+    cfg : cuisto.Config
+        The configuration loaded from TOML configuration file.
+    allow_empty : bool, optional
+        If False (default), raise an error if no detection belongs to the object type.
+        Set it to True when `df_detections` is only a part of the data (eg. one image).
+
+    Returns
+    -------
+    df_detections : pd.DataFrame
+        Filtered detections with the new columns.
+
+    """
+    # keep objects of selected classification, not in blacklisted regions
+    classification = df_detections["Classification"]
+    if not isinstance(classification.dtype, pd.CategoricalDtype):
+        classification = classification.astype("category")
+    pattern = f".*{cfg.object_type}.*"
+    keep = utils.get_category_mask(
+        classification,
+        lambda labels: labels.str.contains(pattern, case=False, regex=True),
+    )
+    if not (allow_empty or keep.any()):
+        raise ValueError(
+            f"Filtering 'Classification' with {[cfg.object_type]} resulted in an"
+            " empty DataFrame, check your config file."
+        )
+    keep &= ~utils.get_category_mask(
+        df_detections["Parent"], lambda labels: labels.isin(cfg.atlas["blacklist"])
+    )
+    df_detections = df_detections[keep]
+    codes = classification.cat.codes.to_numpy()[keep]
+
+    # hemisphere from the medio-lateral coordinate, in microns
+    if "hemisphere" not in df_detections.columns:
+        ml = df_detections[cfg.Zname].to_numpy()
+        if cfg.atlas["type"] in ("abba", "brain"):
+            # regular ABBA atlas : beyond midline, it's left
+            is_left = ml >= cfg.atlas["midline"]
+        elif cfg.atlas["type"] in ("brainglobe", "cord"):
+            # brainglobe atlas : below midline, it's left
+            is_left = ml <= cfg.atlas["midline"]
+        else:
+            raise ValueError(
+                f"{cfg.atlas['type']} not supported, choose either 'abba' or "
+                "'brainglobe'."
+            )
+        hemisphere_codes = is_left.astype(np.intp)
+        hemisphere_codes[np.isnan(ml)] = 2
+        names = np.array(
+            [
+                cfg.hemispheres["names"]["Right"],
+                cfg.hemispheres["names"]["Left"],
+                np.nan,
+            ],
+            dtype=object,
+        )
+        df_detections["hemisphere"] = names[hemisphere_codes]
+
+    # channel from {class_name: channel} classification
+    if "channel" not in df_detections.columns:
+        channels = (
+            classification.cat.categories.str.replace(cfg.object_type + ": ", "")
+            .map(cfg.channels["names"])
+            .to_numpy(dtype=object)
+        )
+        df_detections["channel"] = np.append(channels, np.nan)[codes]
+
+    # convert coordinates to mm
+    for col in ("Atlas_X", "Atlas_Y", "Atlas_Z"):
+        df_detections[col] = df_detections[col].to_numpy() / 1000
+
+    # convert to sterotaxic coordinates
+    ap, dv, ml = (
+        df_detections[cfg.Xname],
+        df_detections[cfg.Yname],
+        df_detections[cfg.Zname],
+    )
+    if cfg.distributions["stereo"]:
+        ap, dv, ml = utils.ccf_to_stereo(ap, dv, ml)
+    df_detections["Atlas_AP"] = ap.to_numpy()
+    df_detections["Atlas_DV"] = dv.to_numpy()
+    df_detections["Atlas_ML"] = ml.to_numpy()
+
+    return df_detections
+
+
+def get_distributions_bins(cfg) -> tuple[list[str], list[list], list[int]]:
+    """
+    Get the axes and bins of the 1D distributions from the configuration.
+
+    Parameters
+    ----------
+    cfg : cuisto.Config
+        The configuration loaded from TOML configuration file.
+
+    Returns
+    -------
+    cols : list of str
+        Stereotaxic coordinates columns, "Atlas_AP", "Atlas_DV" and "Atlas_ML".
+    binlims : list
+        First bin left edge and last bin right edge, for each axis.
+    nbins : list of int
+        Number of bins, for each axis.
+
+    """
+    cols = ["Atlas_AP", "Atlas_DV", "Atlas_ML"]
+    binlims = [
+        cfg.distributions["ap_lim"],
+        cfg.distributions["dv_lim"],
+        cfg.distributions["ml_lim"],
+    ]
+    nbins = [
+        cfg.distributions["ap_nbins"],
+        cfg.distributions["dv_nbins"],
+        cfg.distributions["dv_nbins"],
+    ]
+
+    return cols, binlims, nbins
+
+
+def clean_annotations(
+    df_annotations: pd.DataFrame, cfg, leaf_regions_only: bool = True
+) -> pd.DataFrame:
+    """
+    Clean up annotations before computing metrics in brain regions.
+
+    Root, blacklisted and non-leaf regions are removed, the "hemisphere" column is
+    added and regions are merged according to the fusion file.
+
+    Parameters
+    ----------
+    df_annotations : pd.DataFrame
+        DataFrame of QuPath Annotations.
+    cfg : cuisto.Config
+        The configuration loaded from TOML configuration file.
+    leaf_regions_only : bool, optional
+        See `process_animal()`.
+
+    Returns
+    -------
+    df_annotations : pd.DataFrame
+        Cleaned annotations.
+
+    """
+    # filter regions : remove root and blacklisted regions, and objects in non-leaf
+    # regions if any, evaluated at once on unique regions names
+    keep_leaves = leaf_regions_only & (len(cfg.atlas["leaveslist"]) > 0)
+
+    def keep_region(names):
+        keep = ~names.isin(["Root", "root"]) & ~names.isin(cfg.atlas["blacklist"])
+        if keep_leaves:
+            keep &= names.isin(cfg.atlas["leaveslist"])
+        return keep
+
+    df_annotations = df_annotations[
+        utils.get_category_mask(df_annotations["Name"], keep_region)
+    ]
+    # add hemisphere
+    df_annotations = utils.add_hemisphere(df_annotations, cfg.hemispheres["names"])
+    # merge regions
+    df_annotations = utils.merge_regions(
+        df_annotations, col="Name", fusion_file=cfg.files["fusion"]
+    )
+
+    return df_annotations
+
+
+def get_regions_metrics(df_annotations: pd.DataFrame, cfg) -> pd.DataFrame:
+    """
+    Wraps compute.get_regions_metrics() with the parameters from the configuration.
+
+    Parameters
+    ----------
+    df_annotations : pd.DataFrame
+        Cleaned annotations, see `clean_annotations()`.
+    cfg : cuisto.Config
+        The configuration loaded from TOML configuration file.
+
+    Returns
+    -------
+    df_regions : pandas.DataFrame
+        Metrics in brain regions. One entry for each hemisphere of each brain regions.
+
+    """
+    return compute.get_regions_metrics(
+        df_annotations,
+        cfg.object_type,
+        cfg.channels["names"],
+        cfg.regions["base_measurement"],
+        cfg.regions["metrics"],
+    )
+
+
+def normalize_starter_cells(df_regions: pd.DataFrame, animal: str, cfg) -> pd.DataFrame:
+    """
+    Wraps compute.normalize_starter_cells() with the parameters from the configuration.
+
+    Metrics that are not relative are divided by the number of starter cells.
+
+    Parameters
+    ----------
+    df_regions : pandas.DataFrame
+        Metrics in brain regions.
+    animal : str
+        Animal ID.
+    cfg : cuisto.Config
+        The configuration loaded from TOML configuration file.
+
+    Returns
+    -------
+    df_regions : pandas.DataFrame
+        Same `df_regions`, normalized.
+
+    """
+    colstonorm = [v for v in cfg.regions["metrics"].values() if "relative" not in v]
+    return compute.normalize_starter_cells(
+        df_regions, colstonorm, animal, cfg.info_store, cfg.channels["names"]
+    )
+
+
+def get_animal_regions(
+    animal: str, df_annotations: pd.DataFrame, cfg, leaf_regions_only: bool = True
+) -> pd.DataFrame:
+    """
+    Clean up annotations and compute metrics in brain regions for one animal.
+
+    Parameters
+    ----------
+    animal : str
+        Animal ID.
+    df_annotations : pd.DataFrame
+        DataFrame of QuPath Annotations.
+    cfg : cuisto.Config
+        The configuration loaded from TOML configuration file.
+    leaf_regions_only : bool, optional
+        See `process_animal()`.
+
+    Returns
+    -------
+    df_regions : pandas.DataFrame
+        Metrics in brain regions. One entry for each hemisphere of each brain regions.
+
+    """
+    # - Annotations data cleanup
+    df_annotations = clean_annotations(df_annotations, cfg, leaf_regions_only)
+
+    # - Computations
+    # get regions distributions
+    df_regions = get_regions_metrics(df_annotations, cfg)
+
+    # normalize by starter cells
+    if cfg.regions["normalize_starter_cells"]:
+        df_regions = normalize_starter_cells(df_regions, animal, cfg)
+
+    return df_regions
+
+
+def get_regions_metrics_from_detections(
+    animal: str,
+    df_detections: pd.DataFrame,
+    cfg,
+    slice_spacing: float | None = None,
+    leaf_regions_only: bool = True,
+    split: bool = True,
+) -> pd.DataFrame:
+    """
+    Compute metrics in brain regions from the detections, without annotations.
+
+    Detections are attributed to atlas regions from their coordinates, then counted
+    with a single `np.bincount`, per region, hemisphere and channel. For fibers-like
+    objects whose base measurement is a length in µm, the length of the paths is
+    summed instead, see `get_segments_lengths()`.
+    Counts are rolled up the atlas hierarchy so that each region includes its
+    descendants, as QuPath annotations do. Areas are derived from the number of atlas
+    voxels of each region in each hemisphere. The result is then cleaned up and
+    formatted as with annotations, see `get_animal_regions()`.
+
+    The area of a region is the cumulated area of its sections, assuming coronal
+    sections every `slice_spacing` microns. If `slice_spacing` is None, one section per
+    atlas plane is assumed. This scales all areas by the same factor, so that relative
+    metrics do not depend on it.
+
+    Parameters
+    ----------
+    animal : str
+        Animal ID.
+    df_detections : pd.DataFrame
+        Detections, prepared with `prepare_detections()` (coordinates in mm). For
+        fibers-like objects, points of a fiber must be contiguous and in order, with
+        the same index.
+    cfg : cuisto.Config
+        The configuration loaded from TOML configuration file.
+    slice_spacing : float or None, optional
+        Spacing between two sections, in microns. Default is None.
+    leaf_regions_only : bool, optional
+        See `process_animal()`.
+    split : bool, optional
+        For fibers-like objects, whether to split segments at atlas voxels boundaries,
+        see `get_segments_lengths()`. Default is True.
+
+    Returns
+    -------
+    df_regions : pandas.DataFrame
+        Metrics in brain regions. One entry for each hemisphere of each brain regions.
+
+    """
+    lookup = _get_atlas_lookup(cfg)
+    nregions = len(lookup.hierarchy.ids)
+
+    # atlas coordinates in microns, in the atlas axes order
+    x, y, z = (
+        df_detections[col].to_numpy(dtype=float) * 1000
+        for col in (cfg.Xname, cfg.Yname, cfg.Zname)
+    )
+    hemisphere_codes = pd.Categorical(
+        df_detections["hemisphere"],
+        categories=[
+            cfg.hemispheres["names"]["Left"],
+            cfg.hemispheres["names"]["Right"],
+        ],
+    ).codes
+    channel_codes = pd.Categorical(
+        df_detections["channel"], categories=list(cfg.channels["names"].values())
+    ).codes
+    nchannels = len(cfg.channels["names"])
+
+    if cfg.regions["base_measurement"].endswith("µm"):
+        # length of the paths, points of a path share the same index
+        offsets = np.flatnonzero(df_detections.index[1:] != df_detections.index[:-1])
+        offsets = np.concatenate(([0], offsets + 1, [len(df_detections)]))
+        measurement = get_segments_lengths(
+            x,
+            y,
+            z,
+            offsets,
+            hemisphere_codes,
+            channel_codes,
+            nchannels,
+            lookup,
+            split=split,
+        )
+    else:
+        # count, per region, hemisphere and channel
+        codes = lookup.get_codes(x, y, z).astype(np.intp)
+        valid = (hemisphere_codes >= 0) & (channel_codes >= 0)
+        measurement = np.bincount(
+            (codes[valid] * 2 + hemisphere_codes[valid]) * nchannels
+            + channel_codes[valid],
+            minlength=nregions * 2 * nchannels,
+        ).reshape(nregions, 2, nchannels)
+
+    return get_regions_metrics_from_measurement(
+        animal,
+        measurement,
+        cfg,
+        slice_spacing=slice_spacing,
+        leaf_regions_only=leaf_regions_only,
+    )
+
+
+def get_regions_metrics_from_fibers(
+    animal: str,
+    fibers,
+    cfg,
+    slice_spacing: float | None = None,
+    leaf_regions_only: bool = True,
+    split: bool = True,
+) -> pd.DataFrame:
+    """
+    Compute metrics in brain regions from fibers coordinates, without annotations.
+
+    Fibers are read from flat arrays, one image at a time, see
+    `io.read_fibers_json()`. The length of the fibers in each region, hemisphere and
+    channel is accumulated with `get_segments_lengths()`, then formatted as with
+    `get_regions_metrics_from_detections()`. Fibers are never exploded in a DataFrame,
+    so this scales to millions of paths.
+
+    Parameters
+    ----------
+    animal : str
+        Animal ID.
+    fibers : iterable of dict
+        Fibers of each image, as returned by `io.read_fibers_json()` or
+        `io.FibersStore.get_fibers()`, with coordinates in microns.
+    cfg : cuisto.Config
+        The configuration loaded from TOML configuration file.
+    slice_spacing : float or None, optional
+        See `get_regions_metrics_from_detections()`.
+    leaf_regions_only : bool, optional
+        See `process_animal()`.
+    split : bool, optional
+        See `get_segments_lengths()`. Default is True.
+
+    Returns
+    -------
+    df_regions : pandas.DataFrame
+        Metrics in brain regions. One entry for each hemisphere of each brain regions.
+
+    """
+    lookup = _get_atlas_lookup(cfg)
+    channels = list(cfg.channels["names"].keys())
+    # json coordinates are named after the ABBA convention
+    axes = [name[-1].lower() for name in (cfg.Xname, cfg.Yname, cfg.Zname)]
+
+    measurement = np.zeros((len(lookup.hierarchy.ids), 2, len(channels)))
+    for image_fibers in fibers:
+        # hemisphere of each point, 0 is left, 1 is right
+        hemisphere_codes = pd.Categorical(
+            image_fibers["hemisphere"], categories=["Left", "Right"]
+        ).codes
+        # channel of each path, broadcasted to its points
+        classification = pd.Series(
+            image_fibers["properties"].get(
+                "classification", [None] * (len(image_fibers["offsets"]) - 1)
+            ),
+            dtype=object,
+        )
+        channel_codes = pd.Categorical(
+            classification.str.replace(cfg.object_type + ": ", ""),
+            categories=channels,
+        ).codes.take(image_fibers["path_id"])
+        measurement += get_segments_lengths(
+            *(np.asarray(image_fibers[axis]) for axis in axes),
+            image_fibers["offsets"],
+            hemisphere_codes,
+            channel_codes,
+            len(channels),
+            lookup,
+            split=split,
+        )
+
+    return get_regions_metrics_from_measurement(
+        animal,
+        measurement,
+        cfg,
+        slice_spacing=slice_spacing,
+        leaf_regions_only=leaf_regions_only,
+    )
+
+
+def get_segments_lengths(
+    x: np.ndarray,
+    y: np.ndarray,
+    z: np.ndarray,
+    offsets: np.ndarray,
+    hemisphere_codes: np.ndarray,
+    channel_codes: np.ndarray,
+    nchannels: int,
+    lookup: utils.RegionLookup,
+    split: bool = True,
+) -> np.ndarray:
+    """
+    Sum the length of paths in each region, hemisphere and channel.
+
+    Paths are cut in segments between consecutive points, and, with `split`, segments
+    are further cut where they cross the atlas voxels boundaries, see
+    `compute.split_segments()`. Each piece is attributed to the region of its middle
+    and to the hemisphere and channel of the first point of its segment. Lengths are
+    then accumulated with a single `np.bincount`. Without `split`, each segment is
+    attributed to the region of its middle.
+
+    Parameters
+    ----------
+    x, y, z : np.ndarray
+        Points coordinates in microns, in the atlas axes order (AP, DV, ML).
+    offsets : np.ndarray
+        Paths limits in the points arrays, with length number of paths + 1.
+    hemisphere_codes : np.ndarray
+        Hemisphere of each point, 0 is left and 1 is right, -1 to discard the point.
+    channel_codes : np.ndarray
+        Channel index of each point, -1 to discard the point.
+    nchannels : int
+        Number of channels.
+    lookup : utils.RegionLookup
+        Atlas lookup, see `utils.get_region_lookup()`.
+    split : bool, optional
+        Whether to split segments at voxels boundaries. Default is True.
+
+    Returns
+    -------
+    lengths : np.ndarray
+        Lengths in microns, with shape (regions, 2, channels). Not rolled up, see
+        `utils.RegionHierarchy.roll_up()`.
+
+    """
+    nregions = len(lookup.hierarchy.ids)
+    resolution = lookup.resolution if split else None
+    shape = np.round(np.asarray(lookup.shape_um) / lookup.resolution).astype(int)
+    segments, xm, ym, zm, lengths = compute.split_segments(
+        x, y, z, offsets, resolution=resolution, shape=shape
+    )
+
+    codes = lookup.get_codes(xm, ym, zm).astype(np.intp)
+    hemisphere_codes = np.asarray(hemisphere_codes).take(segments)
+    channel_codes = np.asarray(channel_codes).take(segments)
+    valid = (hemisphere_codes >= 0) & (channel_codes >= 0)
+
+    return np.bincount(
+        (codes[valid] * 2 + hemisphere_codes[valid]) * nchannels + channel_codes[valid],
+        weights=lengths[valid],
+        minlength=nregions * 2 * nchannels,
+    ).reshape(nregions, 2, nchannels)
+
+
+def get_regions_metrics_from_measurement(
+    animal: str,
+    measurement: np.ndarray,
+    cfg,
+    slice_spacing: float | None = None,
+    leaf_regions_only: bool = True,
+) -> pd.DataFrame:
+    """
+    Compute metrics in brain regions from the measurement in each atlas region.
+
+    The measurement is rolled up the atlas hierarchy so that each region includes its
+    descendants, as QuPath annotations do. Areas are derived from the number of atlas
+    voxels of each region in each hemisphere, see
+    `get_regions_metrics_from_detections()`. The result is then cleaned up and
+    formatted as with annotations, see `get_animal_regions()`.
+
+    Parameters
+    ----------
+    animal : str
+        Animal ID.
+    measurement : np.ndarray
+        Base measurement in each atlas region (not rolled up), hemisphere (left,
+        right) and channel, with shape (regions, 2, channels).
+    cfg : cuisto.Config
+        The configuration loaded from TOML configuration file.
+    slice_spacing : float or None, optional
+        See `get_regions_metrics_from_detections()`.
+    leaf_regions_only : bool, optional
+        See `process_animal()`.
+
+    Returns
+    -------
+    df_regions : pandas.DataFrame
+        Metrics in brain regions. One entry for each hemisphere of each brain regions.
+
+    """
+    lookup = _get_atlas_lookup(cfg)
+    hierarchy = lookup.hierarchy
+    hemispheres = [cfg.hemispheres["names"]["Left"], cfg.hemispheres["names"]["Right"]]
+    channels = list(cfg.channels["names"].keys())
+    meas_base_name = cfg.regions["base_measurement"]
+    measurement = hierarchy.roll_up(measurement)
+
+    # cumulated sections area from the regions volumes
+    voxel_counts = lookup.get_voxel_counts(
+        cfg.atlas["midline"],
+        left_beyond_midline=cfg.atlas["type"] in ("abba", "brain"),
+    )
+    voxel_area = lookup.resolution[1] * lookup.resolution[2]
+    if slice_spacing:
+        voxel_area *= lookup.resolution[0] / slice_spacing
+    area = hierarchy.roll_up(voxel_counts) * voxel_area
+
+    # format as annotations, one entry per region and hemisphere with an area
+    region_index, hemisphere_index = np.nonzero(area)
+    df_annotations = pd.DataFrame(
+        {
+            "Name": np.array(hierarchy.acronyms, dtype=object)[region_index],
+            "hemisphere": np.array(hemispheres, dtype=object)[hemisphere_index],
+            "Area µm^2": area[region_index, hemisphere_index],
+        }
+    )
+    for idx, channel in enumerate(channels):
+        df_annotations[f"{cfg.object_type}: {channel} {meas_base_name}"] = measurement[
+            region_index, hemisphere_index, idx
+        ]
+
+    # - Annotations data cleanup
+    df_annotations = clean_annotations(df_annotations, cfg, leaf_regions_only)
+
+    # - Computations
+    df_regions = get_regions_metrics(df_annotations, cfg)
+    if cfg.regions["normalize_starter_cells"]:
+        df_regions = normalize_starter_cells(df_regions, animal, cfg)
+
+    return df_regions
+
+
+def _get_atlas_lookup(cfg) -> utils.RegionLookup:
+    """Get the atlas lookup, raising an error if there is no atlas."""
+    if cfg.bg_atlas is None:
+        raise ValueError("An atlas is required to compute metrics from detections.")
+    return utils.get_region_lookup(cfg.bg_atlas)
+
+
+def get_stages_params(cfg, leaf_regions_only: bool = True) -> dict:
+    """
+    Get the configuration parameters each processing stage depends on.
+
+    Used to identify the outputs of the stages in a `io.StageCache`, see
+    `process_animal()`. Files are identified by their state (name, size and
+    modification time).
+
+    Parameters
+    ----------
+    cfg : cuisto.Config
+        The configuration loaded from TOML configuration file.
+    leaf_regions_only : bool, optional
+        See `process_animal()`.
+
+    Returns
+    -------
+    params : dict
+        {stage name: parameters}.
+
+    """
+
+    def file_state(filename):
+        return io.get_files_state([filename]) if os.path.isfile(filename) else None
+
+    return {
+        "annotations": {
+            "blacklist": cfg.atlas["blacklist"],
+            "leaveslist": cfg.atlas["leaveslist"],
+            "leaf_regions_only": leaf_regions_only,
+            "hemispheres": cfg.hemispheres["names"],
+            "fusion": file_state(cfg.files["fusion"]),
+        },
+        "regions": {
+            "object_type": cfg.object_type,
+            "channels": cfg.channels["names"],
+            "base_measurement": cfg.regions["base_measurement"],
+            "metrics": cfg.regions["metrics"],
+        },
+        "normalize": {
+            "channels": cfg.channels["names"],
+            "metrics": cfg.regions["metrics"],
+            "infos": file_state(cfg.files["infos"]),
+        },
+        "detections": {
+            "object_type": cfg.object_type,
+            "blacklist": cfg.atlas["blacklist"],
+            "atlas_type": cfg.atlas["type"],
+            "midline": cfg.atlas["midline"],
+            "hemispheres": cfg.hemispheres["names"],
+            "channels": cfg.channels["names"],
+            "stereo": cfg.distributions["stereo"],
+        },
+        "distribution": {
+            "hue": cfg.distributions["hue"],
+            "hue_filter": cfg.distributions["hue_filter"],
+            "common_norm": cfg.distributions["common_norm"],
+        },
+    }
+
+
+def process_animal_stages(
+    animal: str,
+    df_annotations: pd.DataFrame,
+    df_detections: pd.DataFrame,
+    cfg,
+    stage_cache: io.StageCache,
+    compute_distributions: bool = True,
+    leaf_regions_only: bool = True,
+) -> tuple[pd.DataFrame, list[pd.DataFrame], pd.DataFrame]:
+    """
+    Same as `process_animal()`, with each stage memoized in `stage_cache`.
+
+    Stages are the annotations cleanup, the regions metrics, the normalization by
+    starter cells, the detections cleanup and the distribution along each axis. Each
+    stage is identified by its inputs and by the configuration parameters it depends on
+    (see `get_stages_params()`), so that only the stages affected by a change are
+    computed again.
+
+    Parameters
+    ----------
+    animal : str
+        Animal ID.
+    df_annotations, df_detections : pd.DataFrame
+        DataFrames of QuPath Annotations and Detections.
+    cfg : cuisto.Config
+        The configuration loaded from TOML configuration file.
+    stage_cache : io.StageCache
+        Where the outputs of the stages are stored.
+    compute_distributions, leaf_regions_only : bool, optional
+        See `process_animal()`.
+
+    Returns
+    -------
+    df_regions, dfs_distributions, df_coordinates
+        See `process_animal()`, without the "animal" column.
+
+    """
+    params = get_stages_params(cfg, leaf_regions_only)
+
+    # - Regions metrics
+    annotations = stage_cache.stage(
+        "annotations",
+        params["annotations"],
+        clean_annotations,
+        stage_cache.data(df_annotations),
+        cfg=cfg,
+        leaf_regions_only=leaf_regions_only,
+    )
+    regions = stage_cache.stage(
+        "regions", params["regions"], get_regions_metrics, annotations, cfg=cfg
+    )
+    if cfg.regions["normalize_starter_cells"]:
+        regions = stage_cache.stage(
+            "normalize",
+            {"animal": animal, **params["normalize"]},
+            normalize_starter_cells,
+            regions,
+            animal=animal,
+            cfg=cfg,
+        )
+
+    # - Detections
+    if compute_distributions:
+        detections = stage_cache.stage(
+            "detections",
+            params["detections"],
+            prepare_detections,
+            stage_cache.data(df_detections),
+            cfg=cfg,
+        )
+        # get AP, DV, ML distributions in stereotaxic coordinates, one stage per axis
+        dfs_distributions = [
+            stage_cache.stage(
+                "distribution",
+                {"col": col, "binlim": binlim, "nbin": nbin, **params["distribution"]},
+                lambda df, col=col, binlim=binlim, nbin=nbin: compute.get_distribution(
+                    df,
+                    col,
+                    cfg.distributions["hue"],
+                    cfg.distributions["hue_filter"],
+                    cfg.distributions["common_norm"],
+                    binlim,
+                    nbin,
+                ),
+                detections,
+            ).get()
+            for col, binlim, nbin in zip(*get_distributions_bins(cfg))
+        ]
+        df_detections = detections.get()
+    else:
+        dfs_distributions = []
+
+    return regions.get(), dfs_distributions, df_detections
+
+
+def get_detections_counts(df_detections: pd.DataFrame, cfg) -> dict:
+    """
+    Count prepared detections in bins and in brain regions.
+
+    Counts are mergeable : counts of different parts of the data of an animal (eg.
+    images) can be summed with `merge_detections_counts()`, so that only one part is
+    held in memory at once.
+
+    Parameters
+    ----------
+    df_detections : pd.DataFrame
+        Detections, prepared with `prepare_detections()`.
+    cfg : cuisto.Config
+        The configuration loaded from TOML configuration file.
+
+    Returns
+    -------
+    counts : dict
+        "n_detections" : number of detections,
+        "distributions" : 1D distributions counts, see
+        `compute.get_distributions_counts()`,
+        "regions" : number of detections per "Parent", "hemisphere" and "channel",
+        "grids" : 2D histograms in the sagittal, coronal and top views, in atlas
+        coordinates. Empty if no atlas is specified.
+
+    """
+    cols, binlims, nbins = get_distributions_bins(cfg)
+    counts = {
+        "n_detections": len(df_detections),
+        "distributions": compute.get_distributions_counts(
+            df_detections,
+            cols,
+            cfg.distributions["hue"],
+            cfg.distributions["hue_filter"],
+            binlims,
+            nbins,
+        ),
+        "regions": df_detections.groupby(
+            ["Parent", "hemisphere", "channel"], observed=True
+        ).size(),
+        "grids": {},
+    }
+
+    # 2D heatmaps, spanning the whole atlas
+    for view, ((x, xlim), (y, ylim)) in get_heatmaps_bins(cfg).items():
+        counts["grids"][view] = compute.get_histogram_2d(
+            df_detections[x].to_numpy(),
+            df_detections[y].to_numpy(),
+            xlim,
+            ylim,
+            cfg.distributions["display"]["cmap_nbins"],
+        )
+
+    return counts
+
+
+def get_heatmaps_bins(cfg) -> dict:
+    """
+    Get the axes and limits of the 2D heatmaps, spanning the whole atlas.
+
+    Parameters
+    ----------
+    cfg : cuisto.Config
+        The configuration loaded from TOML configuration file.
+
+    Returns
+    -------
+    views : dict
+        {view: ((x name, x limits), (y name, y limits))} for the sagittal, coronal and
+        top views, in atlas coordinates (mm). Empty if no atlas is specified.
+
+    """
+    if cfg.bg_atlas is None:
+        return {}
+
+    lims = dict(
+        zip(
+            (cfg.Xname, cfg.Yname, cfg.Zname),
+            [[0, size / 1000] for size in cfg.bg_atlas.shape_um],
+        )
+    )
+    views = {
+        "sagittal": (cfg.Xname, cfg.Yname),
+        "coronal": (cfg.Zname, cfg.Yname),
+        "top": (cfg.Xname, cfg.Zname),
+    }
+
+    return {view: ((x, lims[x]), (y, lims[y])) for view, (x, y) in views.items()}
+
+
+def get_heatmaps_dataframe(grids: dict, cfg) -> pd.DataFrame:
+    """
+    Convert the 2D heatmaps of `get_detections_counts()` to a DataFrame.
+
+    Only non-empty bins are kept.
+
+    Parameters
+    ----------
+    grids : dict
+        {view: grid}, as in the "grids" of `get_detections_counts()`.
+    cfg : cuisto.Config
+        The configuration loaded from TOML configuration file.
+
+    Returns
+    -------
+    df_heatmaps : pd.DataFrame
+        With columns "view", "x" and "y" (bin centers, in atlas coordinates) and
+        "count".
+
+    """
+    views = get_heatmaps_bins(cfg)
+    data = {"view": [], "x": [], "y": [], "count": []}
+    for view, grid in grids.items():
+        (_, xlim), (_, ylim) = views[view]
+        xedges = np.linspace(*xlim, grid.shape[0] + 1)
+        yedges = np.linspace(*ylim, grid.shape[1] + 1)
+        ix, iy = np.nonzero(grid)
+        data["view"].append(np.full(len(ix), view, dtype=object))
+        data["x"].append((xedges[ix] + xedges[ix + 1]) / 2)
+        data["y"].append((yedges[iy] + yedges[iy + 1]) / 2)
+        data["count"].append(grid[ix, iy])
+
+    df_heatmaps = pd.DataFrame(
+        {
+            key: np.concatenate(values) if values else np.empty(0)
+            for key, values in data.items()
+        }
+    )
+    df_heatmaps["view"] = df_heatmaps["view"].astype("category")
+
+    return df_heatmaps
+
+
+def merge_detections_counts(counts_list: list[dict]) -> dict:
+    """
+    Sum counts from `get_detections_counts()`.
+
+    Parameters
+    ----------
+    counts_list : list of dict
+        Counts computed with the same configuration.
+
+    Returns
+    -------
+    counts : dict
+        Merged counts. A ValueError is raised if `counts_list` is empty.
+
+    """
+    counts_list = list(counts_list)
+    if not counts_list:
+        raise ValueError("No counts to merge, there were no detections chunks.")
+    regions = pd.concat([counts["regions"] for counts in counts_list])
+    grids = {}
+    for counts in counts_list:
+        for view, grid in counts["grids"].items():
+            grids[view] = grids[view] + grid if view in grids else grid.copy()
+
+    return {
+        "n_detections": sum(counts["n_detections"] for counts in counts_list),
+        "distributions": compute.merge_distributions_counts(
+            [counts["distributions"] for counts in counts_list]
+        ),
+        "regions": regions.groupby(level=[0, 1, 2], observed=True, sort=False).sum(),
+        "grids": grids,
+    }
+
+
+def get_density_volumes(
+    df_detections: pd.DataFrame,
+    cfg,
+    downsample: int = 1,
+    sigma: float | None = None,
+) -> dict:
+    """
+    Get the 3D density of detections in each channel, aligned with the atlas.
+
+    Wraps `compute.get_density_volume()`, see `io.save_density_volumes()` to store the
+    volumes.
+
+    Parameters
+    ----------
+    df_detections : pd.DataFrame
+        Detections, prepared with `prepare_detections()` (coordinates in mm).
+    cfg : cuisto.Config
+        The configuration loaded from TOML configuration file.
+    downsample : int, optional
+        Voxels are `downsample` times larger than the atlas voxels. Default is 1.
+    sigma : float or None, optional
+        Standard deviation of the gaussian smoothing, in microns. If None (default),
+        the volumes are not smoothed.
+
+    Returns
+    -------
+    volumes : dict
+        {channel: volume}.
+
+    """
+    atlas = cfg.bg_atlas
+    if atlas is None:
+        raise ValueError("An atlas is required to compute density volumes.")
+
+    # atlas coordinates in microns, in the atlas axes order
+    coords = [
+        df_detections[col].to_numpy() * 1000
+        for col in (cfg.Xname, cfg.Yname, cfg.Zname)
+    ]
+    codes, channels = pd.factorize(df_detections["channel"])
+
+    return {
+        channel: compute.get_density_volume(
+            *(values[codes == code] for values in coords),
+            atlas.annotation.shape,
+            atlas.resolution,
+            downsample=downsample,
+            sigma=sigma,
+        )
+        for code, channel in enumerate(channels)
+    }
+
 
 def process_animal(
     animal: str,
@@ -19,6 +1011,7 @@ def process_animal(
     cfg,
     compute_distributions: bool = True,
     leaf_regions_only: bool = True,
+    stage_cache: io.StageCache | None = None,
 ) -> tuple[pd.DataFrame, list[pd.DataFrame], pd.DataFrame]:
     """
     Quantify objects for one animal.
@@ -26,6 +1019,12 @@ def process_animal(
     Fetch required files and compute objects' distributions in brain regions, spatial
     distributions and gather Atlas coordinates.
 
+    With `stage_cache`, the output of each processing stage is memoized on disk, see
+    `process_animal_stages()`.
+
+    Columns of the coordinates and regions metrics tables are cast following the
+    `dtypes` policy of the configuration, see `io.apply_dtypes_policy()`.
+
     Parameters
     ----------
     animal : str
@@ -40,6 +1039,9 @@ def process_animal(
     leaf_regions_only : bool, optional
         If True and a Brainglobe atlas is specified, bar plot per regions will keep only
         leaf regions, eg. regions with no child -- if there are any. Default is True.
+    stage_cache : io.StageCache or None, optional
+        If set, re-use the outputs of the stages whose inputs and parameters did not
+        change. Default is None (no memoization).
 
     Returns
     -------
@@ -52,118 +1054,36 @@ def process_animal(
         Atlas coordinates of each points.
 
     """
-    # - Annotations data cleanup
-    # filter regions
-    df_annotations = utils.filter_df_regions(
-        df_annotations, ["Root", "root"], mode="remove", col="Name"
-    )
-    df_annotations = utils.filter_df_regions(
-        df_annotations, cfg.atlas["blacklist"], mode="remove", col="Name"
-    )
-    # add hemisphere
-    df_annotations = utils.add_hemisphere(df_annotations, cfg.hemispheres["names"])
-    # remove objects in non-leaf regions if any
-    if leaf_regions_only & (len(cfg.atlas["leaveslist"]) > 0):
-        df_annotations = utils.filter_df_regions(
-            df_annotations, cfg.atlas["leaveslist"], mode="keep", col="Name"
-        )
-    # merge regions
-    df_annotations = utils.merge_regions(
-        df_annotations, col="Name", fusion_file=cfg.files["fusion"]
-    )
-    if compute_distributions:
-        # - Detections data cleanup
-        # remove objects not in selected classifications
-        df_detections = utils.filter_df_classifications(
-            df_detections, cfg.object_type, mode="keep", col="Classification"
-        )
-        # remove objects from blacklisted regions
-        df_detections = utils.filter_df_regions(
-            df_detections, cfg.atlas["blacklist"], mode="remove", col="Parent"
-        )
-        # add hemisphere
-        df_detections = utils.add_hemisphere(
+    if stage_cache is not None:
+        df_regions, dfs_distributions, df_detections = process_animal_stages(
+            animal,
+            df_annotations,
             df_detections,
-            cfg.hemispheres["names"],
-            cfg.atlas["midline"],
-            col=cfg.Zname,
-            atlas_type=cfg.atlas["type"],
-        )
-        # add detection channel
-        df_detections = utils.add_channel(
-            df_detections, cfg.object_type, cfg.channels["names"]
-        )
-        # convert coordinates to mm
-        df_detections[["Atlas_X", "Atlas_Y", "Atlas_Z"]] = df_detections[
-            ["Atlas_X", "Atlas_Y", "Atlas_Z"]
-        ].divide(1000)
-        # convert to sterotaxic coordinates
-        if cfg.distributions["stereo"]:
-            (
-                df_detections["Atlas_AP"],
-                df_detections["Atlas_DV"],
-                df_detections["Atlas_ML"],
-            ) = utils.ccf_to_stereo(
-                df_detections[cfg.Xname],
-                df_detections[cfg.Yname],
-                df_detections[cfg.Zname],
-            )
-        else:
-            (
-                df_detections["Atlas_AP"],
-                df_detections["Atlas_DV"],
-                df_detections["Atlas_ML"],
-            ) = (
-                df_detections[cfg.Xname],
-                df_detections[cfg.Yname],
-                df_detections[cfg.Zname],
-            )
-
-    # - Computations
-    # get regions distributions
-    df_regions = compute.get_regions_metrics(
-        df_annotations,
-        cfg.object_type,
-        cfg.channels["names"],
-        cfg.regions["base_measurement"],
-        cfg.regions["metrics"],
-    )
-    colstonorm = [v for v in cfg.regions["metrics"].values() if "relative" not in v]
-
-    # normalize by starter cells
-    if cfg.regions["normalize_starter_cells"]:
-        df_regions = compute.normalize_starter_cells(
-            df_regions, colstonorm, animal, cfg.files["infos"], cfg.channels["names"]
+            cfg,
+            stage_cache,
+            compute_distributions=compute_distributions,
+            leaf_regions_only=leaf_regions_only,
         )
+    else:
+        # - Regions metrics
+        df_regions = get_animal_regions(animal, df_annotations, cfg, leaf_regions_only)
 
-    # get AP, DV, ML distributions in stereotaxic coordinates
-    if compute_distributions:
-        dfs_distributions = [
-            compute.get_distribution(
+        # get AP, DV, ML distributions in stereotaxic coordinates
+        if compute_distributions:
+            # - Detections data cleanup
+            df_detections = prepare_detections(df_detections, cfg)
+            cols, binlims, nbins = get_distributions_bins(cfg)
+            dfs_distributions = compute.get_distributions(
                 df_detections,
-                axis,
+                cols,
                 cfg.distributions["hue"],
                 cfg.distributions["hue_filter"],
                 cfg.distributions["common_norm"],
-                stereo_lim,
-                nbins=nbins,
+                binlims,
+                nbins,
             )
-            for axis, stereo_lim, nbins in zip(
-                ["Atlas_AP", "Atlas_DV", "Atlas_ML"],
-                [
-                    cfg.distributions["ap_lim"],
-                    cfg.distributions["dv_lim"],
-                    cfg.distributions["ml_lim"],
-                ],
-                [
-                    cfg.distributions["ap_nbins"],
-                    cfg.distributions["dv_nbins"],
-                    cfg.distributions["dv_nbins"],
-                ],
-            )
-        ]
-    else:
-        dfs_distributions = []
+        else:
+            dfs_distributions = []
 
     # add animal tag to each DataFrame
     df_detections["animal"] = animal
@@ -171,20 +1091,383 @@ def process_animal(
     for df in dfs_distributions:
         df["animal"] = animal
 
+    # compact types for the coordinates and metrics tables
+    df_detections = io.apply_dtypes_policy(
+        df_detections, cfg.dtypes, io.get_usecols(cfg, "detection")
+    )
+    df_regions = io.apply_dtypes_policy(df_regions, cfg.dtypes)
+
     return df_regions, dfs_distributions, df_detections
 
 
+def process_animal_streaming(
+    animal: str,
+    df_annotations: pd.DataFrame,
+    detections_chunks,
+    cfg,
+    leaf_regions_only: bool = True,
+) -> tuple[pd.DataFrame, list[pd.DataFrame], dict]:
+    """
+    Quantify objects for one animal, reading detections one chunk at a time.
+
+    Same as `process_animal()`, but detections are prepared and counted chunk by chunk
+    (eg. one image at a time, see `io.iter_data_dir()`) and only the counts are kept,
+    so that memory usage does not depend on the total number of detections. Atlas
+    coordinates of each points are thus not returned.
+
+    Parameters
+    ----------
+    animal : str
+        Animal ID.
+    df_annotations : pd.DataFrame
+        DataFrame of QuPath Annotations.
+    detections_chunks : iterable of pd.DataFrame
+        DataFrames of QuPath Detections.
+    cfg : cuisto.Config
+        The configuration loaded from TOML configuration file.
+    leaf_regions_only : bool, optional
+        See `process_animal()`.
+
+    Returns
+    -------
+    df_regions : pandas.DataFrame
+        Metrics in brain regions. One entry for each hemisphere of each brain regions.
+    df_distribution : list of pandas.DataFrame
+        Rostro-caudal distribution, as raw count and probability density function, in
+        each axis.
+    counts : dict
+        Merged counts of detections, see `get_detections_counts()`.
+
+    """
+    # - Regions metrics
+    df_regions = get_animal_regions(animal, df_annotations, cfg, leaf_regions_only)
+
+    # - Detections counts, chunk by chunk
+    with warnings.catch_warnings():
+        # a chunk may not have data in the distributions subset, check only the total
+        warnings.filterwarnings("ignore", message=".*resulted in an empty subset")
+        counts = merge_detections_counts(
+            get_detections_counts(
+                prepare_detections(df_chunk, cfg, allow_empty=True),
+                cfg,
+            )
+            for df_chunk in detections_chunks
+        )
+    if counts["n_detections"] == 0:
+        raise ValueError(
+            f"Filtering 'Classification' with {[cfg.object_type]} resulted in an"
+            " empty DataFrame, check your config file."
+        )
+    if counts["distributions"]["length_total"] == 0:
+        warnings.warn(
+            f"hue={cfg.distributions['hue']} and "
+            f"hue_filter={cfg.distributions['hue_filter']} resulted in an empty subset."
+        )
+
+    # get AP, DV, ML distributions in stereotaxic coordinates
+    _, binlims, _ = get_distributions_bins(cfg)
+    dfs_distributions = compute.get_distributions_from_counts(
+        counts["distributions"],
+        cfg.distributions["hue"],
+        cfg.distributions["hue_filter"],
+        cfg.distributions["common_norm"],
+        binlims,
+    )
+
+    # add animal tag to each DataFrame
+    df_regions["animal"] = animal
+    for df in dfs_distributions:
+        df["animal"] = animal
+    df_regions = io.apply_dtypes_policy(df_regions, cfg.dtypes)
+
+    return df_regions, dfs_distributions, counts
+
+
+def process_animal_from_dir(
+    wdir: str,
+    animal: str,
+    cfg,
+    compute_distributions: bool = True,
+    cache: bool = False,
+    stream: bool = False,
+    chunk_size: int | None = None,
+    store: bool = False,
+    **kwargs,
+) -> tuple[pd.DataFrame, list[pd.DataFrame], pd.DataFrame]:
+    """
+    Read the data of one animal from the working directory and quantify it.
+
+    Annotations and detections are read from the expected directory structure, then
+    passed to `process_animal()`. This is the unit of work of `process_animals()`, it
+    is defined at the module level so that it can be sent to worker processes.
+
+    With `stream`, detections files are read one at a time and passed to
+    `process_animal_streaming()` instead. Coordinates are not returned, the 2D
+    heatmaps of the detections are returned in their place, see
+    `get_heatmaps_dataframe()`.
+
+    Parameters
+    ----------
+    wdir : str
+        Base working directory, containing the `animal` folder.
+    animal : str
+        Animal ID.
+    cfg : cuisto.Config
+        Configuration object.
+    compute_distributions : bool, optional
+        If False, do not read detections and do not compute the 1D distributions.
+        Default is True.
+    cache : bool, optional
+        If True, read measurements through the persistent cache, so that only files
+        that changed since the last run are parsed. Default is False.
+    stream : bool, optional
+        If True, read and count detections one file at a time so that memory usage
+        does not depend on the number of detections. Coordinates are not returned,
+        2D heatmaps are returned instead. Default is False.
+    chunk_size : int or None, optional
+        With `stream`, json files are parsed incrementally and counted by chunks of at
+        most `chunk_size` points, so that memory usage does not depend on the size of
+        the files either (see `io.iter_fibers_json()`). Default is None (whole files).
+    store : bool, optional
+        For fibers, convert the json files to a memory-mapped `io.FibersStore` in the
+        cache directory, re-used as long as the files do not change. With `stream`,
+        points are then read from the store one image at a time. Default is False.
+    kwargs : passed to cuisto.process.process_animal().
+
+    Returns
+    -------
+    df_regions, dfs_distributions, df_coordinates
+        See `process_animal()`. With `stream`, df_coordinates is replaced by the 2D
+        heatmaps, see `get_heatmaps_dataframe()`.
+
+    """
+    # combine all detections and annotations from this animal
+    df_annotations = io.cat_csv_dir(
+        io.get_measurements_directory(wdir, animal, "annotation", cfg.segmentation_tag),
+        index_col="Object ID",
+        sep="\t",
+        usecols=io.get_usecols(cfg, "annotation"),
+        cache=cache,
+    )
+    # parse only the columns used by the pipeline if requested
+    drop_unused = (io.DTYPES_POLICY | cfg.dtypes)["drop_unused"]
+    usecols = io.get_usecols(cfg, "detection") if drop_unused else None
+    if compute_distributions and stream:
+        detections_chunks = io.iter_data_dir(
+            io.get_measurements_directory(
+                wdir, animal, "detection", cfg.segmentation_tag
+            ),
+            cfg.segmentation_tag,
+            index_col="Object ID",
+            sep="\t",
+            dtype=io.QUPATH_DTYPES,
+            usecols=usecols,
+            hemisphere_names=cfg.hemispheres["names"],
+            atlas=cfg.bg_atlas,
+            cache=cache,
+            chunk_size=chunk_size,
+            store=store,
+        )
+        # stages are not memoized when streaming
+        kwargs.pop("stage_cache", None)
+        df_regions, dfs_distributions, counts = process_animal_streaming(
+            animal, df_annotations, detections_chunks, cfg, **kwargs
+        )
+        df_heatmaps = get_heatmaps_dataframe(counts["grids"], cfg)
+        df_heatmaps["animal"] = animal
+        df_heatmaps = io.apply_dtypes_policy(df_heatmaps, cfg.dtypes)
+        return df_regions, dfs_distributions, df_heatmaps
+    elif compute_distributions:
+        df_detections = io.cat_data_dir(
+            io.get_measurements_directory(
+                wdir, animal, "detection", cfg.segmentation_tag
+            ),
+            cfg.segmentation_tag,
+            index_col="Object ID",
+            sep="\t",
+            dtype=io.QUPATH_DTYPES,
+            usecols=usecols,
+            hemisphere_names=cfg.hemispheres["names"],
+            atlas=cfg.bg_atlas,
+            cache=cache,
+            store=store,
+        )
+        if isinstance(df_detections, io.FibersStore):
+            # coordinates are returned, load all points
+            df_detections = df_detections.to_dataframe(
+                cfg.hemispheres["names"], cfg.bg_atlas
+            )
+    else:
+        df_detections = pd.DataFrame()
+
+    return process_animal(
+        animal,
+        df_annotations,
+        df_detections,
+        cfg,
+        compute_distributions=compute_distributions,
+        **kwargs,
+    )
+
+
+def get_animal_signature(
+    wdir: str, animal: str, cfg, compute_distributions: bool = True, **kwargs
+) -> str:
+    """
+    Get a hash identifying the inputs of the quantification of one animal.
+
+    It combines the state (names, sizes and modification times, from the directories
+    manifests) of the measurements files of the animal, the configuration (including
+    the state of the files it points to) and the processing options. It changes
+    whenever the results of `process_animal_from_dir()` could change.
+
+    Parameters
+    ----------
+    wdir : str
+        Base working directory, containing the `animal` folder.
+    animal : str
+        Animal ID.
+    cfg : cuisto.Config
+        Configuration object.
+    compute_distributions : bool, optional
+        See `process_animal_from_dir()`. Default is True.
+    **kwargs : other processing options, see `process_animal_from_dir()`.
+
+    Returns
+    -------
+    signature : str
+        Hexadecimal hash.
+
+    """
+    measurements = {}
+    for kind in ("annotation", "detection"):
+        directory = io.get_measurements_directory(
+            wdir, animal, kind, cfg.segmentation_tag
+        )
+        if os.path.isdir(directory):
+            measurements[kind] = io.get_files_state(
+                io.scan_directory(directory).sort_values("filename")
+            )
+
+    # configuration content, with the state of the files it uses
+    settings = {k: v for k, v in cfg.__getstate__().items() if k != "config_file"}
+    files = io.get_files_state(
+        [filename for filename in cfg.files.values() if os.path.isfile(filename)]
+    )
+
+    return io.get_signature(
+        animal=animal,
+        measurements=measurements,
+        settings=settings,
+        files=files,
+        compute_distributions=compute_distributions,
+        **kwargs,
+    )
+
+
+def get_animal_results_filename(wdir: str, animal: str) -> str:
+    """
+    Get the file where the results of one animal are stored, see `process_animals()`.
+
+    Parameters
+    ----------
+    wdir : str
+        Base working directory.
+    animal : str
+        Animal ID.
+
+    Returns
+    -------
+    filename : str
+        "quantification/animals/{animal}.pkl" in `wdir`.
+
+    """
+    return os.path.join(wdir, "quantification", "animals", f"{animal}.pkl")
+
+
+def load_animal_results(wdir: str, animal: str, signature: str) -> tuple | None:
+    """
+    Load the stored results of one animal, if they are up-to-date.
+
+    Parameters
+    ----------
+    wdir : str
+        Base working directory.
+    animal : str
+        Animal ID.
+    signature : str
+        Current signature of the animal, see `get_animal_signature()`.
+
+    Returns
+    -------
+    results : tuple or None
+        (df_regions, dfs_distributions, df_coordinates) as returned by
+        `process_animal()`, None if there are no results stored with `signature`.
+
+    """
+    filename = get_animal_results_filename(wdir, animal)
+    try:
+        stored = pd.read_pickle(filename)
+    except (OSError, EOFError, pickle.UnpicklingError):
+        return None
+
+    if stored["signature"] != signature:
+        return None
+    return stored["results"]
+
+
+def save_animal_results(wdir: str, animal: str, signature: str, results: tuple):
+    """
+    Store the results of one animal along with the signature of its inputs.
+
+    Parameters
+    ----------
+    wdir : str
+        Base working directory.
+    animal : str
+        Animal ID.
+    signature : str
+        Signature of the animal, see `get_animal_signature()`.
+    results : tuple
+        (df_regions, dfs_distributions, df_coordinates) as returned by
+        `process_animal()`.
+
+    """
+    filename = get_animal_results_filename(wdir, animal)
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    tmp_file = f"{filename}.{os.getpid()}.tmp"
+    pd.to_pickle({"signature": signature, "results": results}, tmp_file)
+    os.replace(tmp_file, filename)
+
+
 def process_animals(
     wdir: str,
     animals: list[str] | tuple[str],
     cfg,
     out_fmt: str | None = None,
     compute_distributions: bool = True,
+    n_jobs: int | None = 1,
+    cache: bool = False,
+    incremental: bool = False,
+    skip_failures: bool = False,
     **kwargs,
 ) -> tuple[pd.DataFrame]:
     """
     Get data from all animals and plot.
 
+    Animals are processed one after the other, or in parallel in separate processes if
+    `n_jobs` is not 1. In both cases, results are concatenated in the order of
+    `animals`. With `skip_failures`, animals whose data can't be read or processed
+    (OSError, ValueError or KeyError) are skipped with a warning and the other animals
+    are still processed, an error is raised only if all animals failed.
+
+    With `incremental`, the results of each animal are stored in
+    "quantification/animals" in `wdir`, along with a signature of their inputs
+    (measurements files, configuration and options, see `get_animal_signature()`).
+    Animals whose inputs did not change since they were stored are loaded instead of
+    being processed again, so that adding an animal to a cohort only processes the new
+    animal.
+
     Parameters
     ----------
     wdir : str
@@ -193,12 +1476,27 @@ def process_animals(
         List of animals ID.
     cfg: cuisto.Config
         Configuration object.
-    out_fmt : {None, "h5", "csv", "tsv", "xslx", "pickle"}
-        Output file(s) format, if None, nothing is saved (default).
+    out_fmt : {None, "parquet", "h5", "csv", "tsv", "xslx", "pickle"}
+        Output file(s) format, if None, nothing is saved (default). "parquet" stores
+        the results in a `io.ResultsStore`, that can be loaded partially. There is one
+        store per object type and atlas type, animals are added to it at each run.
     compute_distributions : bool, optional
         If False, do not compute the 1D distributions and return an empty list.Default
         is True.
-    kwargs : passed to cuisto.process.process_animal().
+    n_jobs : int or None, optional
+        Number of worker processes. If 1, animals are processed sequentially in the
+        current process (default). If None or -1, use as many processes as CPUs.
+    cache : bool, optional
+        If True, read measurements through the persistent cache, so that only files
+        that changed since the last run are parsed. Default is False.
+    incremental : bool, optional
+        If True, re-use the stored results of animals whose inputs did not change and
+        store the results of the others. Default is False.
+    skip_failures : bool, optional
+        If True, skip the animals that fail instead of raising the error. Skipped
+        animals are not part of the output file name. Default is False.
+    kwargs : passed to cuisto.process.process_animal_from_dir() (eg. `stream`), then
+        to cuisto.process.process_animal().
 
     Returns
     -------
@@ -208,76 +1506,127 @@ def process_animals(
         Rostro-caudal distribution, as raw count and probability density function, in
         each axis.
     df_coordinates : pandas.DataFrame
-        Atlas coordinates of each points.
+        Atlas coordinates of each points. With `stream`, 2D heatmaps of the detections
+        instead, saved as "df_heatmaps", see `get_heatmaps_dataframe()`.
 
     """
 
     # -- Preparation
-    df_regions = []
-    dfs_distributions = []
-    df_coordinates = []
+    if not (n_jobs is None or n_jobs == -1 or n_jobs >= 1):
+        raise ValueError(
+            f"n_jobs = {n_jobs} not supported, choose a positive number of processes,"
+            " or -1 or None to use all CPUs."
+        )
+    results = {}  # {animal: (df_regions, dfs_distributions, df_coordinates)}
+    failures = {}  # {animal: exception}
 
-    # -- Processing
-    pbar = tqdm(animals)
+    # get up-to-date stored results
+    if incremental:
+        signatures = {
+            animal: get_animal_signature(
+                wdir, animal, cfg, compute_distributions=compute_distributions, **kwargs
+            )
+            for animal in animals
+        }
+        for animal in animals:
+            stored = load_animal_results(wdir, animal, signatures[animal])
+            if stored is not None:
+                results[animal] = stored
+    to_process = [animal for animal in animals if animal not in results]
 
-    for animal in pbar:
-        pbar.set_description(f"Processing {animal}")
+    # -- Processing
+    if n_jobs == 1:
+        pbar = tqdm(to_process)
+        for animal in pbar:
+            pbar.set_description(f"Processing {animal}")
+            try:
+                results[animal] = process_animal_from_dir(
+                    wdir,
+                    animal,
+                    cfg,
+                    compute_distributions=compute_distributions,
+                    cache=cache,
+                    **kwargs,
+                )
+            except SKIPPABLE_ERRORS as err:
+                if not skip_failures:
+                    raise
+                failures[animal] = err
+    else:
+        if n_jobs == -1:
+            n_jobs = None  # use all CPUs
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            futures = {
+                executor.submit(
+                    process_animal_from_dir,
+                    wdir,
+                    animal,
+                    cfg,
+                    compute_distributions=compute_distributions,
+                    cache=cache,
+                    **kwargs,
+                ): animal
+                for animal in to_process
+            }
+            pbar = tqdm(as_completed(futures), total=len(futures))
+            for future in pbar:
+                animal = futures[future]
+                pbar.set_description(f"Processed {animal}")
+                try:
+                    results[animal] = future.result()
+                except SKIPPABLE_ERRORS as err:
+                    if not skip_failures:
+                        raise
+                    failures[animal] = err
 
-        # combine all detections and annotations from this animal
-        df_annotations = io.cat_csv_dir(
-            io.get_measurements_directory(
-                wdir, animal, "annotation", cfg.segmentation_tag
-            ),
-            index_col="Object ID",
-            sep="\t",
-        )
-        if compute_distributions:
-            df_detections = io.cat_data_dir(
-                io.get_measurements_directory(
-                    wdir, animal, "detection", cfg.segmentation_tag
-                ),
-                cfg.segmentation_tag,
-                index_col="Object ID",
-                sep="\t",
-                hemisphere_names=cfg.hemispheres["names"],
-                atlas=cfg.bg_atlas,
-            )
-        else:
-            df_detections = pd.DataFrame()
+    # store new results
+    if incremental:
+        for animal in to_process:
+            if animal in results:
+                save_animal_results(wdir, animal, signatures[animal], results[animal])
 
-        # get results
-        df_reg, dfs_dis, df_coo = process_animal(
-            animal,
-            df_annotations,
-            df_detections,
-            cfg,
-            compute_distributions=compute_distributions,
-            **kwargs,
-        )
+    # report failures
+    for animal, err in failures.items():
+        warnings.warn(f"{animal} failed and was skipped : {type(err).__name__}: {err}")
+    if len(results) == 0:
+        raise RuntimeError("Processing failed for all animals, see warnings.")
 
-        # collect results
-        df_regions.append(df_reg)
-        dfs_distributions.append(dfs_dis)
-        df_coordinates.append(df_coo)
+    # collect results in the input order
+    df_regions = []
+    dfs_distributions = []
+    df_coordinates = []
+    for animal in animals:
+        if animal in results:
+            df_reg, dfs_dis, df_coo = results[animal]
+            df_regions.append(df_reg)
+            dfs_distributions.append(dfs_dis)
+            df_coordinates.append(df_coo)
 
     # concatenate all results
-    df_regions = pd.concat(df_regions, ignore_index=True)
+    df_regions = io.concat_dfs(df_regions, ignore_index=True)
     dfs_distributions = [
         pd.concat(dfs_list, ignore_index=True) for dfs_list in zip(*dfs_distributions)
     ]
-    df_coordinates = pd.concat(df_coordinates, ignore_index=True)
+    df_coordinates = io.concat_dfs(df_coordinates, ignore_index=True)
 
     # -- Saving
     if out_fmt:
         outdir = os.path.join(wdir, "quantification")
-        outfile = f"{cfg.object_type.lower()}_{cfg.atlas['type']}_{'-'.join(animals)}.{out_fmt}"
-        dfs = dict(
-            df_regions=df_regions,
-            df_coordinates=df_coordinates,
-            df_distribution_ap=dfs_distributions[0],
-            df_distribution_dv=dfs_distributions[1],
-            df_distribution_ml=dfs_distributions[2],
-        )
+        if out_fmt == "parquet":
+            # one store for all animals, partitioned by animal
+            outfile = f"{cfg.object_type.lower()}_{cfg.atlas['type']}.{out_fmt}"
+        else:
+            processed = [animal for animal in animals if animal in results]
+            outfile = f"{cfg.object_type.lower()}_{cfg.atlas['type']}_{'-'.join(processed)}.{out_fmt}"
+        # when streaming, 2D heatmaps are returned in place of the coordinates
+        streamed = compute_distributions and kwargs.get("stream", False)
+        dfs = {
+            "df_regions": df_regions,
+            "df_heatmaps" if streamed else "df_coordinates": df_coordinates,
+            "df_distribution_ap": dfs_distributions[0],
+            "df_distribution_dv": dfs_distributions[1],
+            "df_distribution_ml": dfs_distributions[2],
+        }
         io.save_dfs(outdir, outfile, dfs)
 
     return df_regions, dfs_distributions, df_coordinates
@@ -4,18 +4,141 @@ Contains utilities functions.
 
 """
 
+import os
 import tomllib
 import warnings
+import weakref
+from collections.abc import Callable
+from pathlib import Path
 
 import numpy as np
+import orjson
 import pandas as pd
 from brainglobe_atlasapi import BrainGlobeAtlas
 
 
+class InfoStore:
+    """
+    Parsed info file, with experimental settings of each animal.
+
+    The TOML file is parsed once and read again only when it is modified. Starter
+    cells and injection sites are looked up for several channels or animals at once.
+
+    Parameters
+    ----------
+    info_file : str
+        Path to TOML info file.
+
+    """
+
+    def __init__(self, info_file: str):
+        """Constructor."""
+        self.info_file = info_file
+        self.info = {}
+        self._mtime = None
+        self.update()
+
+    def update(self):
+        """Parse the file again if it was modified since it was last read."""
+        mtime = os.stat(self.info_file).st_mtime_ns
+        if mtime != self._mtime:
+            with open(self.info_file, "rb") as fid:
+                self.info = tomllib.load(fid)
+            self._mtime = mtime
+
+    def get_starter_cells(self, animal: str, channels: list[str]) -> np.ndarray:
+        """
+        Get the number of starter cells associated with animal, for each channel.
+
+        Parameters
+        ----------
+        animal : str
+            Animal ID.
+        channels : list-like of str
+            Channel IDs, eg. one per row of a DataFrame. Each unique channel is looked
+            up once.
+
+        Returns
+        -------
+        n_starters : np.ndarray
+            Number of starter cells, for each element of `channels`.
+
+        """
+        self.update()
+        codes, uniques = pd.factorize(np.asarray(channels, dtype=object))
+        n_starters = np.array(
+            [self.info[animal][channel]["starter_cells"] for channel in uniques]
+        )
+        return n_starters[codes]
+
+    def get_injection_sites(
+        self, animals: list[str], channel: str, stereo: bool = False
+    ) -> pd.DataFrame:
+        """
+        Get the injection site coordinates associated with each animal.
+
+        Parameters
+        ----------
+        animals : list-like of str
+            Animal IDs.
+        channel : str
+            Channel ID as in the TOML file.
+        stereo : bool, optional
+            Wether to convert coordinates in stereotaxis coordinates. Default is False.
+
+        Returns
+        -------
+        df : pd.DataFrame
+            "x", "y" and "z" coordinates, indexed by animal. Coordinates are NaN for
+            animals without `channel`.
+
+        """
+        self.update()
+        coords = np.array(
+            [
+                self.info[animal][channel]["injection_site"]
+                if channel in self.info[animal]
+                else [np.nan, np.nan, np.nan]
+                for animal in animals
+            ],
+            dtype=float,
+        ).reshape(-1, 3)
+        x, y, z = coords.T
+        if stereo:
+            x, y, z = ccf_to_stereo(x, y, z)
+
+        return pd.DataFrame({"x": x, "y": y, "z": z}, index=list(animals))
+
+
+_INFO_STORES = {}
+
+
+def get_info_store(info_file: str) -> InfoStore:
+    """
+    Get the `InfoStore` of an info file, parsing it on first use.
+
+    Parameters
+    ----------
+    info_file : str
+        Path to TOML info file.
+
+    Returns
+    -------
+    info_store : InfoStore
+
+    """
+    info_file = os.path.abspath(info_file)
+    if info_file not in _INFO_STORES:
+        _INFO_STORES[info_file] = InfoStore(info_file)
+    return _INFO_STORES[info_file]
+
+
 def get_starter_cells(animal: str, channel: str, info_file: str) -> int:
     """
     Get the number of starter cells associated with animal.
 
+    The info file is read through its `InfoStore`, see `get_info_store()`.
+
     Parameters
     ----------
     animal : str
@@ -31,10 +154,10 @@ def get_starter_cells(animal: str, channel: str, info_file: str) -> int:
         Number of starter cells.
 
     """
-    with open(info_file, "rb") as fid:
-        info = tomllib.load(fid)
+    info_store = get_info_store(info_file)
+    info_store.update()
 
-    return info[animal][channel]["starter_cells"]
+    return info_store.info[animal][channel]["starter_cells"]
 
 
 def get_injection_site(
@@ -43,6 +166,8 @@ def get_injection_site(
     """
     Get the injection site coordinates associated with animal.
 
+    The info file is read through its `InfoStore`, see `get_info_store()`.
+
     Parameters
     ----------
     animal : str
@@ -60,8 +185,9 @@ def get_injection_site(
         Injection site coordinates.
 
     """
-    with open(info_file, "rb") as fid:
-        info = tomllib.load(fid)
+    info_store = get_info_store(info_file)
+    info_store.update()
+    info = info_store.info
 
     if channel in info[animal]:
         x, y, z = info[animal][channel]["injection_site"]
@@ -185,7 +311,7 @@ def get_leaves_list(atlas: BrainGlobeAtlas | None) -> list:
     Returns
     -------
     leaves_list : list
-        Acronyms of leaf brain regions.
+        Acronyms of leaf brain regions, in the order of `atlas.structures_list`.
 
     """
     leaves_list = []
@@ -193,9 +319,13 @@ def get_leaves_list(atlas: BrainGlobeAtlas | None) -> list:
     if atlas is None:
         return leaves_list
 
-    for region in atlas.structures_list:
-        if atlas.structures.tree[region["id"]].is_leaf():
-            leaves_list.append(region["acronym"])
+    hierarchy = get_region_hierarchy(atlas)
+    is_leaf = dict(zip(hierarchy.acronyms, hierarchy.is_leaf.tolist()))
+    leaves_list = [
+        region["acronym"]
+        for region in atlas.structures_list
+        if is_leaf[region["acronym"]]
+    ]
 
     return leaves_list
 
@@ -204,28 +334,123 @@ def get_child_regions(atlas: BrainGlobeAtlas | None, parent_region: str) -> list
     """
     Get list of regions that are child of `parent_region`.
 
-    If no atlas is provided, returns an empty list.
+    If no atlas is provided, returns an empty list. A KeyError is raised if
+    `parent_region` is not in the atlas.
 
     Parameters
     ----------
     atlas : BrainGlobeAtlas or None
         Atlas to extract regions from.
+    parent_region : str
+        Acronym of the parent region.
 
     Returns
     -------
     child_list : list
-        List of regions.
+        `parent_region` and its descendants, in depth-first order of the atlas
+        hierarchy.
 
     """
     if atlas is None:
         return []
 
-    return [
-        atlas.structures[id]["acronym"]
-        for id in atlas.structures.tree.expand_tree(
-            atlas.structures[parent_region]["id"]
-        )
-    ]
+    return get_region_hierarchy(atlas).get_subtree(parent_region)
+
+
+def get_cached_regions(atlas_name: str, key: str, func: Callable) -> list:
+    """
+    Get a list of regions derived from an atlas, computing it only once.
+
+    Lists are stored in $HOME/.cuisto/{atlas_name}_regions.json, under `key`. If `key`
+    is not there, `func` is called to compute the list, which is then stored. If no
+    atlas is specified, `func` is called directly.
+
+    Parameters
+    ----------
+    atlas_name : str
+        Name of the atlas, empty if there is no atlas.
+    key : str
+        Identifier of the list, including the hash of any file it depends on.
+    func : callable
+        Computes the list, without arguments.
+
+    Returns
+    -------
+    regions : list
+        List of acronyms.
+
+    """
+    if not atlas_name:
+        return func()
+
+    local_dir = Path.home() / ".cuisto"
+    cache_file = local_dir / (atlas_name + "_regions.json")
+    try:
+        with open(cache_file, "rb") as fid:
+            cache = orjson.loads(fid.read())
+    except (OSError, orjson.JSONDecodeError):
+        cache = {}
+
+    if key not in cache:
+        cache[key] = func()
+        local_dir.mkdir(exist_ok=True)
+        tmp_file = cache_file.with_suffix(f".{os.getpid()}.tmp")
+        with open(tmp_file, "wb") as fid:
+            fid.write(orjson.dumps(cache))
+        os.replace(tmp_file, cache_file)
+
+    return cache[key]
+
+
+def roll_up_regions(regions, atlas: BrainGlobeAtlas, depth: int) -> pd.Categorical:
+    """
+    Replace regions by their ancestor at `depth` in the atlas hierarchy.
+
+    Regions less deep than `depth` are unchanged, acronyms that are not in the atlas
+    become NaN. Can be used to aggregate data at a given level of the ontology, eg.
+    `df.groupby(roll_up_regions(df["Parent"], atlas, 5), observed=True)`.
+
+    Parameters
+    ----------
+    regions : list-like
+        Regions acronyms, eg. a "Parent" or "Name" column.
+    atlas : BrainGlobeAtlas
+    depth : int
+        Depth in the hierarchy, 0 is the root.
+
+    Returns
+    -------
+    ancestors : pd.Categorical
+        Acronyms of the ancestors.
+
+    """
+    hierarchy = get_region_hierarchy(atlas)
+    return pd.Categorical.from_codes(
+        hierarchy.get_ancestors(hierarchy.get_codes(regions), depth),
+        dtype=hierarchy.dtype,
+    )
+
+
+def is_in_region(regions, atlas: BrainGlobeAtlas, parent_region: str) -> np.ndarray:
+    """
+    Check if regions are `parent_region` or one of its descendants.
+
+    Parameters
+    ----------
+    regions : list-like
+        Regions acronyms, eg. a "Parent" or "Name" column.
+    atlas : BrainGlobeAtlas
+    parent_region : str
+        Acronym of the ancestor region.
+
+    Returns
+    -------
+    mask : np.ndarray
+        Boolean array.
+
+    """
+    hierarchy = get_region_hierarchy(atlas)
+    return hierarchy.is_descendant(hierarchy.get_codes(regions), parent_region)
 
 
 def ccf_to_stereo(
@@ -345,7 +570,7 @@ def add_hemisphere(
             # regular ABBA atlas : beyond midline, it's left
             df.loc[df[col] >= midline, "hemisphere"] = hemisphere_names["Left"]
             df.loc[df[col] < midline, "hemisphere"] = hemisphere_names["Right"]
-        elif atlas_type in ("brainglibe", "cord"):
+        elif atlas_type in ("brainglobe", "cord"):
             # brainglobe atlas : below midline, it's left
             df.loc[df[col] <= midline, "hemisphere"] = hemisphere_names["Left"]
             df.loc[df[col] > midline, "hemisphere"] = hemisphere_names["Right"]
@@ -399,13 +624,381 @@ def add_channel(
     return df
 
 
+class RegionHierarchy:
+    """
+    Index of the atlas regions hierarchy.
+
+    Built once per atlas, see `get_region_hierarchy()`. Structures are indexed in the
+    depth-first order of the atlas hierarchy (nested sets) : the descendants of the
+    region with index `i` are the regions with indices in [i, end[i]). This turns
+    hierarchy queries into integer range comparisons, that can be vectorized over
+    whole columns of regions codes. Regions codes are the indices in this order, they
+    are also the codes of the categorical `dtype`.
+
+    Parameters
+    ----------
+    atlas : BrainGlobeAtlas
+        Atlas to read regions from.
+
+    """
+
+    def __init__(self, atlas: BrainGlobeAtlas):
+        """Constructor."""
+        tree = atlas.structures.tree
+
+        # structures in depth-first order
+        self.ids = np.array(list(tree.expand_tree()), dtype=np.int64)
+        self.acronyms = [atlas.structures[id]["acronym"] for id in self.ids]
+        self.dtype = pd.CategoricalDtype(self.acronyms)
+        self.root = 0
+        nregions = len(self.ids)
+
+        # parent and depth of each region
+        index = {id: idx for idx, id in enumerate(self.ids.tolist())}
+        self.parent = np.array(
+            [
+                index[tree.parent(id).identifier] if id != tree.root else 0
+                for id in self.ids.tolist()
+            ],
+            dtype=np.int32,
+        )
+        self.depth = np.zeros(nregions, dtype=np.int32)
+        for idx in range(1, nregions):
+            # parents come before their children
+            self.depth[idx] = self.depth[self.parent[idx]] + 1
+
+        # subtree sizes, children come after their parent
+        size = np.ones(nregions, dtype=np.int32)
+        for idx in range(nregions - 1, 0, -1):
+            size[self.parent[idx]] += size[idx]
+        self.start = np.arange(nregions, dtype=np.int32)
+        self.end = self.start + size
+        self.is_leaf = size == 1
+
+        self._ancestors = {}  # per depth
+
+    def get_codes(self, regions) -> np.ndarray:
+        """
+        Get the codes of regions acronyms. Unknown acronyms have code -1.
+
+        Parameters
+        ----------
+        regions : str or list-like
+            Acronym(s) of the regions.
+
+        Returns
+        -------
+        codes : np.ndarray
+            Regions indices.
+
+        """
+        if isinstance(regions, str):
+            regions = [regions]
+        if isinstance(regions, pd.Series):
+            regions = regions.array
+        if not (isinstance(regions, pd.Categorical) and (regions.dtype == self.dtype)):
+            regions = pd.Categorical(regions, dtype=self.dtype)
+        return np.asarray(regions.codes)
+
+    def get_code(self, region: str) -> int:
+        """Get the code of one region, raising a KeyError if it is not in the atlas."""
+        code = self.get_codes(region)[0]
+        if code < 0:
+            raise KeyError(region)
+        return int(code)
+
+    def get_subtree(self, region: str) -> list[str]:
+        """Get `region` and all its descendants acronyms, in depth-first order."""
+        code = self.get_code(region)
+        return self.acronyms[code : self.end[code]]
+
+    def is_descendant(self, codes: np.ndarray, region: str) -> np.ndarray:
+        """
+        Check if regions are `region` or one of its descendants.
+
+        Parameters
+        ----------
+        codes : np.ndarray
+            Regions codes, see `get_codes()`.
+        region : str
+            Acronym of the ancestor region.
+
+        Returns
+        -------
+        mask : np.ndarray
+            Boolean array.
+
+        """
+        code = self.get_code(region)
+        return (codes >= code) & (codes < self.end[code])
+
+    def get_ancestors(self, codes: np.ndarray, depth: int) -> np.ndarray:
+        """
+        Get the ancestors of regions at a given depth in the hierarchy.
+
+        Regions that are less deep than `depth` are unchanged. Unknown regions (code
+        -1) stay unknown.
+
+        Parameters
+        ----------
+        codes : np.ndarray
+            Regions codes, see `get_codes()`.
+        depth : int
+            Depth in the hierarchy, 0 is the root.
+
+        Returns
+        -------
+        ancestors_codes : np.ndarray
+            Regions codes of the ancestors.
+
+        """
+        if depth not in self._ancestors:
+            ancestors = np.arange(len(self.ids), dtype=np.int32)
+            while (self.depth[ancestors] > depth).any():
+                ancestors = np.where(
+                    self.depth[ancestors] > depth, self.parent[ancestors], ancestors
+                )
+            # sentinel for unknown regions
+            self._ancestors[depth] = np.append(ancestors, -1)
+
+        return self._ancestors[depth][codes]
+
+    def roll_up(self, values: np.ndarray) -> np.ndarray:
+        """
+        Sum values of each region and all its descendants.
+
+        Parameters
+        ----------
+        values : np.ndarray
+            Values of each region, indexed by regions codes along the first axis.
+
+        Returns
+        -------
+        totals : np.ndarray
+            Same shape as `values`, with the sum over the subtree of each region.
+
+        """
+        # descendants are contiguous : subtree sums are differences of cumulative sums
+        cumsum = np.zeros((len(values) + 1, *values.shape[1:]), dtype=values.dtype)
+        np.cumsum(values, axis=0, out=cumsum[1:])
+        return cumsum[self.end] - cumsum[self.start]
+
+
+class RegionLookup:
+    """
+    Vectorized lookup of atlas brain regions from atlas coordinates.
+
+    Built once per atlas, see `get_region_lookup()`. A dense array maps the structure
+    ids found in the annotation volume to their code in the atlas `RegionHierarchy`,
+    that is also the code of the corresponding acronym in the categorical regions.
+
+    Parameters
+    ----------
+    atlas : BrainGlobeAtlas
+        Atlas to read regions from.
+
+    """
+
+    def __init__(self, atlas: BrainGlobeAtlas):
+        """Constructor."""
+        # weak reference so that the atlas can be garbage-collected with its lookup
+        self._atlas = weakref.ref(atlas)
+        self.hierarchy = get_region_hierarchy(atlas)
+        self.dtype = self.hierarchy.dtype
+        ids = self.hierarchy.ids
+
+        # dense id -> index array, unknown ids are -1, the last one is a sentinel for
+        # ids beyond the largest known one
+        self.lut = np.full(ids.max() + 2, -1, dtype=np.int32)
+        self.lut[ids] = np.arange(len(ids), dtype=np.int32)
+        # 0 is outside the brain, it becomes the root
+        self.lut[0] = self.hierarchy.root
+
+        self.resolution = atlas.resolution  # microns <-> pixels conversion
+        self.shape_um = atlas.shape_um  # out of brain
+        self._voxel_counts = {}  # per hemispheres definition
+
+    def get_codes(
+        self,
+        x: np.ndarray,
+        y: np.ndarray,
+        z: np.ndarray,
+        chunk_size: int = 2**20,
+    ) -> np.ndarray:
+        """
+        Get the regions indices of points.
+
+        Coordinates are converted to stack indices, then to structure ids with the
+        annotation volume and to regions indices with the lookup table. This is done
+        by chunks of `chunk_size` points to limit temporary arrays. Points outside the
+        atlas are attributed to the root. A KeyError is raised if points fall in
+        voxels whose structure id is not in the atlas structures.
+
+        Parameters
+        ----------
+        x, y, z : np.ndarray
+            Coordinates in microns. They should correspond to what is expected by
+            brainglobe-atlasapi : x is AP, y is DV and Z is ML.
+        chunk_size : int, optional
+            Number of points processed at once. Default is 2**20.
+
+        Returns
+        -------
+        codes : np.ndarray
+            Indices of the regions in `acronyms`.
+
+        """
+        annotation = self._atlas().annotation
+        annotation_flat = np.ravel(annotation)  # view if contiguous
+        strides = [stride // annotation.itemsize for stride in annotation.strides]
+        if not annotation.flags["C_CONTIGUOUS"]:
+            strides = np.cumprod((annotation.shape[1:] + (1,))[::-1])[::-1]
+
+        codes = np.empty(len(x), dtype=np.int32)
+        for start in range(0, len(x), chunk_size):
+            chunk = slice(start, start + chunk_size)
+            # linear indices in the annotation stack
+            linear_indices = 0
+            for values, res, lim, stride in zip(
+                (x, y, z), self.resolution, self.shape_um, strides
+            ):
+                linear_indices += self._to_index(values[chunk], res, lim) * stride
+            ids = annotation_flat.take(linear_indices)
+            codes[chunk] = self.lut.take(np.minimum(ids, len(self.lut) - 1))
+            unknown = (codes[chunk] < 0) | (ids >= len(self.lut))
+            if unknown.any():
+                raise KeyError(f"Unknown structures ids : {set(ids[unknown].tolist())}")
+
+        return codes
+
+    def get_regions(
+        self, x: np.ndarray, y: np.ndarray, z: np.ndarray
+    ) -> pd.Categorical:
+        """
+        Get the regions acronyms of points, see `get_codes()`.
+
+        Parameters
+        ----------
+        x, y, z : np.ndarray
+            Coordinates in microns.
+
+        Returns
+        -------
+        regions : pd.Categorical
+            Acronyms of the regions, whose categories are all the atlas regions.
+
+        """
+        return pd.Categorical.from_codes(self.get_codes(x, y, z), dtype=self.dtype)
+
+    def get_voxel_counts(
+        self, midline: float, left_beyond_midline: bool = True, chunk_size: int = 16
+    ) -> np.ndarray:
+        """
+        Count the voxels of each region, in each hemisphere.
+
+        Voxels are attributed to a hemisphere by comparing the medio-lateral
+        coordinate of their center to `midline`. The annotation volume is read by
+        chunks of `chunk_size` planes along the first axis. Results are cached.
+
+        Parameters
+        ----------
+        midline : float
+            Brain midline in microns.
+        left_beyond_midline : bool, optional
+            If True (default, ABBA atlas), voxels beyond the midline are in the left
+            hemisphere, otherwise they are in the right hemisphere.
+        chunk_size : int, optional
+            Number of planes processed at once. Default is 16.
+
+        Returns
+        -------
+        counts : np.ndarray
+            Number of voxels, with shape (regions, 2), the second axis is (left,
+            right). Not rolled up, see `RegionHierarchy.roll_up()`.
+
+        """
+        key = (midline, left_beyond_midline)
+        if key in self._voxel_counts:
+            return self._voxel_counts[key]
+
+        annotation = self._atlas().annotation
+        nregions = len(self.hierarchy.ids)
+        # hemisphere of each medio-lateral index, 0 is left, 1 is right
+        ml = (np.arange(annotation.shape[2]) + 0.5) * self.resolution[2]
+        is_left = ml >= midline if left_beyond_midline else ml <= midline
+        hemisphere = (~is_left).astype(np.intp)
+
+        counts = np.zeros(nregions * 2, dtype=np.int64)
+        for start in range(0, annotation.shape[0], chunk_size):
+            ids = np.asarray(annotation[start : start + chunk_size])
+            codes = self.lut.take(np.minimum(ids, len(self.lut) - 1)).astype(np.intp)
+            if (codes < 0).any():
+                unknown = set(ids[codes < 0].tolist())
+                raise KeyError(f"Unknown structures ids : {unknown}")
+            counts += np.bincount(
+                (codes * 2 + hemisphere).ravel(), minlength=nregions * 2
+            )
+        self._voxel_counts[key] = counts.reshape(nregions, 2)
+
+        return self._voxel_counts[key]
+
+    @staticmethod
+    def _to_index(values: np.ndarray, res: float, lim: float) -> np.ndarray:
+        """Convert coordinates in microns to stack indices, 0 if out of the stack."""
+        outside = ~((values >= 0) & (values < lim))  # NaN are outside too
+        indices = np.asarray(values) / res
+        indices[outside] = 0
+        return indices.astype(np.intp)
+
+
+# hierarchies and lookups are built once per atlas instance
+_REGION_HIERARCHIES = weakref.WeakKeyDictionary()
+_REGION_LOOKUPS = weakref.WeakKeyDictionary()
+
+
+def get_region_hierarchy(atlas: BrainGlobeAtlas) -> RegionHierarchy:
+    """
+    Get the `RegionHierarchy` of an atlas, building it on first use.
+
+    Parameters
+    ----------
+    atlas : BrainGlobeAtlas
+
+    Returns
+    -------
+    hierarchy : RegionHierarchy
+
+    """
+    if atlas not in _REGION_HIERARCHIES:
+        _REGION_HIERARCHIES[atlas] = RegionHierarchy(atlas)
+    return _REGION_HIERARCHIES[atlas]
+
+
+def get_region_lookup(atlas: BrainGlobeAtlas) -> RegionLookup:
+    """
+    Get the `RegionLookup` of an atlas, building it on first use.
+
+    Parameters
+    ----------
+    atlas : BrainGlobeAtlas
+
+    Returns
+    -------
+    lookup : RegionLookup
+
+    """
+    if atlas not in _REGION_LOOKUPS:
+        _REGION_LOOKUPS[atlas] = RegionLookup(atlas)
+    return _REGION_LOOKUPS[atlas]
+
+
 def add_brain_region(
     df: pd.DataFrame,
     atlas: BrainGlobeAtlas | None,
     col: str = "Parent",
     xname: str = "Atlas_X",
-    yname: str = "Atlas_Z",
-    zname: str = "Altas_Z",
+    yname: str = "Atlas_Y",
+    zname: str = "Atlas_Z",
 ) -> pd.DataFrame:
     """
     Add brain region to a DataFrame with `Atlas_X`, `Atlas_Y` and `Atlas_Z` columns.
@@ -413,9 +1006,14 @@ def add_brain_region(
     This uses Brainglobe Atlas API to query the atlas. It does not use the
     structure_from_coords() method, instead it manually converts the coordinates in
     stack indices, then get the corresponding annotation id and query the corresponding
-    acronym -- because brainglobe-atlasapi is not vectorized at all.
+    acronym -- because brainglobe-atlasapi is not vectorized at all. This is done with
+    the atlas `RegionLookup`, see `get_region_lookup()`.
     If no altas is provided (None), the `col` column is set to an empty string.
 
+    `df` is modified in place : the `col` column is added (or replaced) and `df` itself
+    is returned. A KeyError is raised if points fall in voxels whose structure id is
+    not in the atlas structures.
+
     Parameters
     ----------
     df : pd.DataFrame
@@ -430,40 +1028,17 @@ def add_brain_region(
     Returns
     -------
     df : pd.DataFrame
-        Same DataFrame with a new "Parent" column.
+        Same DataFrame, with the new categorical `col` column.
 
     """
-    df_in = df.copy()
-
     if atlas is None:
         # no atlas provided set required col as empty string
         df[col] = ""
         return df
 
-    res = atlas.resolution  # microns <-> pixels conversion
-    lims = atlas.shape_um  # out of brain
-
-    # set out-of-brain objects at 0 so we get "root" as their parent
-    df_in.loc[(df_in[xname] >= lims[0]) | (df_in[xname] < 0), xname] = 0
-    df_in.loc[(df_in[yname] >= lims[1]) | (df_in[yname] < 0), yname] = 0
-    df_in.loc[(df_in[zname] >= lims[2]) | (df_in[zname] < 0), zname] = 0
-
-    # build the multi index, in pixels and integers
-    ixyz = (
-        df_in[xname].divide(res[0]).astype(int),
-        df_in[yname].divide(res[1]).astype(int),
-        df_in[zname].divide(res[2]).astype(int),
+    df[col] = get_region_lookup(atlas).get_regions(
+        df[xname].to_numpy(), df[yname].to_numpy(), df[zname].to_numpy()
     )
-    # convert i, j, k indices in raveled indices
-    linear_indices = np.ravel_multi_index(ixyz, dims=atlas.annotation.shape)
-    # get the structure id from the annotation stack
-    idlist = atlas.annotation.ravel()[linear_indices]
-    # replace 0 which does not exist to 997 (root)
-    idlist[idlist == 0] = 997
-
-    # query the corresponding acronyms
-    lookup = atlas.lookup_df.set_index("id")
-    df.loc[:, col] = lookup.loc[idlist, "acronym"].values
 
     return df
 
@@ -505,11 +1080,14 @@ def filter_df_classifications(
             raise KeyError(f"{col} not in DataFrame.")
 
     pattern = "|".join(f".*{s}.*" for s in filter_list)
+    mask = get_category_mask(
+        df[col], lambda labels: labels.str.contains(pattern, case=False, regex=True)
+    )
 
     if mode == "keep":
-        df_return = df[df[col].str.contains(pattern, case=False, regex=True)]
+        df_return = df[mask]
     elif mode == "remove":
-        df_return = df[~df[col].str.contains(pattern, case=False, regex=True)]
+        df_return = df[~mask]
 
     # check
     if len(df_return) == 0:
@@ -548,10 +1126,43 @@ def filter_df_regions(
 
     """
 
+    mask = get_category_mask(df[col], lambda labels: labels.isin(filter_list))
+
     if mode == "keep":
-        return df[df[col].isin(filter_list)]
+        return df[mask]
     if mode == "remove":
-        return df[~df[col].isin(filter_list)]
+        return df[~mask]
+
+
+def get_category_mask(
+    values: pd.Series, predicate, missing: bool = False
+) -> np.ndarray:
+    """
+    Evaluate a predicate on the unique labels of `values` and broadcast it to entries.
+
+    `values` is converted to categorical if it is not already, then `predicate` is
+    evaluated on its categories only, and the result is applied through the integer
+    codes. Missing values get `missing`.
+
+    Parameters
+    ----------
+    values : pandas.Series
+    predicate : callable
+        Takes the categories (a pandas.Index) and returns a boolean array.
+    missing : bool, optional
+        Value for missing values. Default is False.
+
+    Returns
+    -------
+    mask : np.ndarray
+        Boolean array, True where `predicate` is True for the entry.
+
+    """
+    if not isinstance(values.dtype, pd.CategoricalDtype):
+        values = values.astype("category")
+    category_mask = np.asarray(predicate(values.cat.categories), dtype=bool)
+    # -1 codes (missing values) get the last element
+    return np.append(category_mask, missing)[values.cat.codes.to_numpy()]
 
 
 def get_data_coverage(df: pd.DataFrame, col="Atlas_AP", by="animal") -> pd.DataFrame:
@@ -575,7 +1186,7 @@ def get_data_coverage(df: pd.DataFrame, col="Atlas_AP", by="animal") -> pd.DataF
         min and max of `col` for each `by`, named "X_min", and "X_max".
 
     """
-    df_group = df.groupby([by])
+    df_group = df.groupby([by], observed=True)
     return pd.DataFrame(
         [
             df_group[col].min(),
@@ -610,7 +1221,7 @@ def renormalize_per_key(df: pd.DataFrame, by: str, on: str):
         Same DataFrame with normalized `on` column.
 
     """
-    norm = df.groupby(by)[on].sum()
+    norm = df.groupby(by, observed=True)[on].sum()
     bys = df[by].unique()
     for key in bys:
         df.loc[df[by] == key, on] = df.loc[df[by] == key, on].divide(norm[key])
@@ -643,45 +1254,84 @@ def select_hemisphere_channel(
         DataFrame to be used in plots.
 
     """
-    dfplt = df.copy()
+    return df[get_hemisphere_channel_mask(df, hue, hue_filter, hue_mirror)]
+
+
+def get_hemisphere_channel_mask(
+    df: pd.DataFrame, hue: str, hue_filter: str, hue_mirror: bool
+) -> np.ndarray:
+    """
+    Get the mask of relevant data given hue and filters.
+
+    See `select_hemisphere_channel()`.
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        DataFrame to filter.
+    hue : {"hemisphere", "channel"}
+        hue that will be used in seaborn plots.
+    hue_filter : str
+        Selected data.
+    hue_mirror : bool
+        Instead of keeping only hue_filter values, they will be plotted in mirror.
+
+    Returns
+    -------
+    mask : np.ndarray
+        Boolean array, True for entries to be used in plots.
+
+    """
+    mask = np.ones(len(df), dtype=bool)
 
     if hue == "hemisphere":
         # hue_filter is used to select channels
         # keep only left and right hemispheres, not "both"
-        dfplt = dfplt[dfplt["hemisphere"] != "both"]
+        mask &= get_category_mask(
+            df["hemisphere"], lambda labels: labels != "both", missing=True
+        )
         if hue_filter == "all":
-            hue_filter = dfplt["channel"].unique()
+            hue_filter = df.loc[mask, "channel"].unique()
         elif not isinstance(hue_filter, (list, tuple)):
             # it is allowed to select several channels so handle lists
             hue_filter = [hue_filter]
-        dfplt = dfplt[dfplt["channel"].isin(hue_filter)]
+        mask &= get_category_mask(
+            df["channel"],
+            lambda labels: labels.isin(hue_filter),
+            missing=pd.isna(hue_filter).any(),
+        )
     elif hue == "channel":
         # hue_filter is used to select hemispheres
         # it can only be left, right, both or empty
         if hue_filter == "both":
             # handle if it's a coordinates DataFrame which doesn't have "both"
-            if "both" not in dfplt["hemisphere"].unique():
+            is_both = get_category_mask(
+                df["hemisphere"], lambda labels: labels == "both"
+            )
+            if not is_both.any():
                 # keep both hemispheres, don't do anything
                 pass
             else:
                 if hue_mirror:
                     # we need to keep both hemispheres to plot them in mirror
-                    dfplt = dfplt[dfplt["hemisphere"] != "both"]
+                    mask &= ~is_both
                 else:
                     # we keep the metrics computed in both hemispheres
-                    dfplt = dfplt[dfplt["hemisphere"] == "both"]
+                    mask &= is_both
         else:
             # hue_filter should correspond to an hemisphere name
-            dfplt = dfplt[dfplt["hemisphere"] == hue_filter]
+            mask &= get_category_mask(
+                df["hemisphere"], lambda labels: labels == hue_filter
+            )
     else:
         # not handled. Just return the DataFrame without filtering, maybe it'll make
         # sense.
         warnings.warn(f"{hue} should be 'channel' or 'hemisphere'.")
 
     # check result
-    if len(dfplt) == 0:
+    if not mask.any():
         warnings.warn(
             f"hue={hue} and hue_filter={hue_filter} resulted in an empty subset."
         )
 
-    return dfplt
+    return mask
@@ -0,0 +1,54 @@
+import shutil
+from pathlib import Path
+
+import orjson
+import pytest
+
+from cuisto import config, io
+
+RESOURCES_DIR = Path(__file__).parent.parent / "resources"
+
+
+@pytest.fixture
+def cells_config():
+    return config.Config(RESOURCES_DIR / "test_config_cells.toml")
+
+
+@pytest.fixture
+def fibers_config():
+    return config.Config(RESOURCES_DIR / "test_config_multi.toml")
+
+
+@pytest.fixture
+def multi_wdir():
+    return RESOURCES_DIR / "multi"
+
+
+@pytest.fixture
+def tmp_multi_wdir(tmp_path, multi_wdir):
+    wdir = tmp_path / "multi"
+    shutil.copytree(multi_wdir, wdir)
+    return wdir
+
+
+@pytest.fixture
+def annotations_dir(multi_wdir):
+    return io.get_measurements_directory(multi_wdir, "mouse0", "annotation", "fibers")
+
+
+@pytest.fixture
+def tmp_annotations_dir(tmp_path, annotations_dir):
+    data_dir = tmp_path / "annotations"
+    shutil.copytree(annotations_dir, data_dir)
+    return data_dir
+
+
+@pytest.fixture
+def write_fibers_json(tmp_path):
+    def write(image: str, data: dict) -> Path:
+        filename = tmp_path / f"{image}_detections_coordinates.json"
+        with open(filename, "wb") as fid:
+            fid.write(orjson.dumps(data, option=orjson.OPT_INDENT_2))
+        return filename
+
+    return write
@@ -0,0 +1,151 @@
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from cuisto import compute, process
+
+
+def test_sum_grouping_sets():
+    rng = np.random.default_rng(0)
+    n = 1000
+    df = pd.DataFrame(
+        {
+            "Name": rng.choice(["CA1", "MOp", "VISp1", None], n),
+            "hemisphere": rng.choice(["Left", "Right", None], n),
+            "channel": rng.choice(["EGFP", "Cy5"], n),
+            "length": rng.uniform(0, 10, n),
+            "count": rng.integers(0, 10, n),
+        }
+    )
+    df.loc[::7, "length"] = np.nan
+
+    df_sums = compute.sum_grouping_sets(
+        df,
+        ["Name", "hemisphere", "channel"],
+        ["length", "count"],
+        pooled={"hemisphere": "both", "channel": "all"},
+    )
+
+    expected = []
+    for pooled_keys in ([], ["hemisphere"], ["channel"], ["hemisphere", "channel"]):
+        df_pooled = df.assign(
+            **{key: "both" if key == "hemisphere" else "all" for key in pooled_keys}
+        )
+        expected.append(
+            df_pooled.groupby(["Name", "hemisphere", "channel"])[["length", "count"]]
+            .sum()
+            .reset_index()
+        )
+    expected = pd.concat(expected, ignore_index=True)
+
+    pd.testing.assert_frame_equal(
+        df_sums, expected, check_dtype=False, check_exact=True
+    )
+    assert df_sums["count"].dtype == df["count"].dtype
+
+
+def test_get_regions_metrics(cells_config):
+    resources_dir = Path(__file__).parent.parent / "resources"
+    df_annotations = pd.read_csv(
+        resources_dir / "cells_measurements_annotations.tsv",
+        index_col="Object ID",
+        sep="\t",
+    )
+    df_annotations = process.clean_annotations(df_annotations, cells_config)
+
+    df_regions = compute.get_regions_metrics(
+        df_annotations,
+        cells_config.object_type,
+        cells_config.channels["names"],
+        cells_config.regions["base_measurement"],
+        cells_config.regions["metrics"],
+    )
+
+    for col in cells_config.regions["metrics"].values():
+        assert pd.api.types.is_float_dtype(df_regions[col])
+    expected = pd.read_csv(
+        resources_dir / "results" / "cells_df_regions.tsv",
+        sep="\t",
+        float_precision="round_trip",
+    )
+    pd.testing.assert_frame_equal(
+        df_regions.reset_index(drop=True),
+        expected.drop(columns="animal"),
+        check_exact=True,
+    )
+
+
+@pytest.mark.parametrize("dtype", ["float32", "float64"])
+def test_get_bin_indices(dtype):
+    bin_edges = np.linspace(-3.7, 5.1, 38)
+    values = np.concatenate(
+        [
+            np.random.default_rng(0).uniform(-5, 6, 10000),
+            bin_edges,
+            np.nextafter(bin_edges, np.inf),
+            np.nextafter(bin_edges, -np.inf),
+            [np.nan],
+        ]
+    ).astype(dtype)
+
+    indices = compute.get_bin_indices(values, bin_edges)
+    count = np.bincount(indices, minlength=len(bin_edges))[:-1]
+
+    expected, _ = np.histogram(values[~np.isnan(values)], bin_edges)
+    np.testing.assert_array_equal(count, expected)
+
+
+def test_get_histogram_2d():
+    rng = np.random.default_rng(0)
+    x, y = rng.uniform(-1, 11, (2, 10000))
+    xlim, ylim, nbins = [0, 10], [2, 8], [50, 30]
+
+    grid = compute.get_histogram_2d(x[:5000], y[:5000], xlim, ylim, nbins)
+    grid += compute.get_histogram_2d(x[5000:], y[5000:], xlim, ylim, nbins)
+
+    expected, _, _ = np.histogram2d(x, y, bins=nbins, range=[xlim, ylim])
+    np.testing.assert_array_equal(grid, expected)
+
+
+def test_get_density_volume():
+    rng = np.random.default_rng(0)
+    shape, resolution = (20, 10, 15), (25, 25, 25)
+    x, y, z = rng.uniform(-50, 550, (3, 10000))
+    x[0] = np.nan
+
+    volume = compute.get_density_volume(x, y, z, shape, resolution, downsample=2)
+
+    expected, _ = np.histogramdd(
+        np.column_stack([x, y, z]),
+        bins=(10, 5, 8),
+        range=[(0, 500), (0, 250), (0, 400)],
+    )
+    np.testing.assert_array_equal(volume, expected)
+
+    smoothed = compute.get_density_volume(
+        x, y, z, shape, resolution, downsample=2, sigma=50
+    )
+    assert smoothed.shape == volume.shape
+    assert smoothed.sum() <= volume.sum()
+
+
+def test_split_segments():
+    # path 0 crosses x = 10 then y = 10, path 1 is a single point
+    x = np.array([5.0, 15.0, 15.0, 50.0])
+    y = np.array([5.0, 5.0, 25.0, 50.0])
+    z = np.array([5.0, 5.0, 5.0, 50.0])
+    offsets = np.array([0, 3, 4])
+
+    segments, *_, lengths = compute.split_segments(x, y, z, offsets)
+    np.testing.assert_array_equal(segments, [0, 1])
+    np.testing.assert_array_equal(lengths, [10, 20])
+
+    segments, xm, ym, _, lengths = compute.split_segments(
+        x, y, z, offsets, resolution=(10, 10, 10)
+    )
+    np.testing.assert_array_equal(segments, [0, 0, 1, 1, 1])
+    np.testing.assert_allclose(lengths, [5, 5, 5, 10, 5])
+    np.testing.assert_allclose(xm, [7.5, 12.5, 15, 15, 15])
+    np.testing.assert_allclose(ym, [5, 5, 7.5, 15, 22.5])
@@ -0,0 +1,18 @@
+from pathlib import Path
+
+from cuisto import config
+
+CONFIG_FILE = Path(__file__).parent.parent / "resources" / "test_config_multi.toml"
+
+
+def test_config_cached_regions(tmp_path, monkeypatch):
+    monkeypatch.setenv("HOME", str(tmp_path))
+
+    cfg = config.Config(CONFIG_FILE)
+    assert (tmp_path / ".cuisto" / f"{cfg.atlas['name']}_regions.json").is_file()
+
+    cfg_warm = config.Config(CONFIG_FILE)
+    assert cfg_warm._bg_atlas is None  # atlas not loaded
+    assert cfg_warm.atlas["blacklist"] == cfg.atlas["blacklist"]
+    assert cfg_warm.atlas["leaveslist"] == cfg.atlas["leaveslist"]
+    assert cfg_warm.bg_atlas.atlas_name == cfg.atlas["name"]
@@ -0,0 +1,370 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from cuisto import io
+
+
+def test_cat_csv_dir(annotations_dir):
+    df = io.cat_csv_dir(annotations_dir, index_col="Object ID", sep="\t", n_jobs=4)
+    df_serial = pd.concat(
+        pd.read_csv(
+            os.path.join(annotations_dir, filename), index_col="Object ID", sep="\t"
+        )
+        for filename in os.listdir(annotations_dir)
+        if filename.endswith(".csv")
+    )
+
+    pd.testing.assert_frame_equal(df, df_serial)
+
+
+def test_cat_csv_dir_schema(annotations_dir, fibers_config):
+    df = io.cat_csv_dir(
+        annotations_dir,
+        index_col="Object ID",
+        sep="\t",
+        dtype=io.QUPATH_DTYPES,
+        usecols=io.get_usecols(fibers_config, "annotation"),
+    )
+
+    assert isinstance(df["Name"].dtype, pd.CategoricalDtype)
+    assert isinstance(df["Classification"].dtype, pd.CategoricalDtype)
+    assert set(df.columns) == {
+        "Image",
+        "Object type",
+        "Name",
+        "Classification",
+        "Parent",
+        "Area µm^2",
+        "Fibers: Cy5 Length µm",
+        "Fibers: DsRed Length µm",
+        "Fibers: EGFP Length µm",
+    }
+
+    usecols = io.get_usecols(fibers_config, "detection")
+    assert usecols("Atlas_X") and usecols("hemisphere")
+    assert not usecols("Distance to annotation with Root µm")
+
+
+def test_apply_dtypes_policy(annotations_dir, fibers_config, tmp_path):
+    df = io.cat_csv_dir(annotations_dir, index_col="Object ID", sep="\t")
+    df["animal"] = "mouse0"
+    usecols = io.get_usecols(fibers_config, "annotation")
+
+    df_compact = io.apply_dtypes_policy(df, {"drop_unused": True}, usecols)
+
+    assert list(df_compact.columns) == [
+        col for col in df.columns if usecols(col) or col == "animal"
+    ]
+    for col in ("Image", "Object type", "Name", "Classification", "animal"):
+        assert isinstance(df_compact[col].dtype, pd.CategoricalDtype)
+    pd.testing.assert_frame_equal(
+        df_compact.astype(object), df[df_compact.columns].astype(object)
+    )
+    # already compact : nothing to do
+    assert io.apply_dtypes_policy(df_compact) is df_compact
+    assert io.apply_dtypes_policy(df, {"labels": ""}) is df
+
+    # types are kept in HDF5 files
+    io.save_dfs(tmp_path, "results.h5", {"df_regions": df_compact})
+    (df_loaded,) = io.load_dfs(tmp_path / "results", "h5", ["df_regions"])
+    pd.testing.assert_frame_equal(df_loaded, df_compact)
+
+
+def test_cat_csv_dir_cache(tmp_annotations_dir, tmp_path):
+    data_dir = tmp_annotations_dir
+    kwargs = {"index_col": "Object ID", "sep": "\t", "dtype": io.QUPATH_DTYPES}
+    df = io.cat_csv_dir(data_dir, **kwargs)
+
+    # first call fills the cache, second call reads from it
+    for _ in range(2):
+        df_cached = io.cat_csv_dir(
+            data_dir, cache=True, cache_dir=tmp_path / "cache", **kwargs
+        )
+        pd.testing.assert_frame_equal(df_cached, df)
+
+    # modified files are read again
+    filename = io.list_files(data_dir, ".csv")[0]
+    df_file = pd.read_csv(filename, sep="\t")
+    df_file.iloc[:2].to_csv(filename, sep="\t", index=False)
+    df_cached = io.cat_csv_dir(
+        data_dir, cache=True, cache_dir=tmp_path / "cache", **kwargs
+    )
+    assert len(df_cached) == len(df) - len(df_file) + 2
+
+
+def test_get_signature(fibers_config, monkeypatch):
+    def signature():
+        return io.get_signature(usecols=io.get_usecols(fibers_config, "detection"))
+
+    expected = signature()
+    assert signature() == expected
+    monkeypatch.setattr(io, "COORDINATES_COLUMNS", ["Atlas_X", "Atlas_Y"])
+    assert signature() != expected
+
+    # bound methods are identified with the object they are bound to
+    usecols = [{"Atlas_X"}.__contains__, {"Atlas_Y"}.__contains__]
+    assert io.get_signature(usecols=usecols[0]) != io.get_signature(usecols=usecols[1])
+    with pytest.raises(TypeError):
+        io.get_signature(usecols=lambda col: True)
+
+
+def test_scan_directory(tmp_annotations_dir, tmp_path, monkeypatch):
+    data_dir = tmp_annotations_dir
+    filename = io.list_files(data_dir, ".csv")[0]
+    header = pd.read_csv(filename, sep="\t").iloc[:0]
+    header.to_csv(data_dir / "empty.csv", sep="\t", index=False)
+    (data_dir / "notes.txt").write_text("not a measurement")
+    cache_dir = tmp_path / "cache"
+
+    manifest = io.scan_directory(data_dir, ".csv", count_rows=True, cache_dir=cache_dir)
+    expected = {f: io.count_lines(f) - 1 for f in io.list_files(data_dir, ".csv")}
+    assert dict(zip(manifest["filename"], manifest["nrows"])) == expected
+    assert expected[os.path.join(data_dir, "empty.csv")] == 0
+    assert not cache_dir.exists()  # manifest is kept only with cache
+
+    manifest = io.scan_directory(
+        data_dir, ".csv", count_rows=True, cache_dir=cache_dir, cache=True
+    )
+    assert dict(zip(manifest["filename"], manifest["nrows"])) == expected
+
+    # rows of unchanged files are not counted again
+    monkeypatch.setattr(io, "count_lines", lambda f: 3)
+    df_file = pd.read_csv(filename, sep="\t")
+    df_file.iloc[:2].to_csv(filename, sep="\t", index=False)
+    manifest = io.scan_directory(
+        data_dir, ".csv", count_rows=True, cache_dir=cache_dir, cache=True
+    )
+    expected[filename] = 2
+    assert dict(zip(manifest["filename"], manifest["nrows"])) == expected
+    # other files are listed, rows are not counted
+    manifest = io.scan_directory(data_dir, cache_dir=cache_dir, cache=True)
+    assert len(manifest) == len(expected) + 1
+    assert manifest.loc[manifest["filename"].str.endswith(".txt"), "nrows"].item() == -1
+    # manifests of other extensions are left untouched
+    manifest = io.scan_directory(data_dir, ".csv", cache_dir=cache_dir, cache=True)
+    assert dict(zip(manifest["filename"], manifest["nrows"])) == expected
+
+    # empty files are not read
+    df = io.cat_csv_dir(data_dir, index_col="Object ID", sep="\t", cache_dir=cache_dir)
+    assert len(df) == sum(expected.values())
+
+
+def test_read_fibers_json(write_fibers_json):
+    paths = {
+        "path0": {
+            "x": [1.0, 2.0],
+            "y": [3.0, 4.0],
+            "z": [5.0, 6.0],
+            "hemisphere": ["Left", "Right"],
+            "classification": "Fibers: EGFP",
+        },
+        "path1": {
+            "x": [7.0],
+            "y": [8.0],
+            "z": [9.0],
+            "hemisphere": ["Right"],
+            "classification": "Fibers: Cy5",
+        },
+    }
+    filename = write_fibers_json("image", {"paths": paths})
+
+    fibers = io.read_fibers_json(filename)
+
+    assert fibers["x"].dtype == np.float32
+    np.testing.assert_array_equal(fibers["x"], [1, 2, 7])
+    np.testing.assert_array_equal(fibers["z"], [5, 6, 9])
+    np.testing.assert_array_equal(fibers["offsets"], [0, 2, 3])
+    np.testing.assert_array_equal(fibers["path_id"], [0, 0, 1])
+    assert list(fibers["hemisphere"]) == ["Left", "Right", "Right"]
+    assert list(fibers["object_id"]) == ["path0", "path1"]
+    assert list(fibers["properties"]["classification"]) == [
+        "Fibers: EGFP",
+        "Fibers: Cy5",
+    ]
+
+
+def test_iter_fibers_json(write_fibers_json):
+    rng = np.random.default_rng(0)
+    paths = {
+        f'path{idx} "{{[\\': {
+            "x": rng.uniform(0, 100, n).tolist(),
+            "y": rng.uniform(0, 100, n).tolist(),
+            "z": rng.uniform(0, 100, n).tolist(),
+            "hemisphere": ["Left"] * n,
+            "classification": "Fibers: EGFP ]}",
+        }
+        for idx, n in enumerate(rng.integers(1, 20, 50))
+    }
+    data = {"units": "microns", "other": {"paths": [1, "}"]}, "paths": paths, "end": 0}
+    filename = write_fibers_json("image", data)
+    expected = io.read_fibers_json(filename)
+
+    chunks = list(io.iter_fibers_json(filename, chunk_size=40, buffer_size=100))
+
+    assert all(len(chunk["x"]) <= 40 for chunk in chunks)
+    for key in ("x", "y", "z", "object_id"):
+        np.testing.assert_array_equal(
+            np.concatenate([chunk[key] for chunk in chunks]), expected[key]
+        )
+    np.testing.assert_array_equal(
+        np.concatenate([chunk["properties"]["classification"] for chunk in chunks]),
+        expected["properties"]["classification"],
+    )
+
+
+def test_fibers_store(tmp_path, write_fibers_json):
+    for image, npaths in (("image0", 3), ("image1", 2)):
+        paths = {
+            f"{image}_path{idx}": {
+                "x": [float(idx)] * (idx + 1),
+                "y": [1.0] * (idx + 1),
+                "z": [2.0] * (idx + 1),
+                "hemisphere": ["Left"] * (idx + 1),
+                "classification": f"Fibers: {image}",
+            }
+            for idx in range(npaths)
+        }
+        write_fibers_json(image, {"paths": paths})
+
+    cache_dir = tmp_path / "cache"
+    store_dir = io.write_fibers_store(tmp_path, cache_dir=cache_dir)
+    assert os.path.dirname(store_dir) == str(cache_dir)
+    store = io.FibersStore(store_dir)
+
+    assert store.images == ["image0", "image1"]
+    assert store.n_paths == 5
+    assert store.n_points == 6 + 3
+    for image in store.images:
+        fibers = store.get_fibers(image)
+        expected = io.read_fibers_json(
+            tmp_path / f"{image}_detections_coordinates.json"
+        )
+        for key in ("x", "y", "z", "offsets", "path_id", "object_id"):
+            np.testing.assert_array_equal(fibers[key], expected[key])
+        assert list(fibers["hemisphere"]) == list(expected["hemisphere"])
+
+    chunks = list(store.iter_chunks(chunk_size=4))
+    assert [image for image, _ in chunks] == ["image0", "image0", "image1"]
+    assert sum(len(points["x"]) for _, points in chunks) == store.n_points
+
+    # up-to-date store is not rewritten
+    mtime = os.stat(os.path.join(store_dir, "metadata.json")).st_mtime_ns
+    io.write_fibers_store(tmp_path, cache_dir=cache_dir)
+    assert os.stat(os.path.join(store_dir, "metadata.json")).st_mtime_ns == mtime
+
+
+def test_stage_cache(tmp_path):
+    df = pd.DataFrame({"a": np.arange(1000), "b": np.linspace(0, 1, 1000)})
+    calls = []
+
+    def double(df, factor=2):
+        calls.append(factor)
+        return df * factor
+
+    stage_cache = io.StageCache(tmp_path)
+    data = stage_cache.data(df)
+    result = stage_cache.stage("double", {"factor": 2}, double, data, factor=2)
+    pd.testing.assert_frame_equal(result.get(), df * 2)
+    result = stage_cache.stage("double", {"factor": 2}, double, stage_cache.data(df))
+    pd.testing.assert_frame_equal(result.get(), df * 2)
+    assert calls == [2]
+
+    # least recently used outputs are removed
+    stage_cache.max_size = 2.5 * os.path.getsize(tmp_path / f"{result.key}.pkl")
+    for factor in (3, 4, 5):
+        stage_cache.stage(
+            "double", {"factor": factor}, double, data, factor=factor
+        ).get()
+    assert calls == [2, 3, 4, 5]
+    assert not (tmp_path / f"{result.key}.pkl").exists()
+    assert len(os.listdir(tmp_path)) == 2
+
+
+def test_density_volumes(tmp_path):
+    rng = np.random.default_rng(0)
+    volumes = {
+        "EGFP": rng.poisson(0.1, (20, 10, 15)),
+        "Cy5": rng.uniform(0, 1, (20, 10, 15)) * (rng.uniform(size=(20, 10, 15)) > 0.9),
+    }
+    filename = tmp_path / "volumes.npz"
+
+    io.save_density_volumes(filename, volumes, [50, 50, 50])
+    loaded, voxel_size = io.load_density_volumes(filename)
+
+    assert list(loaded.keys()) == list(volumes.keys())
+    for name, volume in volumes.items():
+        np.testing.assert_array_equal(loaded[name], volume)
+        assert loaded[name].dtype == volume.dtype
+    np.testing.assert_array_equal(voxel_size, [50, 50, 50])
+
+
+def test_results_store(tmp_path):
+    def get_df(animal, regions):
+        return pd.DataFrame(
+            {
+                "Name": pd.Categorical(regions),
+                "count": np.arange(len(regions), dtype="int32"),
+                "animal": animal,
+            }
+        )
+
+    store = io.ResultsStore(tmp_path / "results.parquet")
+    store.append({"df_regions": get_df("mouse0", ["VISp", "MOp"])})
+    store.append({"df_regions": get_df("mouse1", ["CA1", "VISp", "MOp"])})
+    store.append({"df_regions": get_df("mouse0", ["VISp", "MOp", "CP"])})  # replaced
+
+    assert store.tables == ["df_regions"]
+    assert store.get_animals() == ["mouse0", "mouse1"]
+    df = store.select("df_regions")
+    assert df["count"].dtype == "int32"
+    assert isinstance(df["Name"].dtype, pd.CategoricalDtype)
+    assert df["animal"].tolist() == ["mouse0"] * 3 + ["mouse1"] * 3
+
+    df = store.select("df_regions", columns=["count"], animal=["mouse1"], Name=["VISp"])
+    assert df.columns.tolist() == ["count"]
+    assert df["count"].tolist() == [1]
+
+    (df_regions,) = io.load_dfs(
+        tmp_path / "results", "parquet", ["df_regions"], Name=["MOp"]
+    )
+    assert df_regions["animal"].tolist() == ["mouse0", "mouse1"]
+
+
+def test_results_query(tmp_path, fibers_config):
+    rng = np.random.default_rng(0)
+    store = io.ResultsStore(tmp_path / "results.parquet")
+    for animal in ("mouse0", "mouse1"):
+        store.append(
+            {
+                "df_coordinates": pd.DataFrame(
+                    {
+                        "Atlas_AP": rng.uniform(-5, 5, 100),
+                        "Parent": pd.Categorical(
+                            rng.choice(["VISp1", "VISp", "MOp", "root"], 100)
+                        ),
+                        "channel": rng.choice(["EGFP", "Cy5"], 100),
+                        "animal": animal,
+                    }
+                )
+            }
+        )
+    df = store.select("df_coordinates")
+
+    query = store.query("df_coordinates").where(animal=["mouse1"], channel=["EGFP"])
+    query = query.within(Atlas_AP=(-2, None)).within(Atlas_AP=(None, 3))
+    query = query.in_region("VISp", fibers_config.bg_atlas).select(["Atlas_AP"])
+    df_query = io.get_dataframe(query)
+
+    expected = df.loc[
+        (df["animal"] == "mouse1")
+        & (df["channel"] == "EGFP")
+        & df["Atlas_AP"].between(-2, 3)
+        & df["Parent"].isin(["VISp", "VISp1"]),
+        ["Atlas_AP"],
+    ]
+    pd.testing.assert_frame_equal(df_query, expected.reset_index(drop=True))
+    assert sum(len(chunk) for chunk in query.iter_chunks()) == len(expected)
+    assert store.query("df_coordinates").where(animal=[]).collect().empty
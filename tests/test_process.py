@@ -1,14 +1,17 @@
+import os
+from itertools import pairwise
 from pathlib import Path
 
+import numpy as np
 import pandas as pd
 import pytest
 
-from cuisto import config, process
+from cuisto import io, process, utils
 
 
 @pytest.fixture
 def cells_res_regions():
-    return load_results("cells_df_regions.tsv")
+    return io.apply_dtypes_policy(load_results("cells_df_regions.tsv"))
 
 
 @pytest.fixture
@@ -21,7 +24,7 @@ def cells_res_distributions():
 
 @pytest.fixture
 def cells_res_coordinates():
-    return load_results("cells_df_coordinates.tsv")
+    return io.apply_dtypes_policy(load_results("cells_df_coordinates.tsv"))
 
 
 @pytest.fixture
@@ -34,21 +37,9 @@ def cells_detections():
     return load_data("cells_measurements_detections.tsv")
 
 
-@pytest.fixture
-def cells_config():
-    config_file = Path(__file__).parent.parent / "resources" / "test_config_cells.toml"
-    return config.Config(config_file)
-
-
 @pytest.fixture
 def fibers_res_regions():
-    return load_results("fibers_multi_df_regions.tsv")
-
-
-@pytest.fixture
-def fibers_config():
-    config_file = Path(__file__).parent.parent / "resources" / "test_config_multi.toml"
-    return config.Config(config_file)
+    return io.apply_dtypes_policy(load_results("fibers_multi_df_regions.tsv"))
 
 
 @pytest.fixture
@@ -66,6 +57,53 @@ def load_data(fname: str):
     return pd.read_csv(filename, index_col="Object ID", sep="\t")
 
 
+@pytest.fixture
+def cells_detections_small():
+    return pd.DataFrame(
+        {
+            "Classification": ["Cells: marker+", "Cells: marker-", "Other", None],
+            "Parent": ["CA1", "MOp", "CA1", "CA1"],
+            "Atlas_X": [5400.0, 6000.0, 7000.0, 8000.0],
+            "Atlas_Y": [440.0, 1000.0, 2000.0, 3000.0],
+            "Atlas_Z": [5800.0, np.nan, 5000.0, 4000.0],
+        }
+    )
+
+
+@pytest.mark.parametrize("atlas_type", ["abba", "brainglobe"])
+def test_prepare_detections(cells_detections_small, cells_config, atlas_type):
+    cells_config.atlas["type"] = atlas_type
+    if atlas_type == "abba":
+        # beyond the midline it's left, no hemisphere without coordinate
+        hemispheres = ["Left", np.nan]
+        coordinates = utils.ccf_to_stereo(5.4, 0.44, 5.8)
+    else:
+        # medio-lateral axis is X, below the midline it's left
+        cells_config.Xname, cells_config.Zname = "Atlas_Z", "Atlas_X"
+        cells_config.distributions["stereo"] = False
+        hemispheres = ["Left", "Right"]
+        coordinates = (5.8, 0.44, 5.4)
+
+    df = process.prepare_detections(cells_detections_small, cells_config)
+
+    assert df.index.tolist() == [0, 1]
+    assert df["channel"].tolist() == ["Positive", "Negative"]
+    pd.testing.assert_series_equal(
+        df["hemisphere"], pd.Series(hemispheres, name="hemisphere", dtype=object)
+    )
+    np.testing.assert_allclose(df["Atlas_X"], [5.4, 6.0])
+    np.testing.assert_allclose(
+        df[["Atlas_AP", "Atlas_DV", "Atlas_ML"]].iloc[0].to_numpy(float), coordinates
+    )
+
+
+def test_prepare_detections_atlas_type(cells_detections_small, cells_config):
+    cells_config.atlas["type"] = "unknown"
+
+    with pytest.raises(ValueError, match="not supported"):
+        process.prepare_detections(cells_detections_small, cells_config)
+
+
 def test_process_animal(
     cells_annotations,
     cells_detections,
@@ -96,14 +134,240 @@ def test_process_animal(
     )
 
 
-def test_process_animals(fibers_res_regions, fibers_config):
+def test_process_animals(fibers_res_regions, fibers_config, multi_wdir):
     animals = ["mouse0", "mouse1"]
-    wdir = Path(__file__).parent.parent / "resources" / "multi"
 
     df_regions, _, _ = process.process_animals(
-        wdir, animals, fibers_config, compute_distributions=False
+        multi_wdir, animals, fibers_config, compute_distributions=False
     )
 
     pd.testing.assert_frame_equal(
         df_regions.reset_index(drop=True), fibers_res_regions, check_dtype=False
     )
+
+
+def test_process_animals_parallel(fibers_res_regions, fibers_config, multi_wdir):
+    animals = ["mouse0", "mouse1"]
+
+    df_regions, _, _ = process.process_animals(
+        multi_wdir, animals, fibers_config, compute_distributions=False, n_jobs=2
+    )
+
+    pd.testing.assert_frame_equal(
+        df_regions.reset_index(drop=True), fibers_res_regions, check_dtype=False
+    )
+
+    for n_jobs in (0, -2):
+        with pytest.raises(ValueError, match="n_jobs"):
+            process.process_animals(multi_wdir, animals, fibers_config, n_jobs=n_jobs)
+
+
+def test_process_animals_failure(fibers_res_regions, fibers_config, multi_wdir):
+    animals = ["mouse0", "missing_mouse", "mouse1"]
+
+    with pytest.raises(FileNotFoundError):
+        process.process_animals(
+            multi_wdir, animals, fibers_config, compute_distributions=False
+        )
+    with pytest.warns(UserWarning, match="missing_mouse"):
+        df_regions, _, _ = process.process_animals(
+            multi_wdir,
+            animals,
+            fibers_config,
+            compute_distributions=False,
+            skip_failures=True,
+        )
+
+    pd.testing.assert_frame_equal(
+        df_regions.reset_index(drop=True), fibers_res_regions, check_dtype=False
+    )
+
+
+def test_process_animal_streaming(
+    cells_annotations, cells_detections, cells_config, cells_animalid
+):
+    cells_detections[["Atlas_X", "Atlas_Y", "Atlas_Z"]] = cells_detections[
+        ["Atlas_X", "Atlas_Y", "Atlas_Z"]
+    ].multiply(1000)
+    df_regions, dfs_distributions, df_coordinates = process.process_animal(
+        cells_animalid, cells_annotations, cells_detections, cells_config
+    )
+    # chunks by image, and one chunk with no detection of the object type
+    chunks = [df for _, df in cells_detections.groupby("Image", sort=False)]
+    chunks.append(cells_detections.iloc[:10].assign(Classification="Other"))
+    df_regions_s, dfs_distributions_s, counts = process.process_animal_streaming(
+        cells_animalid, cells_annotations, chunks, cells_config
+    )
+
+    pd.testing.assert_frame_equal(df_regions_s, df_regions)
+    for df_s, df in zip(dfs_distributions_s, dfs_distributions):
+        pd.testing.assert_frame_equal(
+            df_s.reset_index(drop=True), df.reset_index(drop=True), check_dtype=False
+        )
+    assert counts["n_detections"] == len(df_coordinates)
+    assert counts["regions"].sum() == len(df_coordinates)
+    for grid in counts["grids"].values():
+        assert grid.sum() <= len(df_coordinates)
+    df_heatmaps = process.get_heatmaps_dataframe(counts["grids"], cells_config)
+    assert df_heatmaps.groupby("view", observed=True)["count"].sum().to_dict() == {
+        view: grid.sum() for view, grid in counts["grids"].items()
+    }
+    with pytest.raises(ValueError, match="No counts"):
+        process.merge_detections_counts([])
+
+
+def test_process_animals_incremental(
+    tmp_multi_wdir, monkeypatch, fibers_res_regions, fibers_config
+):
+    animals = ["mouse0", "mouse1"]
+    wdir = tmp_multi_wdir
+
+    df_regions, _, _ = process.process_animals(
+        wdir, animals, fibers_config, compute_distributions=False, incremental=True
+    )
+    pd.testing.assert_frame_equal(
+        df_regions.reset_index(drop=True), fibers_res_regions, check_dtype=False
+    )
+
+    # up-to-date animals are not processed again
+    def fail(wdir, animal, *args, **kwargs):
+        raise RuntimeError(f"{animal} processed")
+
+    monkeypatch.setattr(process, "process_animal_from_dir", fail)
+    df_regions, _, _ = process.process_animals(
+        wdir, animals, fibers_config, compute_distributions=False, incremental=True
+    )
+    pd.testing.assert_frame_equal(
+        df_regions.reset_index(drop=True), fibers_res_regions, check_dtype=False
+    )
+
+    # modified animals are
+    for filename in (wdir / "mouse1").rglob("*.csv"):
+        os.utime(filename, ns=(0, 0))
+    with pytest.raises(RuntimeError, match="mouse1 processed"):
+        process.process_animals(
+            wdir, animals, fibers_config, compute_distributions=False, incremental=True
+        )
+
+
+def test_process_animal_stage_cache(
+    tmp_path, cells_annotations, cells_detections, cells_config, cells_animalid
+):
+    cells_detections[["Atlas_X", "Atlas_Y", "Atlas_Z"]] = cells_detections[
+        ["Atlas_X", "Atlas_Y", "Atlas_Z"]
+    ].multiply(1000)
+    stage_cache = io.StageCache(tmp_path)
+
+    def run(**kwargs):
+        return process.process_animal(
+            cells_animalid,
+            cells_annotations,
+            cells_detections,
+            cells_config,
+            **kwargs,
+        )
+
+    def check(results, expected):
+        for df, df_exp in zip(
+            [results[0], results[2], *results[1]],
+            [expected[0], expected[2], *expected[1]],
+        ):
+            pd.testing.assert_frame_equal(df, df_exp)
+
+    check(run(stage_cache=stage_cache), run())
+    nfiles = len(os.listdir(tmp_path))
+    check(run(stage_cache=stage_cache), run())
+    assert len(os.listdir(tmp_path)) == nfiles
+
+    # only the affected stage is computed again
+    cells_config.distributions["ap_nbins"] += 10
+    check(run(stage_cache=stage_cache), run())
+    assert len(os.listdir(tmp_path)) == nfiles + 1
+
+
+def test_get_regions_metrics_from_detections(
+    cells_detections, cells_config, cells_animalid
+):
+    cells_detections[["Atlas_X", "Atlas_Y", "Atlas_Z"]] = cells_detections[
+        ["Atlas_X", "Atlas_Y", "Atlas_Z"]
+    ].multiply(1000)
+    df_detections = process.prepare_detections(cells_detections, cells_config)
+
+    df_regions = process.get_regions_metrics_from_detections(
+        cells_animalid, df_detections, cells_config, leaf_regions_only=False
+    )
+
+    # regions include their descendants
+    atlas = cells_config.bg_atlas
+    df_microns = df_detections[["Atlas_X", "Atlas_Y", "Atlas_Z"]] * 1000
+    regions = utils.add_brain_region(
+        df_microns,
+        atlas,
+        xname=cells_config.Xname,
+        yname=cells_config.Yname,
+        zname=cells_config.Zname,
+    )["Parent"]
+    for region in ("grey", "CTX"):
+        in_region = utils.is_in_region(regions, atlas, region)
+        expected = df_detections.loc[in_region, "channel"].value_counts()
+        counts = df_regions.loc[
+            (df_regions["Name"] == region) & (df_regions["hemisphere"] == "both")
+        ].set_index("channel")["count"]
+        pd.testing.assert_series_equal(
+            counts.sort_index(), expected.sort_index(), check_names=False
+        )
+
+
+def test_get_regions_metrics_from_fibers(fibers_config):
+    rng = np.random.default_rng(0)
+    shape_um = np.asarray(fibers_config.bg_atlas.shape_um)
+
+    def get_fibers(paths, hemispheres):
+        lengths = [len(path) for path in paths]
+        points = np.concatenate(paths)
+        return {
+            "x": points[:, 0],
+            "y": points[:, 1],
+            "z": points[:, 2],
+            "hemisphere": pd.Categorical.from_codes(
+                np.concatenate(hemispheres), categories=["Left", "Right"]
+            ),
+            "offsets": np.concatenate(([0], np.cumsum(lengths))),
+            "path_id": np.repeat(np.arange(len(paths)), lengths),
+            "properties": {
+                "classification": np.resize(
+                    ["Fibers: EGFP", "Fibers: DsRed", "Fibers: Cy5"], len(paths)
+                )
+            },
+        }
+
+    # random walks in the atlas
+    paths = [
+        rng.uniform(0.3, 0.7, 3) * shape_um + rng.normal(0, 50, (10, 3)).cumsum(axis=0)
+        for _ in range(20)
+    ]
+    hemispheres = [rng.integers(0, 2, len(path)) for path in paths]
+    df_regions = process.get_regions_metrics_from_fibers(
+        "mouse0", [get_fibers(paths, hemispheres)], fibers_config
+    )
+
+    # same paths with segments divided in tiny segments, not split at voxels
+    t = np.linspace(0, 1, 200, endpoint=False)[:, None]
+    dense_paths = [
+        np.vstack([p0 + t * (p1 - p0) for p0, p1 in pairwise(path)]) for path in paths
+    ]
+    dense_hemispheres = [np.repeat(hemi[:-1], len(t)) for hemi in hemispheres]
+    df_expected = process.get_regions_metrics_from_fibers(
+        "mouse0",
+        [get_fibers(dense_paths, dense_hemispheres)],
+        fibers_config,
+        split=False,
+    )
+
+    pd.testing.assert_frame_equal(
+        df_regions[["Name", "hemisphere", "channel"]],
+        df_expected[["Name", "hemisphere", "channel"]],
+    )
+    np.testing.assert_allclose(
+        df_regions["length µm"], df_expected["length µm"], atol=2
+    )
@@ -0,0 +1,104 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from cuisto import utils
+
+
+def test_add_brain_region(fibers_config):
+    atlas = fibers_config.bg_atlas
+    rng = np.random.default_rng(0)
+    coords = rng.uniform(0, atlas.shape_um, size=(200, 3)).astype("float32")
+    coords[0] = -1  # out of the atlas
+    df = pd.DataFrame(coords, columns=["Atlas_X", "Atlas_Y", "Atlas_Z"])
+
+    assert utils.add_brain_region(df, atlas) is df  # in place
+
+    expected = [
+        atlas.structure_from_coords(point, as_acronym=True, microns=True)
+        for point in coords.astype(float)
+    ]
+    expected = ["root" if region == "Outside atlas" else region for region in expected]
+    expected[0] = "root"
+    assert isinstance(df["Parent"].dtype, pd.CategoricalDtype)
+    assert df["Parent"].tolist() == expected
+    assert utils.get_region_lookup(atlas) is utils.get_region_lookup(atlas)
+
+
+def test_region_hierarchy(fibers_config):
+    atlas = fibers_config.bg_atlas
+    tree = atlas.structures.tree
+
+    for region in ("root", "grey", "CTX", "VISp"):
+        expected = [
+            atlas.structures[id]["acronym"]
+            for id in tree.expand_tree(atlas.structures[region]["id"])
+        ]
+        assert utils.get_child_regions(atlas, region) == expected
+
+    with pytest.raises(KeyError):
+        utils.get_child_regions(atlas, "unknown")
+
+    leaves = [s["acronym"] for s in atlas.structures_list if tree[s["id"]].is_leaf()]
+    assert utils.get_leaves_list(atlas) == leaves
+
+    regions = pd.Series(["VISp1", "VISp", "MOp", "root", "unknown"])
+    mask = utils.is_in_region(regions, atlas, "VISp")
+    np.testing.assert_array_equal(mask, [True, True, False, False, False])
+
+    ancestors = utils.roll_up_regions(regions, atlas, depth=1)
+    assert ancestors.tolist()[:4] == ["grey", "grey", "grey", "root"]
+    assert pd.isna(ancestors[4])
+
+    hierarchy = utils.get_region_lookup(atlas).hierarchy
+    totals = hierarchy.roll_up(np.ones(len(hierarchy.ids), dtype=int))
+    for region in ("root", "CTX", "VISp"):
+        code = hierarchy.acronyms.index(region)
+        assert totals[code] == len(utils.get_child_regions(atlas, region))
+
+
+@pytest.mark.parametrize("dtype", ["object", "category"])
+def test_filter_df(dtype):
+    df = pd.DataFrame(
+        {
+            "Classification": ["Fibers: EGFP", "fibers: Cy5", "Cells: EGFP", None],
+            "Parent": ["VISp1", "MOp", "VISp1", "CA1"],
+        },
+    ).astype(dtype)
+
+    df_kept = utils.filter_df_classifications(df.iloc[:3], "Fibers", mode="keep")
+    assert df_kept.index.tolist() == [0, 1]
+    assert df_kept["Classification"].dtype == dtype
+    df_removed = utils.filter_df_classifications(df, ["EGFP"], mode="remove")
+    assert df_removed.index.tolist() == [1, 3]
+
+    assert utils.filter_df_regions(df, ["VISp1"]).index.tolist() == [0, 2]
+    assert utils.filter_df_regions(df, ["VISp1"], mode="remove").index.tolist() == [
+        1,
+        3,
+    ]
+
+
+def test_info_store(tmp_path):
+    info_file = tmp_path / "infos.toml"
+    info_file.write_text(
+        "[mouse0]\n[mouse0.EGFP]\nstarter_cells = 150\ninjection_site = [1.0, 2.0, 3.0]\n"
+        "[mouse0.Cy5]\nstarter_cells = 175\ninjection_site = [4.0, 5.0, 6.0]\n"
+        "[mouse1]\n[mouse1.EGFP]\nstarter_cells = 250\ninjection_site = [7.0, 8.0, 9.0]\n"
+    )
+    info_store = utils.get_info_store(info_file)
+
+    np.testing.assert_array_equal(
+        info_store.get_starter_cells("mouse0", ["Cy5", "EGFP", "Cy5"]), [175, 150, 175]
+    )
+    df_sites = info_store.get_injection_sites(["mouse0", "mouse1"], "Cy5", stereo=True)
+    assert df_sites.loc["mouse0"].tolist() == list(utils.ccf_to_stereo(4.0, 5.0, 6.0))
+    assert df_sites.loc["mouse1"].isna().all()
+
+    # modified file is read again
+    info_file.write_text("[mouse0]\n[mouse0.EGFP]\nstarter_cells = 10\n")
+    os.utime(info_file, ns=(0, 0))
+    assert utils.get_starter_cells("mouse0", "EGFP", info_file) == 10
+    assert utils.get_info_store(info_file) is info_store